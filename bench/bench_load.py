@@ -0,0 +1,378 @@
+"""Нагрузочный тест бота целиком: хэндлеры bot.py против локального поддельного Bot API.
+
+Запуск: python bench/bench_load.py [--users 1000 10000 100000] [--sessions 2000] [--workers 8]
+                                   [--api-latency-ms 20] [--rate-limit 0.001] [--broadcast-users N]
+
+Поддельный Bot API — отдельный процесс с HTTP-сервером: отвечает правдоподобными
+сообщениями, считает вызовы по методам, держит задержку api-latency-ms и с
+вероятностью rate-limit отвечает 429 с retry_after. Бот направляется туда через
+apihelper.API_URL, код bot.py не меняется.
+
+Каждое число пользователей прогоняется в отдельном процессе с чистой БД во
+временном каталоге: в users засеваются N пользователей, затем sessions случайных
+пользователей проходят сценарий «старт → каталог → карусель → характеристики →
+заказ», а админ делает рассылку всем доступным. Сценарии идут в пуле из workers
+потоков, апдейты одного пользователя — по порядку, как в WebhookServer.
+В отчёте: пропускная способность, p50/p99 обработки апдейта и хэндлеров,
+суммарное время SQLite (из метрик бота), скорость рассылки и пиковый RSS.
+"""
+import argparse
+import itertools
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from multiprocessing import Process, Queue
+from urllib.parse import parse_qsl, urlsplit
+from urllib.request import urlopen
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+TOKEN = "1:bench"
+ADMIN_ID = 1
+FIRST_USER = 1000
+
+
+# === ПОДДЕЛЬНЫЙ BOT API ===
+class FakeBotAPI:
+    """Bot API в миниатюре: отвечает на любые методы, считает вызовы, умеет тормозить и отвечать 429"""
+
+    MESSAGE_METHODS = ("sendMessage", "sendPhoto", "sendDocument", "editMessageText", "editMessageMedia",
+                       "editMessageCaption", "copyMessage")
+
+    def __init__(self, latency: float = 0.0, rate_limit: float = 0.0, retry_after: float = 1.0, seed: int = 1):
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.retry_after = retry_after
+        self._random = random.Random(seed)
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.calls = {}
+            self.limited = 0
+
+    def handle(self, method: str, params: dict):
+        """(HTTP-код, JSON-ответ) на вызов метода"""
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            self.calls[method] = self.calls.get(method, 0) + 1
+            limited = method != "getMe" and self._random.random() < self.rate_limit
+            if limited:
+                self.limited += 1
+            message_id = next(self._ids)
+        if limited:
+            return 429, {'ok': False, 'error_code': 429, 'description': f"Too Many Requests: retry after {self.retry_after}",
+                         'parameters': {'retry_after': self.retry_after}}
+        if method == "getMe":
+            return 200, {'ok': True, 'result': {'id': 1, 'is_bot': True, 'first_name': 'Bench', 'username': 'bench_bot'}}
+        if method in self.MESSAGE_METHODS:
+            chat_id = int(params.get('chat_id') or 0)
+            result = {'message_id': message_id, 'date': int(time.time()), 'chat': {'id': chat_id, 'type': 'private'}}
+            if method in ("sendPhoto", "editMessageMedia"):
+                result['photo'] = [{'file_id': f"photo{message_id}", 'file_unique_id': f"u{message_id}",
+                                    'width': 800, 'height': 600}]
+            if method == "sendDocument":
+                result['document'] = {'file_id': f"doc{message_id}", 'file_unique_id': f"d{message_id}"}
+            if 'text' in params:
+                result['text'] = params['text']
+            return 200, {'ok': True, 'result': result}
+        return 200, {'ok': True, 'result': True}
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'calls': dict(self.calls), 'total': sum(self.calls.values()), 'limited': self.limited}
+
+
+def serve_fake_api(ready: Queue, latency: float, rate_limit: float, retry_after: float):
+    api = FakeBotAPI(latency, rate_limit, retry_after)
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True  # заголовки и тело уходят отдельно — без этого +40 мс delayed ACK на вызов
+
+        def _reply(self, code: int, payload):
+            body = json.dumps(payload).encode()
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _dispatch(self):
+            url = urlsplit(self.path)
+            length = int(self.headers.get("Content-Length") or 0)
+            body = self.rfile.read(length) if length else b""
+            if url.path == "/_stats":
+                self._reply(200, api.stats())
+                return
+            if url.path == "/_reset":
+                api.reset()
+                self._reply(200, {'ok': True})
+                return
+            params = dict(parse_qsl(url.query))
+            if body and "x-www-form-urlencoded" in (self.headers.get("Content-Type") or ""):
+                params.update(parse_qsl(body.decode()))
+            self._reply(*api.handle(url.path.rsplit("/", 1)[-1], params))
+
+        do_GET = do_POST = _dispatch
+
+        def log_message(self, format, *args):
+            pass
+
+    class Server(ThreadingHTTPServer):
+        daemon_threads = True
+        request_queue_size = 256
+
+        def handle_error(self, request, client_address):
+            pass  # процесс бота завершается, не закрыв keep-alive соединения
+
+    httpd = Server(("127.0.0.1", 0), Handler)
+    ready.put(httpd.server_address[1])
+    httpd.serve_forever()
+
+
+# === СИНТЕТИЧЕСКИЕ АПДЕЙТЫ ===
+class Updates:
+    def __init__(self):
+        self._ids = itertools.count(1)  # TeleBot пропускает update_id <= 0
+
+    def message(self, uid: int, text: str) -> dict:
+        n = next(self._ids)
+        return {'update_id': n, 'message': {
+            'message_id': n, 'date': int(time.time()), 'text': text,
+            'chat': {'id': uid, 'type': 'private'},
+            'from': {'id': uid, 'is_bot': False, 'first_name': f"User{uid}"}}}
+
+    def callback(self, uid: int, data: str, message_id: int = 1) -> dict:
+        n = next(self._ids)
+        return {'update_id': n, 'callback_query': {
+            'id': str(n), 'chat_instance': str(uid), 'data': data,
+            'from': {'id': uid, 'is_bot': False, 'first_name': f"User{uid}"},
+            'message': {'message_id': message_id, 'date': int(time.time()), 'text': "",
+                        'chat': {'id': uid, 'type': 'private'},
+                        'from': {'id': 1, 'is_bot': True, 'first_name': 'Bench'}}}}
+
+    def session(self, uid: int, bike: str, photos: int):
+        """Сценарий покупателя: (шаг, апдейт)"""
+        yield "start", self.message(uid, "/start")
+        yield "catalog", self.message(uid, "Каталог")
+        yield "bike", self.callback(uid, bike)
+        for _ in range(min(3, photos - 1)):
+            yield "next_photo", self.callback(uid, f"next_photo_{bike}")
+        yield "prev_photo", self.callback(uid, f"prev_photo_{bike}")
+        yield "specs", self.callback(uid, f"specs_{bike}")
+        yield "order", self.callback(uid, f"order_{bike}")
+        yield "size", self.callback(uid, "size_M")
+        yield "contacts", self.message(uid, "Иван +7 900 123-45-67")
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))] if values else 0.0
+
+
+def rss_mb() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # в Linux — килобайты
+
+
+# === ОДИН ПРОГОН (в отдельном процессе) ===
+def seed_users(db, count: int, reachable: int):
+    from database import USER_UPSERT_SQL
+
+    now = time.strftime("%Y-%m-%dT%H:%M:%S")
+    batch = 50000
+    for start in range(0, count, batch):
+        rows = [(FIRST_USER + i, f"user{i}", f"User{i}", "", f"User{i}", now, now)
+                for i in range(start, min(start + batch, count))]
+        with db.pool.transaction() as conn:
+            conn.executemany(USER_UPSERT_SQL, rows)
+    if reachable < count:
+        with db.pool.transaction() as conn:
+            conn.execute("UPDATE users SET reachable = 0 WHERE user_id >= ?", (FIRST_USER + reachable,))
+
+
+def run_once(args, users: int) -> dict:
+    from telebot import apihelper, types
+
+    apihelper.API_URL = f"http://127.0.0.1:{args.api_port}/bot{{0}}/{{1}}"
+    os.environ.update({
+        'BOT_TOKEN': TOKEN,
+        'ADMIN_ID': str(ADMIN_ID),
+        'REDIS_URL': os.environ.get('REDIS_URL', "redis://localhost:6379/0"),  # без STATE_STORAGE=redis не используется
+        'BROADCAST_RATE': str(args.broadcast_rate),
+        'FLOOD_RATE': "1000",  # антифлуд меряем отдельно, здесь он не должен резать сценарии
+        'FLOOD_BURST': "1000",
+        'METRICS_ENABLED': "1",
+    })
+    import bot as B
+
+    B.bot.threaded = False
+    seed_started = time.perf_counter()
+    seed_users(B.db, users, min(users, args.broadcast_users or users))
+    seed_time = time.perf_counter() - seed_started
+    urlopen(f"http://127.0.0.1:{args.api_port}/_reset").read()
+
+    # Покупатели
+    snap = B.bike_catalog.current()
+    bikes = list(snap.photos)
+    rng = random.Random(users)
+    gen = Updates()
+    customers = rng.sample(range(FIRST_USER, FIRST_USER + users), min(args.sessions, users))
+    scripts = []
+    for uid in customers:
+        bike = rng.choice(bikes)
+        scripts.append(list(gen.session(uid, bike, len(snap.photos[bike]))))
+    latencies = {}
+    lock = threading.Lock()
+
+    def play(script):
+        local = []
+        for step, raw in script:
+            update = types.Update.de_json(raw)
+            started = time.perf_counter()
+            B.bot.process_new_updates([update])
+            local.append((step, time.perf_counter() - started))
+        with lock:
+            for step, seconds in local:
+                latencies.setdefault(step, []).append(seconds)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(args.workers) as pool:
+        list(pool.map(play, scripts))
+    handled = time.perf_counter() - started
+    B.order_writer.submit(lambda: None).result()
+    while B.outbox.stats()['queued']:
+        time.sleep(0.05)
+    drained = time.perf_counter() - started
+    all_latencies = [s for values in latencies.values() for s in values]
+
+    # Рассылка от админа
+    broadcast = {}
+    for raw in (gen.message(ADMIN_ID, "Рассылка"), gen.message(ADMIN_ID, "Новая поставка велосипедов!")):
+        B.bot.process_new_updates([types.Update.de_json(raw)])
+    confirm_started = time.perf_counter()
+    B.bot.process_new_updates([types.Update.de_json(gen.callback(ADMIN_ID, "confirm_broadcast"))])
+    broadcast['confirm_ms'] = (time.perf_counter() - confirm_started) * 1000
+    jobs = B.broadcaster.active()
+    if jobs:
+        job = jobs[0]
+        finished = job.done.wait(args.broadcast_timeout)
+        elapsed = time.perf_counter() - confirm_started
+        broadcast.update(total=job.total, sent=job.sent, failed=job.failed, seconds=elapsed,
+                         rate=job.processed / elapsed if elapsed else 0.0, finished=finished)
+        if not finished:
+            B.broadcaster.shutdown()
+
+    db_time = {labels[0]: (count, count * avg) for labels, (count, avg, _) in
+               B.metrics.histogram('bot_db_query_seconds').items()}
+    handlers = {labels[0]: (count, avg * 1000, p99 * 1000) for labels, (count, avg, p99) in
+                B.metrics.histogram('bot_handler_seconds').items()}
+    api = json.loads(urlopen(f"http://127.0.0.1:{args.api_port}/_stats").read())
+    B.outbox.stop()
+    return {
+        'users': users,
+        'seed_s': seed_time,
+        'updates': len(all_latencies),
+        'throughput': len(all_latencies) / handled,
+        'drain_s': drained,
+        'p50_ms': percentile(all_latencies, 0.5) * 1000,
+        'p99_ms': percentile(all_latencies, 0.99) * 1000,
+        'steps': {step: (percentile(v, 0.5) * 1000, percentile(v, 0.99) * 1000) for step, v in latencies.items()},
+        'handlers': handlers,
+        'db': db_time,
+        'broadcast': broadcast,
+        'api': api,
+        'rss_mb': rss_mb(),
+    }
+
+
+# === ОТЧЁТ ===
+def report(result: dict, verbose: bool):
+    db_total = sum(seconds for _, seconds in result['db'].values())
+    db_queries = sum(count for count, _ in result['db'].values())
+    b = result['broadcast']
+    print(f"\n=== {result['users']:,} пользователей (засев {result['seed_s']:.1f} с) ===")
+    print(f"апдейтов: {result['updates']}, {result['throughput']:.0f} апд/с, "
+          f"p50 {result['p50_ms']:.2f} мс, p99 {result['p99_ms']:.2f} мс, очередь ответов пуста через {result['drain_s']:.1f} с")
+    print(f"SQLite: {db_queries} запросов, {db_total * 1000:.0f} мс всего, "
+          f"{db_total / max(1, result['updates']) * 1000:.3f} мс на апдейт")
+    if b:
+        print(f"рассылка: {b['sent']}/{b['total']} за {b['seconds']:.1f} с, {b['rate']:.0f} сообщ./с, "
+              f"confirm_broadcast {b['confirm_ms']:.1f} мс{'' if b['finished'] else ', НЕ ЗАВЕРШЕНА'}")
+    print(f"Bot API: {result['api']['total']} вызовов, 429: {result['api']['limited']}; пиковый RSS {result['rss_mb']:.0f} МБ")
+    if verbose:
+        print("шаги (p50 / p99, мс):")
+        for step, (p50, p99) in result['steps'].items():
+            print(f"  {step:12s} {p50:8.2f} {p99:8.2f}")
+        print("хэндлеры (количество, среднее, p99, мс):")
+        for name, (count, avg, p99) in sorted(result['handlers'].items(), key=lambda item: -item[1][1]):
+            print(f"  {name:24s} {count:7d} {avg:8.2f} {p99:8.2f}")
+        print("SQLite по видам (количество, мс):")
+        for op, (count, seconds) in sorted(result['db'].items(), key=lambda item: -item[1][1]):
+            print(f"  {op:12s} {count:7d} {seconds * 1000:9.1f}")
+        print(f"вызовы API: {result['api']['calls']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--sessions", type=int, default=2000, help="сколько пользователей проходят сценарий")
+    parser.add_argument("--workers", type=int, default=8, help="потоков обработки апдейтов")
+    parser.add_argument("--api-latency-ms", type=float, default=20.0)
+    parser.add_argument("--rate-limit", type=float, default=0.001, help="доля ответов 429")
+    parser.add_argument("--retry-after", type=float, default=0.2, help="retry_after в ответах 429, с")
+    parser.add_argument("--broadcast-rate", type=float, default=2000, help="BROADCAST_RATE бота")
+    parser.add_argument("--broadcast-users", type=int, default=None,
+                        help="доступных для рассылки (по умолчанию все); для 1M без ограничения прогон займёт минуты")
+    parser.add_argument("--broadcast-timeout", type=float, default=600)
+    parser.add_argument("--verbose", action="store_true", help="по шагам, хэндлерам и запросам SQLite")
+    parser.add_argument("--api-port", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--child", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child is not None:
+        # Вывод бота в stdout не нужен — результат одной JSON-строкой в stderr
+        sys.stdout = open(os.devnull, "w")
+        result = run_once(args, args.child)
+        print(json.dumps(result), file=sys.stderr)
+        return
+
+    ready = Queue()
+    api = Process(target=serve_fake_api, args=(ready, args.api_latency_ms / 1000, args.rate_limit, args.retry_after),
+                  daemon=True)
+    api.start()
+    port = ready.get(timeout=10)
+    print(f"сессий: {args.sessions}, потоков: {args.workers}, задержка API {args.api_latency_ms} мс, "
+          f"429: {args.rate_limit:.2%} (retry_after {args.retry_after} с)")
+    try:
+        for users in args.users:
+            with tempfile.TemporaryDirectory(prefix="bench_load_") as workdir:
+                # Чистая БД на каждый прогон: bot.py открывает users.db в текущем каталоге
+                child = subprocess.run(
+                    [sys.executable, os.path.abspath(__file__), "--child", str(users), "--api-port", str(port)]
+                    + sys.argv[1:],
+                    cwd=workdir, stderr=subprocess.PIPE, text=True,
+                )
+            lines = [line for line in child.stderr.splitlines() if line.startswith("{")]
+            if child.returncode != 0 or not lines:
+                print(f"\n=== {users:,} пользователей: прогон упал ===\n{child.stderr[-2000:]}")
+                continue
+            report(json.loads(lines[-1]), args.verbose)
+    finally:
+        api.terminate()
+
+
+if __name__ == "__main__":
+    main()
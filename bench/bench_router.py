@@ -0,0 +1,146 @@
+"""Микробенчмарк: цепочка фильтров TeleBot против Router.
+
+Запуск: python bench/bench_router.py [--updates 20000] [--extra-handlers 0 20 50]
+
+Обе схемы регистрируются на отдельных TeleBot(threaded=False) с пустыми
+обработчиками, апдейты прогоняются через process_new_updates — меряется
+только диспетчеризация, без сети и БД.
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from telebot import TeleBot, types  # noqa: E402
+
+from router import Router  # noqa: E402
+
+ADMIN_ID = 1
+BIKES = ("PRIMO", "TERZO", "ULTIMO", "TESORO", "OTTIMO")
+TOKEN = "1:bench"
+
+
+def noop(_):
+    pass
+
+
+def message(uid, text, n):
+    return types.Update.de_json({
+        'update_id': n,
+        'message': {'message_id': n, 'date': 0, 'text': text,
+                    'chat': {'id': uid, 'type': 'private'},
+                    'from': {'id': uid, 'is_bot': False, 'first_name': 'U'}},
+    })
+
+
+def callback(uid, data, n):
+    return types.Update.de_json({
+        'update_id': n,
+        'callback_query': {'id': str(n), 'chat_instance': 'x', 'data': data,
+                           'from': {'id': uid, 'is_bot': False, 'first_name': 'U'},
+                           'message': {'message_id': 1, 'date': 0, 'chat': {'id': uid, 'type': 'private'}}},
+    })
+
+
+def workload(count):
+    """Смесь, похожая на реальный трафик: каталог, карусель, заказ, болтовня"""
+    templates = [
+        lambda n: message(10 + n % 50, "Каталог", n),
+        lambda n: callback(10 + n % 50, BIKES[n % len(BIKES)], n),
+        lambda n: callback(10 + n % 50, "next_photo_PRIMO", n),
+        lambda n: callback(10 + n % 50, "prev_photo_PRIMO", n),
+        lambda n: callback(10 + n % 50, "specs_TERZO", n),
+        lambda n: callback(10 + n % 50, "size_M (17\")", n),
+        lambda n: message(10 + n % 50, "Иван 8 999 123-45-67", n),
+        lambda n: message(10 + n % 50, "Позвать специалиста", n),
+        lambda n: message(10 + n % 50, "просто спросить", n),
+        lambda n: message(ADMIN_ID, "Статистика", n),
+    ]
+    return [templates[n % len(templates)](n) for n in range(count)]
+
+
+def chain_bot(extra):
+    """Та же цепочка фильтров, что была в bot.py до роутера"""
+    bot = TeleBot(TOKEN, threaded=False)
+    bot.message_handler(commands=['admin'])(noop)
+    for text in ("Статистика", "Список пользователей", "Рассылка"):
+        bot.message_handler(func=lambda m, t=text: m.text and m.text == t and m.from_user.id == ADMIN_ID)(noop)
+    for i in range(extra):
+        bot.message_handler(func=lambda m, t=f"Кнопка {i}": m.text and m.text == t)(noop)
+    bot.message_handler(func=lambda m: m.text and m.text == "Выйти из админки" and m.from_user.id == ADMIN_ID)(noop)
+    bot.message_handler(commands=['start'])(noop)
+    bot.message_handler(func=lambda m: "специалиста" in m.text.lower())(noop)
+    bot.message_handler(func=lambda m: "Каталог" in m.text)(noop)
+    bot.message_handler(func=lambda m: any(c.isdigit() for c in m.text) and len(m.text) > 5)(noop)
+    bot.message_handler(func=lambda m: True)(noop)
+
+    bot.callback_query_handler(func=lambda call: call.data == "confirm_broadcast")(noop)
+    bot.callback_query_handler(func=lambda call: call.data == "cancel_broadcast")(noop)
+    for i in range(extra):
+        bot.callback_query_handler(func=lambda call, p=f"extra{i}_": call.data.startswith(p))(noop)
+    bot.callback_query_handler(func=lambda call: call.data in BIKES)(noop)
+    bot.callback_query_handler(func=lambda call: call.data.startswith(("prev_photo_", "next_photo_")))(noop)
+    bot.callback_query_handler(func=lambda call: call.data.startswith("specs_"))(noop)
+    bot.callback_query_handler(func=lambda call: call.data.startswith("order_"))(noop)
+    bot.callback_query_handler(func=lambda call: call.data.startswith("size_"))(noop)
+    return bot
+
+
+def router_bot(extra):
+    bot = TeleBot(TOKEN, threaded=False)
+    router = Router(admin_id=ADMIN_ID)
+    router.text("Статистика", "Список пользователей", "Рассылка", "Выйти из админки", admin=True)(noop)
+    router.text("Позвать специалиста", "Каталог")(noop)
+    for i in range(extra):
+        router.text(f"Кнопка {i}")(noop)
+        router.callback_prefix(f"extra{i}_")(noop)
+    router.callback("confirm_broadcast", "cancel_broadcast")(noop)
+    router.callback_prefix("prev_photo_", "next_photo_", "specs_", "order_", "size_")(noop)
+
+    @router.text_fallback
+    def fallback(msg):
+        text = msg.text
+        if "специалиста" in text.lower() or "Каталог" in text:
+            return
+        if len(text) > 5 and any(c.isdigit() for c in text):
+            return
+
+    @router.callback_fallback
+    def callback_fallback(call):
+        return call.data in BIKES
+
+    bot.message_handler(commands=['admin'])(noop)
+    bot.message_handler(commands=['start'])(noop)
+    bot.message_handler(content_types=['text'])(router.dispatch_message)
+    bot.callback_query_handler(func=lambda call: True)(router.dispatch_callback)
+    return bot
+
+
+def measure(bot, updates, rounds=3):
+    best = float('inf')
+    for _ in range(rounds):
+        start = time.perf_counter()
+        for update in updates:
+            bot.process_new_updates([update])
+        best = min(best, time.perf_counter() - start)
+    return best / len(updates) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--updates", type=int, default=20000)
+    parser.add_argument("--extra-handlers", type=int, nargs="*", default=[0, 20, 50])
+    args = parser.parse_args()
+
+    updates = workload(args.updates)
+    print(f"{'доп. обработчиков':>18} {'цепочка, мкс':>14} {'роутер, мкс':>13} {'ускорение':>10}")
+    for extra in args.extra_handlers:
+        chain = measure(chain_bot(extra), updates)
+        routed = measure(router_bot(extra), updates)
+        print(f"{extra:>18} {chain:>14.2f} {routed:>13.2f} {chain / routed:>9.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,194 @@
+"""Нагрузочный тест приёма апдейтов: long polling против WebhookServer.
+
+Запуск: python bench/bench_webhook.py [--updates 5000] [--rate 1500] [--workers 8] [--work-ms 5] [--rtt-ms 60]
+
+Апдейты «приходят» с заданной частотой. В режиме polling Bot API подменяется
+через apihelper.CUSTOM_REQUEST_SENDER: getUpdates отвечает пачками с задержкой
+rtt, подтверждением апдейта считается следующий getUpdates с offset за ним.
+В режиме webhook клиенты шлют POST на локальный WebhookServer из отдельного
+процесса (как и Telegram, они не делят GIL с ботом), подтверждение — ответ 200.
+Хэндлер в обоих режимах спит work-ms (имитация запросов к API), число потоков
+обработки одинаковое.
+"""
+import argparse
+import http.client
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from telebot import TeleBot, apihelper  # noqa: E402
+
+from webhook import SECRET_HEADER, WebhookServer  # noqa: E402
+
+TOKEN = "1:bench"
+SECRET = "bench-secret"
+
+
+def update(n):
+    uid = 1000 + n % 500
+    return {
+        'update_id': n + 1,  # TeleBot пропускает update_id <= 0
+        'message': {'message_id': n + 1, 'date': 0, 'text': "Каталог",
+                    'chat': {'id': uid, 'type': 'private'},
+                    'from': {'id': uid, 'is_bot': False, 'first_name': 'U'}},
+    }
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))] if values else 0.0
+
+
+class Workload:
+    """Расписание прихода апдейтов и учёт обработанных"""
+
+    def __init__(self, count, rate):
+        self.count = count
+        self.interval = 1.0 / rate
+        self.start = time.monotonic() + 0.2
+        self.processed = 0
+        self.finished_at = None
+        self.done = threading.Event()
+        self._lock = threading.Lock()
+
+    def arrival(self, n):
+        return self.start + n * self.interval
+
+    def register(self, bot, work):
+        @bot.message_handler(func=lambda m: True)
+        def handle(_):
+            time.sleep(work)
+            with self._lock:
+                self.processed += 1
+                if self.processed == self.count:
+                    self.finished_at = time.monotonic()
+                    self.done.set()
+
+
+def run_polling(args):
+    load = Workload(args.updates, args.rate)
+    acks = []
+    state = {'acked': 0}
+
+    class Response:
+        status_code = 200
+        reason = 'OK'
+
+        def __init__(self, result):
+            self.text = json.dumps({'ok': True, 'result': result})
+
+        def json(self):
+            return json.loads(self.text)
+
+    def sender(method, url, params=None, **kwargs):
+        params = params or {}
+        if url.endswith("/getMe"):
+            return Response({'id': 1, 'is_bot': True, 'first_name': 'Bench', 'username': 'bench_bot'})
+        if not url.endswith("/getUpdates"):
+            return Response(True)
+        time.sleep(args.rtt_ms / 2000)  # запрос идёт до Telegram
+        now = time.monotonic()
+        offset = max(int(params.get('offset') or 1) - 1, 0)  # номер первого неподтверждённого апдейта
+        for n in range(state['acked'], min(offset, args.updates)):
+            acks.append(now - load.arrival(n))
+        state['acked'] = max(state['acked'], offset)
+        deadline = now + float(params.get('timeout') or 0)
+        while offset >= args.updates or load.arrival(offset) > time.monotonic():
+            if time.monotonic() >= deadline or load.done.is_set():
+                time.sleep(args.rtt_ms / 2000)
+                return Response([])
+            time.sleep(0.001)
+        ready = [n for n in range(offset, min(offset + int(params.get('limit') or 100), args.updates))
+                 if load.arrival(n) <= time.monotonic()]
+        time.sleep(args.rtt_ms / 2000)  # ответ идёт обратно
+        return Response([update(n) for n in ready])
+
+    apihelper.CUSTOM_REQUEST_SENDER = sender
+    try:
+        bot = TeleBot(TOKEN, threaded=True, num_threads=args.workers)
+        load.register(bot, args.work_ms / 1000)
+        poller = threading.Thread(target=bot.infinity_polling,
+                                  kwargs={'timeout': 20, 'long_polling_timeout': 1, 'logger_level': None},
+                                  daemon=True)
+        poller.start()
+        load.done.wait()
+        bot.stop_polling()
+    finally:
+        apihelper.CUSTOM_REQUEST_SENDER = None
+    return load, acks
+
+
+def send_updates(port, path, start, count, rate, connections):
+    """Клиентская сторона вебхука — запускается в отдельном процессе, возвращает (задержки ack, статусы)"""
+    load = Workload(count, rate)
+    load.start = start  # time.monotonic() общий для процессов одной машины
+    acks = []
+    local = threading.local()
+
+    def post(n):
+        delay = load.arrival(n) - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        conn = getattr(local, 'conn', None)
+        if conn is None:
+            conn = local.conn = http.client.HTTPConnection("127.0.0.1", port)
+        body = json.dumps(update(n))
+        conn.request("POST", path, body, {SECRET_HEADER: SECRET, "Content-Type": "application/json"})
+        response = conn.getresponse()
+        response.read()
+        acks.append(time.monotonic() - load.arrival(n))
+        return response.status
+
+    # Telegram держит до max_connections параллельных соединений на вебхук
+    with ThreadPoolExecutor(connections) as pool:
+        statuses = list(pool.map(post, range(count)))
+    return acks, statuses
+
+
+def run_webhook(args):
+    with ProcessPoolExecutor(1) as sender:
+        sender.submit(time.sleep, 0).result()  # процесс-отправитель поднят до старта расписания
+        load = Workload(args.updates, args.rate)
+        bot = TeleBot(TOKEN, threaded=False)
+        load.register(bot, args.work_ms / 1000)
+        server = WebhookServer(bot, SECRET, host="127.0.0.1", port=0, workers=args.workers,
+                               queue_size=args.queue_size)
+        server.start()
+        acks, statuses = sender.submit(send_updates, server.port, server.path, load.start, args.updates,
+                                       args.rate, args.connections).result()
+    load.done.wait()
+    server.stop()
+    print(f"  webhook: ответов не 200: {sum(1 for s in statuses if s != 200)}, статистика: {server.stats()}")
+    return load, acks
+
+
+def report(name, load, acks):
+    elapsed = load.finished_at - load.start
+    print(f"{name:8s} {load.count / elapsed:9.0f} апд/с   ack p50 {percentile(acks, 0.5) * 1000:7.1f} мс"
+          f"   p99 {percentile(acks, 0.99) * 1000:7.1f} мс")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--updates", type=int, default=5000)
+    parser.add_argument("--rate", type=float, default=1500, help="апдейтов в секунду на входе")
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--work-ms", type=float, default=5.0, help="время обработки одного апдейта")
+    parser.add_argument("--rtt-ms", type=float, default=60.0, help="RTT до api.telegram.org для polling")
+    parser.add_argument("--connections", type=int, default=40, help="параллельных соединений к вебхуку")
+    parser.add_argument("--queue-size", type=int, default=1000)
+    args = parser.parse_args()
+
+    print(f"апдейтов: {args.updates}, на входе {args.rate:.0f}/с, потоков обработки: {args.workers}, "
+          f"обработка {args.work_ms} мс, RTT {args.rtt_ms} мс")
+    report("polling", *run_polling(args))
+    report("webhook", *run_webhook(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,32 @@
 import os
 import logging
 import datetime
+import html
+import re
 import time
-import sqlite3
-from telebot import TeleBot, types
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from telebot import TeleBot, types, util
+from telebot.apihelper import ApiTelegramException
 from telebot.handler_backends import State, StatesGroup
-from telebot.storage import StateRedisStorage
+from telebot.storage import StateMemoryStorage
 from urllib.parse import urlparse
 
+from broadcast import Broadcaster
+from catalog import Catalog
+from database import BroadcastStore, Database, PhotoStore
+from export import EXPORT_TITLES, export_csv_gz, export_filename, parse_period
+from flood import Coalescer, FloodControl
+from metrics import Metrics, MetricsServer, UpdateTimer, describe_defaults, instrument_api
+from outbox import Outbox
+from photo_cache import PhotoCache
+from ratelimit import TokenBucket
+from router import Router
+from sessions import SessionStore
+from startup import FileLease, FirstUpdate, RedisLease
+
+STARTED_AT = time.monotonic()  # от этого момента считается время до первого апдейта
+
 # === ЛОГИРОВАНИЕ ===
 logging.basicConfig(level=logging.INFO)
 print("Начало инициализации бота...")
@@ -16,6 +35,35 @@ print("Начало инициализации бота...")
 TOKEN = os.getenv("BOT_TOKEN")
 ADMIN_ID = int(os.getenv("ADMIN_ID"))  # <-- int!
 REDIS_URL = os.getenv("REDIS_URL")
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "25"))  # сообщений в секунду, лимит Telegram ~30
+BROADCAST_WORKERS = int(os.getenv("BROADCAST_WORKERS", "8"))
+OUTBOX_WORKERS = int(os.getenv("OUTBOX_WORKERS", "4"))
+PHOTO_WARMUP_CHAT_ID = os.getenv("PHOTO_WARMUP_CHAT_ID")  # служебный чат для предзагрузки фото каталога
+SESSION_TTL = float(os.getenv("SESSION_TTL", "86400"))  # сколько живёт карусель / незавершённый заказ, с
+SESSION_MAX_ENTRIES = int(os.getenv("SESSION_MAX_ENTRIES", "50000"))
+STATE_STORAGE = os.getenv("STATE_STORAGE", "memory").lower()  # redis — состояния и сессии общие для всех реплик
+STATE_TTL = int(os.getenv("STATE_TTL", "86400"))  # TTL ключей состояний в Redis, с
+REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", "16"))
+# Лиза на polling и фоновые задачи в единственном экземпляре: новый экземпляр стартует,
+# как только старый её отпустит. redis (по умолчанию — контейнеры Railway не делят диск),
+# file — для одного хоста или общего тома, none — без лизы
+LEASE_BACKEND = os.getenv("LEASE_BACKEND", "redis").lower()
+LEASE_FILE = os.getenv("LEASE_FILE", "bot.lease")
+LEASE_TTL = float(os.getenv("LEASE_TTL", "15"))  # столько ждёт новый экземпляр, если старый упал, не отпустив лизу
+BOT_MODE = os.getenv("BOT_MODE", "polling").lower()  # webhook — апдейты принимает встроенный HTTP-сервер
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # публичный адрес, например https://bot.up.railway.app
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBHOOK_PORT = int(os.getenv("PORT", "8080"))
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "8"))
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", "1000"))
+FLOOD_RATE = float(os.getenv("FLOOD_RATE", "1"))  # апдейтов в секунду от одного пользователя
+FLOOD_BURST = float(os.getenv("FLOOD_BURST", "5"))
+FLOOD_MAX_USERS = int(os.getenv("FLOOD_MAX_USERS", "10000"))  # сколько пользователей помнит антифлуд
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1") != "0"
+METRICS_PORT = os.getenv("METRICS_PORT")  # порт для /metrics; не задан — метрики только в админке
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")  # "::" — открыть для внутренней сети хостинга
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")  # Bearer-токен для /metrics; обязателен, если METRICS_HOST не localhost
 
 print(f"Токен: {'Да' if TOKEN else 'НЕТ'}")
 print(f"Админ ID: {ADMIN_ID}")
@@ -25,11 +73,20 @@ if not TOKEN or not ADMIN_ID or not REDIS_URL:
     print("ОШИБКА: Не хватает BOT_TOKEN, ADMIN_ID или REDIS_URL")
     exit(1)
 
+if BOT_MODE == "webhook" and (not WEBHOOK_URL or not WEBHOOK_SECRET):
+    print("ОШИБКА: Для BOT_MODE=webhook нужны WEBHOOK_URL и WEBHOOK_SECRET")
+    exit(1)
+
+if METRICS_PORT and METRICS_HOST not in ("127.0.0.1", "localhost", "::1") and not METRICS_TOKEN:
+    print("ОШИБКА: /metrics открыт не только на localhost — задайте METRICS_TOKEN")
+    exit(1)
+
 # === ПАРСИНГ REDIS_URL ===
 try:
     parsed = urlparse(REDIS_URL)
     redis_host = parsed.hostname or 'localhost'
     redis_port = parsed.port or 6379
+    redis_username = parsed.username or None
     redis_password = parsed.password
     redis_db = int(parsed.path.lstrip('/')) if parsed.path else 0
     print(f"Redis: {redis_host}:{redis_port}, db={redis_db}")
@@ -37,234 +94,379 @@ except Exception as e:
     print(f"Ошибка парсинга REDIS_URL: {e}")
     exit(1)
 
-# === ИНИЦИАЛИЗАЦИЯ БОТА — ПРОСТО И НАДЁЖНО (без Redis) ===
-bot = TeleBot(TOKEN)
-print("Бот запущен с хранением состояний в памяти (MemoryStorage)")
+# === ИНИЦИАЛИЗАЦИЯ БОТА ===
+# По умолчанию состояния в памяти; STATE_STORAGE=redis — FSM и сессии в Redis,
+# так можно держать несколько реплик бота и не терять состояния при перезапуске.
+# В режиме вебхука у TeleBot свой пул потоков не нужен — апдейты раздаёт WebhookServer
+if STATE_STORAGE == "redis":
+    import redis
+    from redis_storage import RedisConnection, RedisSessionBackend, RedisStateStorage
+
+    redis_pool = redis.ConnectionPool(
+        host=redis_host,
+        port=redis_port,
+        db=redis_db,
+        username=redis_username,
+        password=redis_password,
+        max_connections=REDIS_MAX_CONNECTIONS,
+        socket_timeout=5,
+        health_check_interval=30,
+    )
+    redis_conn = RedisConnection(redis_pool)
+    state_storage = RedisStateStorage(redis_conn, ttl=STATE_TTL, bot_id=util.extract_bot_id(TOKEN))
+    session_backend = RedisSessionBackend(redis_conn)
+    bot = TeleBot(TOKEN, state_storage=state_storage, threaded=BOT_MODE != "webhook",
+                  use_class_middlewares=True)
+    print(f"Бот запущен с хранением состояний в Redis (пул до {REDIS_MAX_CONNECTIONS} соединений, TTL {STATE_TTL} с)")
+else:
+    redis_conn = None
+    session_backend = None
+    bot = TeleBot(TOKEN, state_storage=StateMemoryStorage(), threaded=BOT_MODE != "webhook",
+                  use_class_middlewares=True)
+    print("Бот запущен с хранением состояний в памяти (MemoryStorage)")
+
+# === МЕТРИКИ ===
+# Задержки хэндлеров, запросов к SQLite и Bot API; с METRICS_ENABLED=0 замеры не ставятся вовсе
+metrics = Metrics(enabled=METRICS_ENABLED)
+if METRICS_ENABLED:
+    describe_defaults(metrics)
+    instrument_api(metrics)
+
+# Этапы запуска, с: инициализация, ожидание лизы, первый апдейт
+startup_times = {}
+
+def report_first_update(elapsed):
+    startup_times['first_update'] = elapsed
+    print(f"Первый апдейт через {elapsed:.2f} с после старта (инициализация {startup_times.get('init', 0):.2f} с, "
+          f"ожидание лизы {startup_times.get('lease_wait', 0):.2f} с)")
+
+bot.setup_middleware(FirstUpdate(STARTED_AT, on_first=report_first_update))
+metrics.collect('bot_startup_seconds', 'gauge', "Startup phases since process start", lambda: dict(startup_times),
+                labels=('phase',))
+
+# Все тексты и callback'и идут через один роутер: словари вместо цепочки фильтров
+router = Router(admin_id=ADMIN_ID, metrics=metrics if METRICS_ENABLED else None)
+
+# === АНТИФЛУД ===
+# Middleware до хэндлеров: лишние апдейты от одного пользователя отбрасываются,
+# не доходя до БД; предупреждение — не чаще раза в 10 секунд, остальные callback'и
+# закрываются пустым ответом
+def warn_flood(update):
+    if isinstance(update, types.CallbackQuery):
+        bot.answer_callback_query(update.id, "Слишком часто, подождите немного")
+    else:
+        outbox.send_message(update.chat.id, "Слишком много сообщений, подождите немного")
+
+def drop_flood(update):
+    # Пустой ответ на callback: убирает индикатор загрузки у кнопки, в чат ничего не пишет
+    if isinstance(update, types.CallbackQuery):
+        bot.answer_callback_query(update.id)
+
+flood = FloodControl(rate=FLOOD_RATE, burst=FLOOD_BURST, max_users=FLOOD_MAX_USERS,
+                     exempt=(ADMIN_ID,), on_throttle=warn_flood, on_drop=drop_flood)
+bot.setup_middleware(flood)
+if METRICS_ENABLED:
+    bot.setup_middleware(UpdateTimer(metrics))  # после антифлуда: отброшенные апдейты не замеряем
+# Листание карусели: из серии быстрых кликов рисуем только последний
+carousel_renders = Coalescer(window=0.7)
 
 # === БАЗА ДАННЫХ ===
+# Одна БД на всё: пользователи, заказы, статистика, рассылки и кэш фото.
+# При старте схема догоняется миграциями, данные старой bot_database.db переносятся
 DB_FILE = "users.db"
-
-def ensure_users_db():
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            user_id TEXT PRIMARY KEY,
-            username TEXT,
-            first_name TEXT,
-            last_name TEXT,
-            full_name TEXT,
-            first_seen TEXT,
-            last_activity TEXT,
-            messages_count INTEGER
-        )
-    ''')
-    conn.commit()
-    conn.close()
-    print(f"БД {DB_FILE} готова")
-
-ensure_users_db()
+db = Database(DB_FILE)
+users_db = db.pool
+users_db.metrics = metrics if METRICS_ENABLED else None
+print(f"БД {DB_FILE} готова (схема v{db.version})")
+
+# Общий лимит бота: его делят рассылки и обычные ответы
+api_bucket = TokenBucket(BROADCAST_RATE)
+broadcaster = Broadcaster(bot, BroadcastStore(users_db), api_bucket, workers=BROADCAST_WORKERS)
+# Ответы пользователям уходят через очередь: порядок в чате, лимит на чат и общий, повтор после 429
+outbox = Outbox(bot, api_bucket, workers=OUTBOX_WORKERS)
+# Заказы пишутся одним фоновым потоком, чтобы хэндлер не ждал БД
+order_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="orders")
+# Выгрузки CSV — тоже в фоне и по одной, чтобы не занимать потоки хэндлеров
+export_worker = ThreadPoolExecutor(max_workers=1, thread_name_prefix="export")
+photo_cache = PhotoCache(PhotoStore(users_db))
+webhook_server = None  # WebhookServer, создаётся при запуске с BOT_MODE=webhook
+lease = None  # FileLease / RedisLease, берётся при запуске; None при LEASE_BACKEND=none
+
+# Очереди и счётчики компонентов снимаются в момент запроса /metrics
+metrics.collect('bot_outbox_queued', 'gauge', "Replies waiting in the outbox", lambda: outbox.stats()['queued'])
+metrics.collect('bot_outbox_messages_total', 'counter', "Outbox deliveries by outcome",
+                lambda: {k: v for k, v in outbox.stats().items() if k in ('sent', 'failed', 'retried', 'dropped')},
+                labels=('outcome',))
+metrics.collect('bot_webhook_queued', 'gauge', "Updates waiting in webhook queues",
+                lambda: webhook_server.stats()['queued'] if webhook_server is not None else 0)
+metrics.collect('bot_broadcast_active', 'gauge', "Running broadcasts", lambda: len(broadcaster.active()))
+metrics.collect('bot_broadcast_rate', 'gauge', "Messages per second across running broadcasts",
+                lambda: round(sum(job.rate for job in broadcaster.active()), 2))
+metrics.collect('bot_db_connections', 'gauge', "Open SQLite connections (one per live thread)",
+                lambda: users_db.open_connections)
+metrics.collect('bot_flood_throttled_total', 'counter', "Updates dropped by flood control",
+                lambda: {'message': flood.stats()['throttled_messages'], 'callback_query': flood.stats()['throttled_callbacks']},
+                labels=('type',))
 
 # === ПОЛЬЗОВАТЕЛИ ===
-def load_users():
-    try:
-        conn = sqlite3.connect(DB_FILE)
-        cursor = conn.cursor()
-        cursor.execute("SELECT * FROM users")
-        rows = cursor.fetchall()
-        users = {}
-        for row in rows:
-            users[row[0]] = {
-                'username': row[1], 'first_name': row[2], 'last_name': row[3],
-                'full_name': row[4], 'first_seen': row[5], 'last_activity': row[6],
-                'messages_count': row[7]
-            }
-        conn.close()
-        return users
-    except Exception as e:
-        print(f"Ошибка загрузки: {e}")
-        return {}
-
-def save_users(users):
+def add_user(user_id, username, first_name, last_name):
     try:
-        conn = sqlite3.connect(DB_FILE)
-        cursor = conn.cursor()
-        for uid, data in users.items():
-            cursor.execute('''
-                INSERT OR REPLACE INTO users VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (
-                uid, data.get('username'), data.get('first_name'), data.get('last_name'),
-                data.get('full_name'), data.get('first_seen'), data.get('last_activity'),
-                data.get('messages_count')
-            ))
-        conn.commit()
-        conn.close()
-        return True
+        db.add_user(user_id, username, first_name, last_name)
     except Exception as e:
         print(f"Ошибка сохранения: {e}")
-        return False
 
-def add_user(user_id, username, first_name, last_name):
-    users = load_users()
-    now = datetime.datetime.now().isoformat()
-    uid = str(user_id)
-    if uid in users:
-        users[uid].update({
-            'username': username, 'first_name': first_name, 'last_name': last_name,
-            'full_name': f"{first_name} {last_name or ''}".strip(),
-            'last_activity': now,
-            'messages_count': users[uid].get('messages_count', 0) + 1
-        })
-    else:
-        users[uid] = {
-            'username': username, 'first_name': first_name, 'last_name': last_name,
-            'full_name': f"{first_name} {last_name or ''}".strip(),
-            'first_seen': now, 'last_activity': now, 'messages_count': 1
-        }
-    save_users(users)
+USERS_PAGE_SIZE = 10
 
-def get_all_users():
-    return load_users()
+def get_stats():
+    return db.get_user_stats()
+
+def get_users_page(page=0, after=None, before=None):
+    return db.get_users_page(page, after=after, before=before, limit=USERS_PAGE_SIZE)
+
+def count_reachable_users():
+    """Получатели рассылки — только те, кому сообщения доходят"""
+    return get_stats().get('reachable_users', 0)
 
 def update_user_activity(user_id):
-    users = load_users()
-    uid = str(user_id)
-    if uid in users:
-        users[uid]['last_activity'] = datetime.datetime.now().isoformat()
-        users[uid]['messages_count'] = users[uid].get('messages_count', 0) + 1
-        save_users(users)
-    else:
-        add_user(user_id, None, None, None)
+    try:
+        db.update_user_activity(user_id)
+    except Exception as e:
+        print(f"Ошибка сохранения: {e}")
 
 # === FSM ===
 class AdminForm(StatesGroup):
     waiting_for_broadcast_message = State()
 
 # === КАТАЛОГ ===
-bikes = {
-    "PRIMO": {
-        "description": "<b>PRIMO</b>\n\nМаневренная, универсальная модель для активного фанового катания в холмистой местности.\n\nБазовый уровень линейки — для зрелых любителей качества и современных тенденций велостроения.\n\nРозничная цена 50 000 руб.",
-        "photos": [
-            "https://optim.tildacdn.com/tild6336-3032-4434-b935-346363326131/-/format/webp/Photo-70.webp",
-            "https://optim.tildacdn.com/tild6536-6564-4661-b563-323737643733/-/format/webp/Photo-45.webp",
-            "https://optim.tildacdn.com/tild6263-6233-4537-a436-633033386132/-/format/webp/Photo-47.webp",
-            "https://optim.tildacdn.com/tild3731-3531-4463-b933-386135363632/-/format/webp/Photo-48.webp",
-            "https://optim.tildacdn.com/tild3038-3263-4935-a533-326637363030/-/format/webp/Photo-49.webp",
-            "https://optim.tildacdn.com/tild3831-3637-4836-b836-363934653638/-/format/webp/Photo-50.webp",
-            "https://optim.tildacdn.com/tild6665-3839-4632-a663-613133313564/-/format/webp/Photo-55.webp",
-            "https://optim.tildacdn.com/tild3734-6433-4835-b639-623036366165/-/format/webp/Photo-57.webp"
-        ],
-        "specs": {
-            "Вилка": "UDING DS HLO", "Передний переключатель": "SHIMANO ALTUS M315", "Задний переключатель": "SHIMANO ALTUS M310",
-            "Шифтеры": "SHIMANO ALTUS M315 2x8s", "Тормоза": "SHIMANO MT 200", "Кассета": "SHIMANO CS-HG-41-8 11-34T",
-            "Цепь": "TEC C8 16S", "Система": "PROWHEEL CY-10TM", "Картридж": "GINEYEA BB73 68mm", "Ротор": "SHIMANO RT-26S 160мм",
-            "Втулки": "SOLON 901F/R AL", "Обода": "HENGTONG HLQC-GA10", "Покрышки": "KENDA K1162",
-            "Руль": "ZOOM MTB AL 31,8 720/760мм", "Вынос": "ZOOM TDS-C301", "Грипсы": "VELO VLG-609",
-            "Рулевая колонка": "GINEYEA GH-830", "Седло": "VELO VL-3534", "Подседельный штырь": "ZOOM SP-C212",
-            "Педали": "FENGDE NW-430"
-        }
-    },
-    "TERZO": {
-        "description": "<b>TERZO</b>\n\nНа треть эффективнее аналогов в этой нише.\nОтличное решение для тех, кто перерос прогулочный байк и готов для большего.\n\nРозничная цена 65 000 руб.",
-        "photos": ["https://optim.tildacdn.com/tild3531-3036-4463-b536-303235326633/-/format/webp/Photo-71.webp"],
-        "specs": {
-            "Вилка": "UDING DS HLO", "Передний переключатель": "-", "Задний переключатель": "SHIMANO CUES 9S",
-            "Шифтеры": "SHIMANO CUES 9S", "Тормоза": "SHIMANO MT 200", "Кассета": "SHIMANO CUES 11-41T 9S",
-            "Цепь": "SHIMANO LG500", "Система": "PROWHEEL C10YNW-32T", "Картридж": "GINEYEA BB73 68mm",
-            "Ротор": "SHIMANO RT-26M 180мм", "Втулки": "SOLON 901F/R AL", "Обода": "HENGTONG HLGC-GA10",
-            "Покрышки": "KENDA K1162", "Руль": "ZOOM MTB AL 31,8 740/760мм", "Вынос": "ZOOM TDS-RD301",
-            "Грипсы": "VELO VLG-609", "Рулевая колонка": "GINEYEA GH-830", "Седло": "VELO VL-3534",
-            "Подседельный штырь": "ZOOM SP-C212", "Педали": "FENGDE NW-430"
-        }
-    },
-    "ULTIMO": {
-        "description": "<b>ULTIMO</b>\n\nТоповый в линейке middle-сегмента трейловых велосипедов для прогрессирующих райдеров.\nПредназначен для гонок и катания на пересечённой местности со средним или существенным перепадом высот.\n\nРозничная цена 75 000 руб.",
-        "photos": ["https://optim.tildacdn.com/tild3637-6439-4237-b638-303336613863/-/format/webp/Photo-69.webp"],
-        "specs": {
-            "Вилка": "UDING DS HLO", "Передний переключатель": "-", "Задний переключатель": "SHIMANO CUES 10S",
-            "Шифтеры": "SHIMANO CUES 10S", "Тормоза": "SHIMANO MT 200", "Кассета": "SHIMANO CUES CS-LG400 11-48T 10S",
-            "Цепь": "SHIMANO LG500", "Система": "PROWHEEL RMZ 32T", "Картридж": "PROWHEEL PW-MBB73 HOLOWTECH 2",
-            "Ротор": "SHIMANO RT-26M 180мм", "Втулки": "SOLON 901F/R AL", "Обода": "HENGTONG HLGC-GA10",
-            "Покрышки": "OBOR W3104", "Руль": "ZOOM MTB AL 31,8 740/760мм", "Вынос": "ZOOM TDS-C301",
-            "Грипсы": "VELO VLG-609", "Рулевая колонка": "GINEYEA GH-830", "Седло": "VELO VL-3534",
-            "Подседельный штырь": "ZOOM SP-C212", "Педали": "FENGDE NW-430"
-        }
-    },
-    "TESORO": {
-        "description": "<b>TESORO</b>\n\nСбалансированный аппарат для катания в горах и холмистой местности, для техничных трасс с прыжками и виражами.\n\nРозничная цена 85 000 руб.",
-        "photos": ["https://optim.tildacdn.com/tild3932-3166-4537-b837-386365666162/-/format/webp/Photo-72.webp"],
-        "specs": {
-            "Вилка": "ZOOM 868 AIR BOOST", "Передний переключатель": "-", "Задний переключатель": "SHIMANO CUES 115",
-            "Шифтеры": "SHIMANO CUES 115", "Тормоза": "SHIMANO MT 200", "Кассета": "SHIMANO CUES CS-LG400 11-50T 11S",
-            "Цепь": "SHIMANO LG500", "Система": "PROWHEEL RMZ 32T", "Картридж": "PROWHEEL PW-MB73 HOLOWITECH 2",
-            "Ротор": "SHIMANO RT-26M 180мм", "Втулки": "SOLON 9081F/TR AL", "Обода": "ПИСТОНИРОВАННЫЙ STAR 32H",
-            "Покрышки": "OBOR W3104", "Руль": "ZOOM MTB AL 31,8 740/760мм", "Вынос": "ZOOM TDS-RD307A",
-            "Грипсы": "VELO VLG-609", "Рулевая колонка": "GINEYEA GH-830", "Седло": "VELO VLG-609",
-            "Подседельный штырь": "ZOOM SP218", "Педали": "FENGDE NW-430"
-        }
-    },
-    "OTTIMO": {
-        "description": "<b>OTTIMO</b>\n\nНа этом байке реально проехать кросс-кантрийный марафон, уверенно проходить сложные участки и крутые спуски.\nПозволяет чувствовать себя на равных с мировыми брендами в соревнованиях.\n\nРозничная цена 95 000 руб.",
-        "photos": ["https://optim.tildacdn.com/tild3662-3335-4362-a665-303137396364/-/format/webp/Photo-73.webp"],
-        "specs": {
-            "Вилка": "ROCK SHOX FS RECON 29F", "Передний переключатель": "-", "Задний переключатель": "SHIMANO CUES 11S",
-            "Шифтеры": "SHIMANO CUES 11S", "Тормоза": "SHIMANO MT 200", "Кассета": "SHIMANO CUES CS-LG400 11-50T 11S",
-            "Цепь": "SHIMANO LG500", "Система": "SHIMANO CUES FC-U6000-1", "Картридж": "SHIMANO BB-M501 HOLOWTECH 2",
-            "Ротор": "SHIMANO RT-26M 180мм", "Втулки": "SOLON 908TF/TR AL", "Обода": "ПИСТОНИРОВАННЫЙ STAR 32H",
-            "Покрышки": "MAXXIS RECON M355", "Руль": "ZOOM MTB AL 31,8 740/760мм", "Вынос": "ZOOM TDS-D479",
-            "Грипсы": "VELO VLG-1266-11D2", "Рулевая колонка": "GINEYEA GH-202", "Седло": "VELO 1C58",
-            "Подседельный штырь": "ZOOM SP218"
-        }
-    }
-}
-
-frame_sizes = {"M (17\")": "163-177 см", "L (19\")": "173-187 см", "XL (21\")": "182-197 см"}
-user_photo_index = {}
-user_selections = {}
+# Данные — в catalog.json; клавиатуры и тексты собираются один раз и пересобираются при изменении файла
+bike_catalog = Catalog()
+# Сессии: карусель — (модель, индекс фото), заказ — (модель, размер рамы)
+user_photo_index = SessionStore("carousel", ttl=SESSION_TTL, max_entries=SESSION_MAX_ENTRIES, backend=session_backend)
+user_selections = SessionStore("order", ttl=SESSION_TTL, max_entries=SESSION_MAX_ENTRIES, backend=session_backend)
+
+def state_batch(user_id: int, chat_id: int):
+    """Все обращения к Redis за время обработки апдейта: одно чтение заранее и одна запись в конце"""
+    if redis_conn is None:
+        return nullcontext()
+    return redis_conn.batch([
+        bot.current_states.prefetch_key(chat_id, user_id),
+        session_backend.prefetch_key(user_photo_index.namespace, user_id),
+        session_backend.prefetch_key(user_selections.namespace, user_id),
+    ])
 
 # === АДМИНКА ===
 @bot.message_handler(commands=['admin'])
+@metrics.timed
 def admin_panel(msg):
     if msg.from_user.id != ADMIN_ID:
         bot.send_message(msg.chat.id, "Нет доступа")
         return
     kb = types.ReplyKeyboardMarkup(resize_keyboard=True)
-    kb.add("Статистика", "Рассылка", "Список пользователей", "Выйти из админки")
-    bot.send_message(msg.chat.id, f"<b>Админ-панель</b>\nПользователей: {len(get_all_users())}", parse_mode="HTML", reply_markup=kb)
+    kb.add("Статистика", "Метрики", "Рассылка", "Список пользователей", "Экспорт", "Выйти из админки")
+    bot.send_message(msg.chat.id, f"<b>Админ-панель</b>\nПользователей: {get_stats().get('total_users', 0)}", parse_mode="HTML", reply_markup=kb)
 
-@bot.message_handler(func=lambda m: m.text and m.text == "Статистика" and m.from_user.id == ADMIN_ID)
+@router.text("Статистика", admin=True)
 def show_stats(msg):
-    users = get_all_users()
-    today = datetime.datetime.now().date()
-    active_today = sum(1 for u in users.values() if u.get('last_activity') and datetime.datetime.fromisoformat(u['last_activity']).date() == today)
-    total_messages = sum(u.get('messages_count', 0) for u in users.values())
-    bot.send_message(msg.chat.id, f"<b>Статистика</b>\nВсего: {len(users)}\nСегодня: {active_today}\nСообщений: {total_messages}", parse_mode="HTML")
-
-@bot.message_handler(func=lambda m: m.text and m.text == "Список пользователей" and m.from_user.id == ADMIN_ID)
+    stats = get_stats()
+    photos = photo_cache.stats()
+    sending = outbox.stats()
+    throttling = flood.stats()
+    month_ago = (datetime.datetime.now() - datetime.timedelta(days=30)).isoformat()
+    sales = db.get_sales_by_model(since=month_ago)
+    orders_total = db.count_orders(since=month_ago)
+    without_model = orders_total - sum(n for _, n in sales)  # контакты без выбранной модели
+    bot.send_message(
+        msg.chat.id,
+        f"<b>Статистика</b>\nВсего: {stats.get('total_users', 0)}\nДоступны для рассылки: {stats.get('reachable_users', 0)}"
+        f"\nСегодня: {stats['active_today']}\nНовых сегодня: {stats['new_today']}"
+        f"\nСообщений: {stats.get('total_messages', 0)}\nСообщений сегодня: {stats['messages_today']}"
+        f"\n\nЗаявок за 30 дней: {orders_total}"
+        + "".join(f"\n• {model}: {n}" for model, n in sales)
+        + (f"\n• без модели: {without_model}" if without_model else "")
+        + f"\n\nФото в кэше: {photos['cached']}\nИз кэша: {photos['hits']}\nЗагрузок по URL: {photos['uploads']}"
+        + (f"\n\nСессий карусели: {len(user_photo_index)}\nНезавершённых заказов: {len(user_selections)}"
+           if session_backend is None else "\n\nСессии: в Redis")
+        + f"\n\nОтправлено ответов: {sending['sent']}\nВ очереди: {sending['queued']}\nПовторов после 429: {sending['retried']}"
+          f"\nНе доставлено: {sending['failed']}\nУведомлений склеено: {sending['coalesced']}"
+        + f"\n\nОтброшено антифлудом: {throttling['throttled_messages']} сообщений, {throttling['throttled_callbacks']} нажатий"
+          f"\nПредупреждений: {throttling['notices']}\nПерерисовок карусели пропущено: {carousel_renders.coalesced}"
+        + webhook_stats_text(),
+        parse_mode="HTML",
+    )
+
+def webhook_stats_text():
+    if webhook_server is None:
+        return ""
+    hook = webhook_server.stats()
+    return (f"\n\n<b>Вебхук</b>\nПринято: {hook['received']}\nОбработано: {hook['processed']}"
+            f"\nВ очереди: {hook['queued']} (макс. {hook['max_depth']})\nОтказов из-за перегрузки: {hook['overloaded']}"
+            f"\nНеверный секрет: {hook['rejected']}\nСреднее время обработки: {hook['avg_handle_ms']} мс")
+
+@router.text("Метрики", admin=True)
+def show_metrics(msg):
+    if not metrics.enabled:
+        bot.send_message(msg.chat.id, "Метрики выключены (METRICS_ENABLED=0)")
+        return
+    handlers = metrics.histogram('bot_handler_seconds')
+    queries = metrics.histogram('bot_db_query_seconds')
+    requests = metrics.histogram('bot_api_request_seconds')
+    requests.pop(('getUpdates',), None)  # long polling держит запрос открытым — его время ничего не говорит
+    api_errors = metrics.counter('bot_api_errors_total')
+    jobs = broadcaster.active()
+    bot.send_message(
+        msg.chat.id,
+        "<b>Метрики</b> (количество, среднее, p99)"
+        + "\n\n<b>Хэндлеры</b>" + latency_lines(handlers)
+        + "\n\n<b>SQLite</b>" + latency_lines(queries)
+        + "\n\n<b>Bot API</b>" + latency_lines(requests)
+        + "\n\n<b>Ошибки API</b>" + ("".join(f"\n• {method} {code}: {int(n)}" for (method, code), n in
+                                             sorted(api_errors.items(), key=lambda item: -item[1])) or "\nнет")
+        + f"\n\n<b>Очереди</b>\nОтветов в outbox: {outbox.stats()['queued']}"
+        + (f"\nАпдейтов в вебхуке: {webhook_server.stats()['queued']}" if webhook_server is not None else "")
+        + f"\nРассылок идёт: {len(jobs)}"
+        + (f", {sum(job.rate for job in jobs):.1f} сообщ./с" if jobs else "")
+        + (f"\n\n<b>Запуск</b>\nПервый апдейт через {startup_times['first_update']:.2f} с"
+           f" (ожидание лизы {startup_times.get('lease_wait', 0):.2f} с)" if 'first_update' in startup_times else ""),
+        parse_mode="HTML",
+    )
+
+def latency_lines(histogram, limit=8):
+    rows = sorted(histogram.items(), key=lambda item: -item[1][0])[:limit]
+    if not rows:
+        return "\nнет данных"
+    return "".join(f"\n• {labels[0]}: {count}, {avg * 1000:.1f} мс, {p99 * 1000:.1f} мс"
+                   for labels, (count, avg, p99) in rows)
+
+@router.text("Список пользователей", admin=True)
 def show_users_list(msg):
-    users = get_all_users()
-    if not users:
+    rows = get_users_page(0)
+    if not rows:
         bot.send_message(msg.chat.id, "Пользователей нет")
         return
-    sorted_users = sorted(users.items(), key=lambda x: x[1]['last_activity'], reverse=True)
-    text = "<b>Последние пользователи:</b>\n\n"
-    for i, (uid, data) in enumerate(sorted_users[:10], 1):
-        text += f"{i}. {data['full_name']}\n"
-        text += f"   @{data['username'] or 'нет'}\n"
+    text, kb = render_users_page(rows, 0)
+    bot.send_message(msg.chat.id, text, parse_mode="HTML", reply_markup=kb)
+
+def render_users_page(rows, page):
+    total = get_stats().get('total_users', 0)
+    pages = max(1, (total + USERS_PAGE_SIZE - 1) // USERS_PAGE_SIZE)
+    text = f"<b>Последние пользователи</b> (стр. {page + 1} из {pages}):\n\n"
+    for i, (uid, username, full_name, messages_count, _) in enumerate(rows, page * USERS_PAGE_SIZE + 1):
+        text += f"{i}. {full_name}\n"
+        text += f"   @{username or 'нет'}\n"
         text += f"   ID: {uid}\n"
-        text += f"   Сообщений: {data['messages_count']}\n\n"
-    bot.send_message(msg.chat.id, text, parse_mode="HTML")
+        text += f"   Сообщений: {messages_count}\n\n"
+    kb = types.InlineKeyboardMarkup()
+    nav = []
+    if page > 0:
+        first = rows[0]
+        nav.append(types.InlineKeyboardButton("Пред", callback_data=f"users_prev_{page - 1}_{first[4]}_{first[0]}"))
+    if page < pages - 1 and len(rows) == USERS_PAGE_SIZE:
+        last = rows[-1]
+        nav.append(types.InlineKeyboardButton("След", callback_data=f"users_next_{page + 1}_{last[4]}_{last[0]}"))
+    if nav:
+        kb.row(*nav)
+    if pages > 1:
+        # Быстрый переход: первая, соседние и последняя страницы
+        jump = sorted({0, max(0, page - 2), min(pages - 1, page + 2), pages - 1} - {page})
+        kb.row(*[types.InlineKeyboardButton(str(p + 1), callback_data=f"users_page_{p}") for p in jump])
+    return text, kb
+
+@router.callback_prefix("users_", admin=True)
+def page_users_list(call):
+    action, page, *key = call.data.replace("users_", "").split("_", 3)
+    page = int(page)
+    if key:
+        key = (key[0], int(key[1]))
+    if action == "next":
+        rows = get_users_page(after=key)
+    elif action == "prev":
+        rows = get_users_page(before=key)
+    else:
+        rows = get_users_page(page)
+    if not rows:
+        bot.answer_callback_query(call.id, "Пусто")
+        return
+    text, kb = render_users_page(rows, page)
+    try:
+        bot.edit_message_text(text, call.message.chat.id, call.message.message_id, parse_mode="HTML", reply_markup=kb)
+    except Exception as e:
+        print(f"Ошибка листания пользователей: {e}")
+    bot.answer_callback_query(call.id)
+
+@router.text("Экспорт", admin=True)
+def export_menu(msg):
+    kb = types.InlineKeyboardMarkup()
+    kb.row(types.InlineKeyboardButton("Пользователи", callback_data="export_users_all"),
+           types.InlineKeyboardButton("Активные за 30 дней", callback_data="export_users_30"))
+    kb.row(types.InlineKeyboardButton("Заказы", callback_data="export_orders_all"),
+           types.InlineKeyboardButton("Заказы за 30 дней", callback_data="export_orders_30"))
+    bot.send_message(
+        msg.chat.id,
+        "<b>Экспорт</b>\nВыберите, что выгрузить.\n\nЗа произвольный период: "
+        "<code>/export users 2024-01-01 2024-01-31</code> или <code>/export orders 2024-01-01</code>",
+        parse_mode="HTML",
+        reply_markup=kb,
+    )
+
+@router.callback_prefix("export_", admin=True)
+def export_callback(call):
+    table, period = call.data.replace("export_", "").split("_", 1)
+    since = None
+    if period == "30":
+        since = (datetime.date.today() - datetime.timedelta(days=30)).isoformat()
+    bot.answer_callback_query(call.id)
+    start_export(call.message.chat.id, table, since, None)
+
+@bot.message_handler(commands=['export'])
+@metrics.timed
+def export_command(msg):
+    if msg.from_user.id != ADMIN_ID:
+        bot.send_message(msg.chat.id, "Нет доступа")
+        return
+    args = msg.text.split()[1:]
+    try:
+        if not args or args[0] not in EXPORT_TITLES:
+            raise ValueError(args)
+        since, until = parse_period(args[1:])
+    except ValueError:
+        bot.send_message(msg.chat.id, "Формат: /export users|orders [ГГГГ-ММ-ДД] [ГГГГ-ММ-ДД]")
+        return
+    start_export(msg.chat.id, args[0], since, until)
+
+def start_export(chat_id, table, since, until):
+    bot.send_message(chat_id, "Готовим выгрузку, файл придёт отдельным сообщением...")
+    export_worker.submit(run_export, chat_id, table, since, until)
+
+def run_export(chat_id, table, since, until):
+    started = time.time()
+    try:
+        path, count = export_csv_gz(db, table, since, until)
+    except Exception as e:
+        print(f"Ошибка выгрузки {table}: {e}")
+        bot.send_message(chat_id, "Не удалось подготовить выгрузку")
+        return
+    try:
+        with open(path, "rb") as f:
+            bot.send_document(
+                chat_id, f,
+                visible_file_name=export_filename(table, since, until),
+                caption=f"{EXPORT_TITLES[table]}: {count} строк, {time.time() - started:.1f} с",
+            )
+    except Exception as e:
+        print(f"Ошибка отправки выгрузки {table}: {e}")
+        bot.send_message(chat_id, f"Не удалось отправить файл: {e}")
+    finally:
+        os.remove(path)
 
-@bot.message_handler(func=lambda m: m.text and m.text == "Рассылка" and m.from_user.id == ADMIN_ID)
+@router.text("Рассылка", admin=True)
 def start_broadcast(msg):
-    total = len(get_all_users())
+    total = count_reachable_users()
     if total == 0:
         bot.send_message(msg.chat.id, "Нет пользователей")
         return
     bot.send_message(msg.chat.id, f"<b>Рассылка</b>\nПолучателей: {total}\n\nНапишите сообщение:", parse_mode="HTML")
     bot.set_state(msg.from_user.id, AdminForm.waiting_for_broadcast_message, msg.chat.id)
 
-@bot.message_handler(state=AdminForm.waiting_for_broadcast_message, content_types=['text'])
 def process_broadcast_message(msg):
     kb = types.InlineKeyboardMarkup()
     kb.add(types.InlineKeyboardButton("Разослать", callback_data="confirm_broadcast"))
@@ -272,35 +474,33 @@ def process_broadcast_message(msg):
     with bot.retrieve_data(msg.from_user.id, msg.chat.id) as data:
         data['broadcast_message'] = msg.text
     preview = msg.text[:100] + "..." if len(msg.text) > 100 else msg.text
-    bot.send_message(msg.chat.id, f"<b>Подтверждение</b>\n\n{preview}\n\nПолучателей: {len(get_all_users())}", parse_mode="HTML", reply_markup=kb)
+    bot.send_message(msg.chat.id, f"<b>Подтверждение</b>\n\n{preview}\n\nПолучателей: {count_reachable_users()}", parse_mode="HTML", reply_markup=kb)
 
-@bot.callback_query_handler(func=lambda call: call.data == "confirm_broadcast")
+@router.callback("confirm_broadcast")
 def confirm_broadcast(call):
     with bot.retrieve_data(call.from_user.id, call.message.chat.id) as data:
         text = data.get('broadcast_message', '')
     if not text:
         bot.answer_callback_query(call.id, "Ошибка")
         return
-    users = get_all_users()
-    success = 0
-    bot.edit_message_text("Рассылка начата...", call.message.chat.id, call.message.message_id)
-    for i, uid in enumerate(users.keys()):
-        try:
-            bot.send_message(int(uid), text)
-            success += 1
-            if (i + 1) % 10 == 0:
-                time.sleep(1)
-        except:
-            pass
-    bot.edit_message_text(f"<b>Готово</b>\nУспешно: {success}\nВсего: {len(users)}", call.message.chat.id, call.message.message_id, parse_mode="HTML")
     bot.delete_state(call.from_user.id, call.message.chat.id)
+    bot.edit_message_text("Рассылка начата...", call.message.chat.id, call.message.message_id)
+    job = broadcaster.start(text, call.message.chat.id, call.message.message_id)
+    print(f"Рассылка #{job.id} запущена: {job.total} получателей")
+    bot.answer_callback_query(call.id)
+
+@router.callback_prefix("stop_broadcast_", admin=True)
+def stop_broadcast(call):
+    job_id = int(call.data.replace("stop_broadcast_", ""))
+    stopped = broadcaster.cancel(job_id)
+    bot.answer_callback_query(call.id, "Останавливаем..." if stopped else "Рассылка уже завершена")
 
-@bot.callback_query_handler(func=lambda call: call.data == "cancel_broadcast")
+@router.callback("cancel_broadcast")
 def cancel_broadcast(call):
     bot.delete_state(call.from_user.id, call.message.chat.id)
     bot.edit_message_text("Отменено", call.message.chat.id, call.message.message_id)
 
-@bot.message_handler(func=lambda m: m.text and m.text == "Выйти из админки" and m.from_user.id == ADMIN_ID)
+@router.text("Выйти из админки", admin=True)
 def exit_admin(msg):
     kb = types.ReplyKeyboardMarkup(resize_keyboard=True)
     kb.add("Каталог", "Позвать специалиста", "О нас")
@@ -308,142 +508,384 @@ def exit_admin(msg):
 
 # === ОСНОВНОЕ ===
 @bot.message_handler(commands=['start'])
+@metrics.timed
 def start(msg):
     add_user(msg.from_user.id, msg.from_user.username, msg.from_user.first_name, msg.from_user.last_name)
     kb = types.ReplyKeyboardMarkup(resize_keyboard=True)
     kb.add("Каталог", "Позвать специалиста", "О нас")
-    bot.send_message(msg.chat.id, "Привет! Выберите действие:", reply_markup=kb)
+    outbox.send_message(msg.chat.id, "Привет! Выберите действие:", reply_markup=kb)
 
-@bot.message_handler(func=lambda m: "специалиста" in m.text.lower())
+@router.text("Позвать специалиста")
 def call_specialist(msg):
     update_user_activity(msg.from_user.id)
-    bot.send_message(msg.chat.id, "Специалист свяжется с вами!")
-    bot.send_message(ADMIN_ID, f"Запрос от @{msg.from_user.username or 'нет'} ({msg.from_user.id})")
+    outbox.send_message(msg.chat.id, "Специалист свяжется с вами!")
+    outbox.notify(ADMIN_ID, f"Запрос от @{msg.from_user.username or 'нет'} ({msg.from_user.id})")
 
-@bot.message_handler(func=lambda m: "Каталог" in m.text)
+@router.text("Каталог")
 def catalog(msg):
     update_user_activity(msg.from_user.id)
-    kb = types.InlineKeyboardMarkup()
-    for bike in bikes:
-        kb.add(types.InlineKeyboardButton(bike, callback_data=bike))
-    bot.send_message(msg.chat.id, "Выберите модель:", reply_markup=kb)
+    snap = bike_catalog.current()
+    outbox.send_message(msg.chat.id, snap.catalog_text, reply_markup=snap.catalog_keyboard)
 
-@bot.callback_query_handler(func=lambda call: call.data in bikes)
 def show_bike(call):
     update_user_activity(call.from_user.id)
     name = call.data
-    user_photo_index[call.from_user.id] = {'bike': name, 'index': 0}
+    user_photo_index.set(call.from_user.id, (name, 0))
     show_photo(call.message, call.from_user.id, name, 0)
     bot.answer_callback_query(call.id)
 
 def show_photo(message, user_id, bike_name, idx):
-    bike = bikes[bike_name]
-    photos = bike["photos"]
-    kb = types.InlineKeyboardMarkup()
-    if len(photos) > 1:
-        row = []
-        if idx > 0:
-            row.append(types.InlineKeyboardButton("Пред", callback_data=f"prev_photo_{bike_name}"))
-        row.append(types.InlineKeyboardButton(f"{idx+1}/{len(photos)}", callback_data="ignore"))
-        if idx < len(photos) - 1:
-            row.append(types.InlineKeyboardButton("След", callback_data=f"next_photo_{bike_name}"))
-        kb.row(*row)
-    kb.add(types.InlineKeyboardButton("Спецификация", callback_data=f"specs_{bike_name}"))
-    kb.add(types.InlineKeyboardButton("Заказать", callback_data=f"order_{bike_name}"))
-    kb.add(types.InlineKeyboardButton("Назад", callback_data="back_to_catalog"))
-    caption = bike["description"] if idx == 0 else f"Фото {idx+1}"
-    bot.send_photo(message.chat.id, photos[idx], caption=caption, reply_markup=kb, parse_mode="HTML")
-
-@bot.callback_query_handler(func=lambda call: call.data.startswith(("prev_photo_", "next_photo_")))
+    snap = bike_catalog.current()
+    outbox.submit(message.chat.id, photo_cache.send_photo, bot, message.chat.id, snap.photos[bike_name][idx],
+                  caption=snap.captions[(bike_name, idx)], reply_markup=snap.photo_keyboards[(bike_name, idx)],
+                  parse_mode="HTML")
+
+@router.callback_prefix("prev_photo_", "next_photo_")
 def navigate_photo(call):
     update_user_activity(call.from_user.id)
     uid = call.from_user.id
-    if uid not in user_photo_index:
+    session = user_photo_index.get(uid)
+    if session is None:
+        bot.answer_callback_query(call.id, "Откройте модель заново из каталога")
+        return
+    snap = bike_catalog.current()
+    bike, idx = session
+    if bike not in snap:
+        bot.answer_callback_query(call.id, "Модель больше недоступна")
         return
-    data = user_photo_index[uid]
-    bike = data['bike']
-    idx = data['index']
     if call.data.startswith("prev"):
         idx = max(0, idx - 1)
     else:
-        idx = min(len(bikes[bike]["photos"]) - 1, idx + 1)
-    user_photo_index[uid]['index'] = idx
+        idx = min(len(snap.photos[bike]) - 1, idx + 1)
+    user_photo_index.set(uid, (bike, idx))
+    # Индекс обновлён сразу, а перерисовка схлопывается: за серию кликов — первая и последняя
+    carousel_renders.submit((call.message.chat.id, call.message.message_id),
+                            lambda: render_photo(call.message, uid, bike, idx))
+    bot.answer_callback_query(call.id)
+
+def render_photo(message, uid, bike, idx):
+    snap = bike_catalog.current()
+    if bike not in snap:
+        return
+    # Меняем фото, подпись и кнопки в том же сообщении — один запрос вместо delete + send
+    try:
+        photo_cache.edit_photo(bot, message.chat.id, message.message_id, snap.photos[bike][idx],
+                               caption=snap.captions[(bike, idx)], reply_markup=snap.photo_keyboards[(bike, idx)],
+                               parse_mode="HTML")
+        return
+    except ApiTelegramException as e:
+        if "message is not modified" in (e.description or ""):
+            return
+        print(f"Не удалось отредактировать фото, отправляем заново: {e}")
+    except Exception as e:
+        print(f"Не удалось отредактировать фото, отправляем заново: {e}")
     try:
-        bot.delete_message(call.message.chat.id, call.message.message_id)
+        bot.delete_message(message.chat.id, message.message_id)
     except:
         pass
-    show_photo(call.message, uid, bike, idx)
+    show_photo(message, uid, bike, idx)
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("specs_"))
+@router.callback_prefix("specs_")
 def show_specs(call):
     update_user_activity(call.from_user.id)
     name = call.data.replace("specs_", "")
-    specs = bikes[name]["specs"]
-    text = f"<b>Спецификация {name}</b>\n\n"
-    for k, v in specs.items():
-        text += f"• <b>{k}:</b> {v}\n"
-    kb = types.InlineKeyboardMarkup()
-    kb.add(types.InlineKeyboardButton("Назад", callback_data=name))
-    bot.send_message(call.message.chat.id, text, parse_mode="HTML", reply_markup=kb)
+    snap = bike_catalog.current()
+    if name not in snap:
+        bot.answer_callback_query(call.id, "Модель больше недоступна")
+        return
+    outbox.send_message(call.message.chat.id, snap.specs_text[name], parse_mode="HTML", reply_markup=snap.specs_keyboard[name])
+    bot.answer_callback_query(call.id)
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("order_"))
+@router.callback_prefix("order_")
 def select_size(call):
     update_user_activity(call.from_user.id)
     name = call.data.replace("order_", "")
-    user_selections[call.from_user.id] = {"bike": name}
-    kb = types.InlineKeyboardMarkup()
-    for size, h in frame_sizes.items():
-        kb.add(types.InlineKeyboardButton(f"{size} ({h})", callback_data=f"size_{size}"))
-    kb.add(types.InlineKeyboardButton("Назад", callback_data=name))
-    bot.send_message(call.message.chat.id, f"Выбрано: {name}\n\nВыберите размер:", reply_markup=kb)
+    snap = bike_catalog.current()
+    if name not in snap:
+        bot.answer_callback_query(call.id, "Модель больше недоступна")
+        return
+    user_selections.set(call.from_user.id, (name, None))
+    outbox.send_message(call.message.chat.id, snap.size_text[name], reply_markup=snap.size_keyboard[name])
+    bot.answer_callback_query(call.id)
 
-@bot.callback_query_handler(func=lambda call: call.data.startswith("size_"))
+@router.callback_prefix("size_")
 def save_size(call):
     update_user_activity(call.from_user.id)
     size = call.data.replace("size_", "")
     uid = call.from_user.id
-    user_selections[uid]["frame_size"] = size
-    user_selections[uid]["height_range"] = frame_sizes[size]
-    bot.send_message(call.message.chat.id, f"Отлично!\nМодель: {user_selections[uid]['bike']}\nРазмер: {size}\n\nНапишите имя и телефон:")
+    bike, _ = user_selections.get(uid, (None, None))
+    user_selections.set(uid, (bike, size))
+    outbox.send_message(call.message.chat.id, f"Отлично!\nМодель: {bike}\nРазмер: {size}\n\nНапишите имя и телефон:")
+    bot.answer_callback_query(call.id)
+
+# Кандидат в телефон — отдельная группа цифр с разделителями, не часть артикула («CS-LG400 11-50T»)
+PHONE_RE = re.compile(r"(?<![\w\-])\+?\d[\d\s()\-]{8,}\d(?![\w\-])")
+
+def find_phone(text):
+    """Телефон в тексте: 10 цифр или 11 с ведущими 7/8 (+7, 8) после удаления разделителей"""
+    for match in PHONE_RE.finditer(text):
+        digits = re.sub(r"\D", "", match.group(0))
+        if len(digits) == 10 or (len(digits) == 11 and digits[0] in "78"):
+            return match
+    return None
 
-@bot.message_handler(func=lambda m: any(c.isdigit() for c in m.text) and len(m.text) > 5)
 def save_order(msg):
     update_user_activity(msg.from_user.id)
     uid = msg.from_user.id
-    sel = user_selections.get(uid, {})
-    admin_msg = f"Новая заявка:\n\nПользователь: {msg.from_user.first_name}\nID: {uid}\nМодель: {sel.get('bike')}\nРазмер: {sel.get('frame_size')}\nКонтакты: {msg.text}"
-    bot.send_message(ADMIN_ID, admin_msg)
-    bot.send_message(msg.chat.id, "Спасибо! Мы свяжемся с вами.")
-    if uid in user_selections:
-        del user_selections[uid]
-
-@bot.message_handler(func=lambda m: True)
+    bike, frame_size = user_selections.pop(uid, (None, None))
+    # Запись в БД и уведомление админу — в фоне, пользователю отвечаем сразу
+    order_writer.submit(record_order, uid, msg.from_user.first_name, msg.text, bike, frame_size)
+    outbox.send_message(msg.chat.id, "Спасибо! Мы свяжемся с вами.")
+
+def record_order(uid, first_name, contacts, bike, frame_size):
+    phone = find_phone(contacts)
+    name = (contacts[:phone.start()] + contacts[phone.end():] if phone else contacts).strip(" ,;") or first_name
+    try:
+        order_id = db.add_order(uid, name, phone.group(0) if phone else contacts, None, bike, frame_size)
+        title = f"Новая заявка #{order_id}"
+    except Exception as e:
+        print(f"Ошибка сохранения заказа: {e}")
+        title = "Новая заявка (не сохранена в БД)"
+    outbox.notify(ADMIN_ID, f"{title}:\n\nПользователь: {first_name}\nID: {uid}\nМодель: {bike}\nРазмер: {frame_size}\nКонтакты: {contacts}")
+
 def track(msg):
     update_user_activity(msg.from_user.id)
 
+@router.callback("back_to_catalog")
+def back_to_catalog(call):
+    update_user_activity(call.from_user.id)
+    snap = bike_catalog.current()
+    outbox.send_message(call.message.chat.id, snap.catalog_text, reply_markup=snap.catalog_keyboard)
+    bot.answer_callback_query(call.id)
+
+@router.callback("ignore")
+def ignore_callback(call):
+    bot.answer_callback_query(call.id)
+
+# === ПОИСК ===
+# Индекс строится вместе со снимком каталога, поиск — пересечение готовых множеств
+TAG_RE = re.compile(r"<[^>]+>")
+
+def hit_text(hit):
+    text = f"<b>{html.escape(hit.name)}</b>"
+    if hit.price:
+        text += f" — {hit.price:,} руб.".replace(",", " ")
+    return text + "".join(f"\n• {line}" for line in hit.lines)
+
+def search_text(hits, ignored):
+    text = f"<b>Нашлось моделей: {len(hits)}</b>"
+    for hit in hits:
+        text += "\n\n" + hit_text(hit)
+    if ignored:
+        text += f"\n\nБез учёта: {html.escape(', '.join(ignored))}"
+    return text
+
+def search_catalog(msg, query, quiet=False):
+    """Ответить найденными моделями; quiet — для обычного текста в чате: отвечаем,
+    только если совпали все слова запроса, иначе молчим"""
+    hits, ignored = bike_catalog.current().search.search(query, limit=5)
+    if not hits or (quiet and ignored):
+        if not quiet:
+            outbox.send_message(msg.chat.id, "Ничего не нашлось. Попробуйте иначе: /search rock shox, /search до 70 000")
+        return False
+    kb = types.InlineKeyboardMarkup()
+    for hit in hits:
+        kb.add(types.InlineKeyboardButton(hit.name, callback_data=hit.name))
+    outbox.send_message(msg.chat.id, search_text(hits, ignored), parse_mode="HTML", reply_markup=kb)
+    return True
+
+@bot.message_handler(commands=['search'])
+@metrics.timed
+def search_command(msg):
+    update_user_activity(msg.from_user.id)
+    query = msg.text.partition(" ")[2].strip()
+    if not query:
+        outbox.send_message(msg.chat.id, "Что ищем? Например: /search shimano cues 11s или /search вилка до 80 000")
+        return
+    search_catalog(msg, query)
+
+@bot.inline_handler(func=lambda query: True)
+@metrics.timed
+def inline_search(query):
+    text = query.query.strip()
+    hits = bike_catalog.current().search.search(text, limit=20)[0] if text else []
+    results = []
+    for i, hit in enumerate(hits):
+        price = f"{hit.price:,} руб.".replace(",", " ") if hit.price else ""
+        results.append(types.InlineQueryResultArticle(
+            id=str(i),
+            title=f"{hit.name} {price}".strip(),
+            description=html.unescape(TAG_RE.sub("", "; ".join(hit.lines)))[:200],
+            input_message_content=types.InputTextMessageContent(hit_text(hit), parse_mode="HTML"),
+        ))
+    bot.answer_inline_query(query.id, results, cache_time=300)
+
+# === РОУТИНГ ===
+@router.text_fallback
+def route_free_text(msg):
+    """Всё, что не совпало с кнопкой: состояние рассылки, затем прежние проверки по порядку"""
+    if msg.from_user.id == ADMIN_ID and bot.get_state(msg.from_user.id, msg.chat.id) == AdminForm.waiting_for_broadcast_message.name:
+        return process_broadcast_message(msg)
+    text = msg.text
+    if "специалиста" in text.lower():
+        return call_specialist(msg)
+    if "Каталог" in text:
+        return catalog(msg)
+    # Контакты для заказа — если модель уже выбрана или в тексте настоящий телефон;
+    # иначе цифры скорее из названия детали («SHIMANO CUES 11S») — это поиск
+    bike, _ = user_selections.get(msg.from_user.id, (None, None))
+    if len(text) > 5 and any(c.isdigit() for c in text) and (bike is not None or find_phone(text)):
+        return save_order(msg)
+    if search_catalog(msg, text, quiet=True):
+        return update_user_activity(msg.from_user.id)
+    return track(msg)
+
+@router.callback_fallback
+def route_other_callback(call):
+    if call.data in bike_catalog.current():
+        return show_bike(call)
+
+@bot.message_handler(content_types=['text'])
+def dispatch_text(msg):
+    with state_batch(msg.from_user.id, msg.chat.id):
+        router.dispatch_message(msg)
+
+@bot.callback_query_handler(func=lambda call: True)
+def dispatch_callback(call):
+    with state_batch(call.from_user.id, call.message.chat.id):
+        router.dispatch_callback(call)
+
 # === ЗАПУСК — ФИНАЛЬНАЯ ВЕРСИЯ ДЛЯ RAILWAY ===
+def shutdown(signum, frame):
+    print("Получен сигнал остановки — сохраняем прогресс рассылок")
+    bot.stop_polling()
+    if webhook_server is not None:
+        webhook_server.stop()
+    broadcaster.shutdown()
+    order_writer.shutdown(wait=True)
+    export_worker.shutdown(wait=False, cancel_futures=True)
+    outbox.stop()
+    users_db.close_all()
+    # Последним шагом: следующий экземпляр начнёт принимать апдейты сразу после этого
+    if lease is not None:
+        lease.release()
+    raise SystemExit(0)
+
 if __name__ == "__main__":
-    import random
-    import time
-
-    delay = random.uniform(10, 30)
-    print(f"Ждём {delay:.1f} секунд, чтобы старый контейнер точно умер...")
-    time.sleep(delay)
-
-    print("Запускаем polling в бесконечном цикле с перезапусками")
-    while True:
-        try:
-            bot.infinity_polling(
-                none_stop=True,
-                interval=0,
-                timeout=20,
-                long_polling_timeout=20
-            )
-        except Exception as e:
-            if "409" in str(e) or "Conflict" in str(e):
-                print("409 Conflict — ждём и пробуем снова...")
-                time.sleep(15)
-            else:
-                print(f"Polling упал: {e}")
-                time.sleep(10)
+    import signal
+    import threading
+
+    signal.signal(signal.SIGTERM, shutdown)
+    startup_times['init'] = time.monotonic() - STARTED_AT
+
+    # Вместо случайной паузы — лиза: старый экземпляр отпускает её при остановке,
+    # а если он упал, она истекает через LEASE_TTL. Держат её polling (Telegram отдаёт
+    # getUpdates только одному) и фоновые задачи вроде продолжения рассылок; вебхук
+    # обслуживают все реплики сразу
+    if LEASE_BACKEND == "redis":
+        import redis
+        from redis_storage import RedisConnection
+
+        if redis_conn is None:
+            redis_conn = RedisConnection(redis.ConnectionPool(host=redis_host, port=redis_port, db=redis_db,
+                                                              username=redis_username, password=redis_password,
+                                                              max_connections=2, socket_timeout=5))
+        lease = RedisLease(redis_conn.redis, key=redis_conn.key("lease"), ttl=LEASE_TTL)
+    elif LEASE_BACKEND == "file":
+        lease = FileLease(LEASE_FILE, ttl=LEASE_TTL)
+    elif LEASE_BACKEND != "none":
+        print(f"ОШИБКА: неизвестный LEASE_BACKEND={LEASE_BACKEND} (redis, file или none)")
+        exit(1)
+
+    def acquire_lease():
+        print(f"Ждём лизу ({LEASE_BACKEND}, TTL {LEASE_TTL:.0f} с)...")
+        startup_times['lease_wait'] = lease.acquire()
+        print(f"Лиза получена за {startup_times['lease_wait']:.2f} с, инициализация заняла {startup_times['init']:.2f} с")
+
+    def resume_broadcasts():
+        resumed = broadcaster.resume_unfinished()
+        if resumed:
+            print(f"Продолжаем незавершённые рассылки: {', '.join(f'#{job.id}' for job in resumed)}")
+
+    def optimize_db():
+        started = time.monotonic()
+        db.optimize()
+        print(f"Статистика БД обновлена за {time.monotonic() - started:.2f} с")
+
+    def warm_up_photos():
+        if PHOTO_WARMUP_CHAT_ID:
+            uploaded = photo_cache.warm_up(bot, int(PHOTO_WARMUP_CHAT_ID), bike_catalog.current().photo_urls)
+            print(f"Прогрев фото: загружено {uploaded}, в кэше {photo_cache.stats()['cached']}")
+
+    def deferred_startup():
+        # Тяжёлое — когда бот уже принимает апдейты.
+        # Только под лизой: иначе оба экземпляра продолжили бы одни и те же рассылки.
+        # Упавший шаг повторяется с паузой, выполненные не повторяются
+        steps = [resume_broadcasts, optimize_db, warm_up_photos]
+        if lease is not None and not lease.held:
+            steps.insert(0, acquire_lease)
+        for step in steps:
+            delay = 5
+            while True:
+                try:
+                    step()
+                    break
+                except Exception as e:
+                    print(f"Фоновый старт: {step.__name__} не выполнен: {e}; повтор через {delay} с")
+                    time.sleep(delay)
+                    delay = min(delay * 2, 300)
+
+    if METRICS_ENABLED and METRICS_PORT:
+        # И в режиме вебхука метрики на своём порту: порт вебхука смотрит в интернет
+        MetricsServer(metrics, host=METRICS_HOST, port=int(METRICS_PORT), token=METRICS_TOKEN).start()
+    if BOT_MODE == "webhook":
+        from webhook import WebhookServer
+
+        webhook_server = WebhookServer(
+            bot,
+            WEBHOOK_SECRET,
+            port=WEBHOOK_PORT,
+            path=WEBHOOK_PATH,
+            workers=WEBHOOK_WORKERS,
+            queue_size=WEBHOOK_QUEUE_SIZE,
+        )
+        webhook_server.start()
+        bot.set_webhook(
+            url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+            max_connections=100,
+            allowed_updates=["message", "callback_query", "inline_query"],
+        )
+        print(f"Вебхук установлен, слушаем порт {WEBHOOK_PORT}, воркеров: {WEBHOOK_WORKERS}")
+        if lease is not None:
+            # Апдейты принимаем без лизы; потеряли её — фоновые задачи перейдут к другой реплике
+            lease.on_lost = lambda: print("Лиза перехвачена другой репликой")
+        # Лизу ждём в фоне: реплики без неё просто обслуживают вебхук
+        threading.Thread(target=deferred_startup, name="deferred-startup", daemon=True).start()
+        threading.Event().wait()
+    else:
+        if lease is not None:
+            # Лизу перехватили (например, нас надолго заморозили) — останавливаемся, как по SIGTERM
+            lease.on_lost = lambda: os.kill(os.getpid(), signal.SIGTERM)
+            acquire_lease()
+        bot.remove_webhook()
+        print("Запускаем polling в бесконечном цикле с перезапусками")
+        threading.Thread(target=deferred_startup, name="deferred-startup", daemon=True).start()
+        while True:
+            try:
+                bot.infinity_polling(
+                    none_stop=True,
+                    interval=0,
+                    timeout=20,
+                    long_polling_timeout=20
+                )
+            except Exception as e:
+                if "409" in str(e) or "Conflict" in str(e):
+                    # Под лизой это лишь недовершённый long poll старого экземпляра;
+                    # без неё — возможно, работающий второй экземпляр
+                    print("409 Conflict — ждём и пробуем снова...")
+                    time.sleep(1 if lease is not None else 15)
+                else:
+                    print(f"Polling упал: {e}")
+                    time.sleep(10)
 
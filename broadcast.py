@@ -0,0 +1,339 @@
+import logging
+import queue
+import threading
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from telebot import types
+
+from database import BroadcastStore
+from telebot.apihelper import ApiTelegramException
+
+from ratelimit import TokenBucket, retry_after
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+# Ошибки, после которых писать пользователю бессмысленно
+_BLOCKED_MARKERS = ("bot was blocked", "user is deactivated", "bot can't initiate", "bot was kicked")
+_NOT_FOUND_MARKERS = ("chat not found", "user not found", "peer_id_invalid")
+
+
+def classify_failure(exc: BaseException) -> str:
+    """blocked / not_found — получатель недоступен навсегда, failed — временная ошибка"""
+    if not isinstance(exc, ApiTelegramException):
+        return 'failed'
+    description = (exc.description or '').lower()
+    if exc.error_code == 403 or any(m in description for m in _BLOCKED_MARKERS):
+        return 'blocked'
+    if exc.error_code == 400 and any(m in description for m in _NOT_FOUND_MARKERS):
+        return 'not_found'
+    return 'failed'
+
+
+class BroadcastJob:
+    """Состояние одной рассылки в памяти; в БД сбрасывается пачками через checkpoint"""
+
+    def __init__(self, job_id: int, text: str, chat_id: int, message_id: int, total: int,
+                 sent: int = 0, failed: int = 0, cursor: int = 0):
+        self.id = job_id
+        self.text = text
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.total = total
+        self.sent = sent
+        self.failed = failed
+        self.cursor = cursor
+        self.resumed_from = sent + failed
+        self.started_at = time.monotonic()
+        self.finished_at: Optional[float] = None
+        self.cancelled = threading.Event()
+        self.interrupted = False
+        self.done = threading.Event()
+        self._lock = threading.Lock()
+        # take_results + запись в БД — под одним замком: иначе старая пачка может
+        # записаться после новой и откатить sent/failed/cursor
+        self.checkpoint_lock = threading.Lock()
+        self._unacked = set()
+        self._last_dispatched = cursor
+        self._results: List[Tuple[int, str]] = []
+
+    @classmethod
+    def from_row(cls, row: Dict) -> "BroadcastJob":
+        return cls(row['id'], row['text'], row['chat_id'], row['message_id'], row['total'],
+                   row['sent'], row['failed'], row['cursor'])
+
+    def dispatched(self, uid: int):
+        with self._lock:
+            self._unacked.add(uid)
+            self._last_dispatched = uid
+
+    def record(self, uid: int, status: str):
+        with self._lock:
+            if status == 'sent':
+                self.sent += 1
+            else:
+                self.failed += 1
+            self._results.append((uid, status))
+
+    def take_results(self) -> Tuple[List[Tuple[int, str]], int, int, int]:
+        """Забрать накопленные результаты; курсор — последний user_id, до которого всё подтверждено"""
+        with self._lock:
+            results, self._results = self._results, []
+            self._unacked.difference_update(uid for uid, _ in results)
+            cursor = min(self._unacked) - 1 if self._unacked else self._last_dispatched
+            return results, self.sent, self.failed, cursor
+
+    def restore_results(self, results: List[Tuple[int, str]]):
+        """Вернуть пачку, которую не удалось записать: получатели снова не подтверждены"""
+        with self._lock:
+            self._results[:0] = results
+            self._unacked.update(uid for uid, _ in results)
+
+    @property
+    def pending_results(self) -> int:
+        return len(self._results)
+
+    @property
+    def processed(self) -> int:
+        return self.sent + self.failed
+
+    @property
+    def rate(self) -> float:
+        elapsed = (self.finished_at or time.monotonic()) - self.started_at
+        return (self.processed - self.resumed_from) / elapsed if elapsed > 0 else 0.0
+
+    @property
+    def eta(self) -> Optional[float]:
+        rate = self.rate
+        if rate <= 0:
+            return None
+        return max(0, self.total - self.processed) / rate
+
+
+def _format_eta(seconds: Optional[float]) -> str:
+    if seconds is None:
+        return "—"
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return f"{seconds // 3600} ч {seconds % 3600 // 60} мин"
+    if seconds >= 60:
+        return f"{seconds // 60} мин {seconds % 60} с"
+    return f"{seconds} с"
+
+
+class Broadcaster:
+    """Фоновые рассылки: пул воркеров, общий token bucket, учёт retry_after и отмена.
+
+    Задания и статус доставки каждому получателю хранятся в БД, поэтому после
+    перезапуска рассылка продолжается с последнего подтверждённого получателя.
+    """
+
+    def __init__(self, bot, store: BroadcastStore, bucket: Optional[TokenBucket] = None, workers: int = 8,
+                 progress_interval: float = 3.0, checkpoint_size: int = 200, max_retries: int = 3):
+        self.bot = bot
+        self.store = store
+        self.bucket = bucket or TokenBucket(25)
+        self.workers = workers
+        self.progress_interval = progress_interval
+        self.checkpoint_size = checkpoint_size
+        self.max_retries = max_retries
+        self.jobs: Dict[int, BroadcastJob] = {}
+        self._lock = threading.Lock()
+
+    def start(self, text: str, chat_id: int, message_id: int) -> BroadcastJob:
+        """Создать задание и запустить его в фоне; прогресс пишется в сообщение (chat_id, message_id)"""
+        job = BroadcastJob.from_row(self.store.create_job(text, chat_id, message_id))
+        self._launch(job)
+        return job
+
+    def resume_unfinished(self) -> List[BroadcastJob]:
+        """Продолжить рассылки, прерванные перезапуском; уже идущие в этом процессе не трогаем"""
+        jobs = []
+        for row in self.store.unfinished_jobs():
+            running = self.jobs.get(row['id'])
+            if running is not None and not running.done.is_set():
+                continue
+            job = BroadcastJob.from_row(row)
+            logger.info("Рассылка #%s: продолжаем с user_id > %s (%s из %s)",
+                        job.id, job.cursor, job.processed, job.total)
+            self._launch(job)
+            jobs.append(job)
+        return jobs
+
+    def cancel(self, job_id: int) -> bool:
+        job = self.jobs.get(job_id)
+        if job is None or job.done.is_set():
+            return False
+        job.cancelled.set()
+        return True
+
+    def shutdown(self, timeout: float = 10.0):
+        """Остановить рассылки при выключении бота, сохранив прогресс; задания останутся незавершёнными"""
+        jobs = self.active()
+        for job in jobs:
+            job.interrupted = True
+            job.cancelled.set()
+        for job in jobs:
+            job.done.wait(timeout)
+
+    def active(self):
+        return [job for job in self.jobs.values() if not job.done.is_set()]
+
+    # === ВНУТРЕННЕЕ ===
+    def _launch(self, job: BroadcastJob):
+        with self._lock:
+            self.jobs[job.id] = job
+        recipients = self.store.iter_pending(job.id, after=job.cursor)
+        threading.Thread(target=self._run, args=(job, recipients), name=f"broadcast-{job.id}", daemon=True).start()
+
+    def _run(self, job: BroadcastJob, recipients: Iterable[int]):
+        tasks = queue.Queue(maxsize=self.workers * 4)
+        workers = [
+            threading.Thread(target=self._worker, args=(job, tasks), name=f"broadcast-{job.id}-w{i}", daemon=True)
+            for i in range(self.workers)
+        ]
+        for w in workers:
+            w.start()
+        finished = threading.Event()
+        reporter = threading.Thread(target=self._report_loop, args=(job, finished), name=f"broadcast-{job.id}-progress",
+                                    daemon=True)
+        reporter.start()
+        try:
+            for uid in recipients:
+                if job.cancelled.is_set():
+                    break
+                job.dispatched(uid)
+                while not job.cancelled.is_set():
+                    try:
+                        tasks.put(uid, timeout=0.5)
+                        break
+                    except queue.Full:
+                        continue
+        except Exception as e:
+            logger.exception("Рассылка #%s: ошибка чтения получателей: %s", job.id, e)
+            job.interrupted = True
+            job.cancelled.set()
+        finally:
+            for _ in workers:
+                tasks.put(_STOP)
+            for w in workers:
+                w.join()
+            job.finished_at = time.monotonic()
+            for attempt in range(self.max_retries + 1):
+                if self._checkpoint(job):
+                    break
+                time.sleep(attempt + 1)
+            else:
+                # Итог не записан — не закрываем задание, после перезапуска оно продолжится
+                job.interrupted = True
+            try:
+                if not job.interrupted:
+                    self.store.finish_job(job.id, 'cancelled' if job.cancelled.is_set() else 'done')
+            finally:
+                finished.set()
+                reporter.join()
+                self._report(job, final=True)
+                # Последним: после done рассылка больше не трогает БД — shutdown может закрывать соединения
+                job.done.set()
+
+    def _worker(self, job: BroadcastJob, tasks: queue.Queue):
+        while True:
+            uid = tasks.get()
+            if uid is _STOP:
+                return
+            if job.cancelled.is_set():
+                continue
+            status = self._deliver(job, uid)
+            if status is not None:
+                job.record(uid, status)
+
+    def _deliver(self, job: BroadcastJob, uid: int) -> Optional[str]:
+        """Статус доставки (sent / blocked / not_found / failed) или None, если рассылку остановили"""
+        for _ in range(self.max_retries + 1):
+            if not self.bucket.acquire(cancel=job.cancelled):
+                return None
+            try:
+                self.bot.send_message(uid, job.text)
+                return 'sent'
+            except Exception as e:
+                wait = retry_after(e)
+                if wait is None:
+                    status = classify_failure(e)
+                    logger.info("Рассылка #%s: не доставлено %s (%s): %s", job.id, uid, status, e)
+                    return status
+                # 429 — притормаживаем всех воркеров разом и повторяем
+                self.bucket.pause(wait)
+        return 'failed'
+
+    def _checkpoint(self, job: BroadcastJob) -> bool:
+        """Записать накопленные результаты; False — запись не удалась, результаты остались в задании"""
+        with job.checkpoint_lock:
+            results, sent, failed, cursor = job.take_results()
+            if not results and cursor == job.cursor:
+                return True
+            try:
+                self.store.checkpoint(job.id, results, sent, failed, cursor)
+                job.cursor = cursor
+                return True
+            except Exception as e:
+                # Курсор не двигаем, результаты уйдут со следующей пачкой
+                job.restore_results(results)
+                logger.exception("Рассылка #%s: не удалось сохранить прогресс: %s", job.id, e)
+                return False
+
+    def _report_loop(self, job: BroadcastJob, finished: threading.Event):
+        last = None
+        last_report = time.monotonic()
+        while not finished.wait(0.5):
+            if job.pending_results >= self.checkpoint_size:
+                self._checkpoint(job)
+            if time.monotonic() - last_report < self.progress_interval:
+                continue
+            last_report = time.monotonic()
+            self._checkpoint(job)
+            if job.processed != last:
+                last = job.processed
+                self._report(job)
+
+    def progress_text(self, job: BroadcastJob, final: bool = False) -> str:
+        if final and job.interrupted:
+            title = "Рассылка приостановлена, продолжится после перезапуска"
+        elif final:
+            title = "Рассылка остановлена" if job.cancelled.is_set() else "Готово"
+        else:
+            title = "Рассылка идёт..."
+        text = (
+            f"<b>{title}</b>\n"
+            f"Успешно: {job.sent}\n"
+            f"Ошибок: {job.failed}\n"
+            f"Обработано: {job.processed} из {job.total}\n"
+            f"Скорость: {job.rate:.1f} сообщ./с"
+        )
+        if not final:
+            text += f"\nОсталось: ~{_format_eta(job.eta)}"
+        else:
+            summary = self.store.delivery_summary(job.id)
+            if summary.get('blocked') or summary.get('not_found'):
+                text += (f"\n\nЗаблокировали бота: {summary.get('blocked', 0)}"
+                         f"\nЧат не найден: {summary.get('not_found', 0)}"
+                         f"\nОни исключены из следующих рассылок")
+        return text
+
+    def _report(self, job: BroadcastJob, final: bool = False):
+        kb = None
+        if not final:
+            kb = types.InlineKeyboardMarkup()
+            kb.add(types.InlineKeyboardButton("Остановить", callback_data=f"stop_broadcast_{job.id}"))
+        for _ in range(2):
+            try:
+                self.bot.edit_message_text(self.progress_text(job, final), job.chat_id, job.message_id,
+                                           parse_mode="HTML", reply_markup=kb)
+                return
+            except Exception as e:
+                wait = retry_after(e)
+                if wait is None:
+                    logger.debug("Рассылка #%s: не удалось обновить прогресс: %s", job.id, e)
+                    return
+                time.sleep(wait)
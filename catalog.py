@@ -0,0 +1,404 @@
+import bisect
+import functools
+import html
+import json
+import logging
+import os
+import re
+import threading
+import time
+from types import MappingProxyType
+from typing import Dict, List, Mapping, NamedTuple, Optional, Tuple
+
+from telebot import types
+
+logger = logging.getLogger(__name__)
+
+CATALOG_FILE = os.getenv("CATALOG_FILE", os.path.join(os.path.dirname(os.path.abspath(__file__)), "catalog.json"))
+
+
+def _keyboard(rows) -> str:
+    """Собрать inline-клавиатуру и сразу сериализовать её в JSON для Bot API"""
+    kb = types.InlineKeyboardMarkup()
+    for row in rows:
+        kb.row(*[types.InlineKeyboardButton(text, callback_data=data) for text, data in row])
+    return kb.to_json()
+
+
+# === ПОИСК ===
+_WORD_RE = re.compile(r"[0-9a-zа-яё]+", re.IGNORECASE)
+_TAG_RE = re.compile(r"<[^>]+>")
+_PRICE_TEXT_RE = re.compile(r"(\d[\d\s]*\d|\d)\s*(?:руб|₽)", re.IGNORECASE)
+_PRICE_FILTER_RE = re.compile(r"\b(до|дешевле|от|дороже)\s*(\d+(?:[\s.,]\d{3})*)\s*(к|k|тыс\w*)?", re.IGNORECASE)
+# Окончания для грубого стемминга: «вилкой» и «вилка» дают один токен
+_ENDINGS = tuple(sorted((
+    "ами", "ями", "ого", "его", "ому", "ему", "ыми", "ими", "ой", "ей", "ый", "ий", "ая", "яя", "ое", "ее",
+    "ые", "ие", "ом", "ем", "ам", "ям", "ах", "ях", "ов", "ев", "а", "я", "ы", "и", "у", "ю", "е", "о",
+), key=len, reverse=True))
+_STOP_WORDS = frozenset((
+    "как", "какой", "какая", "какие", "котор", "есть", "ли", "для", "или", "на", "со", "стоит", "руб", "цен",
+    "велосипед", "модел", "which", "what", "has", "have", "with", "the", "and", "bike", "bikes", "run", "runs",
+))
+
+
+@functools.lru_cache(maxsize=1 << 16)
+def normalize(word: str) -> str:
+    """Токен для индекса: нижний регистр, ё -> е, у русских слов отрезано окончание"""
+    word = word.lower().replace("ё", "е")
+    if word[-1] >= "а":
+        for ending in _ENDINGS:
+            if len(word) - len(ending) >= 3 and word.endswith(ending):
+                return word[:-len(ending)]
+    return word
+
+
+def tokenize(text: str) -> List[str]:
+    return [normalize(word) for word in _WORD_RE.findall(text)]
+
+
+def parse_price(text: str) -> Optional[int]:
+    """«Розничная цена 50 000 руб.» -> 50000"""
+    match = _PRICE_TEXT_RE.search(text)
+    return int(re.sub(r"\s", "", match.group(1))) if match else None
+
+
+_LINE_BITS = 6
+_MAX_LINES = 1 << _LINE_BITS  # строк на модель в индексе; дальше описание не индексируется
+
+
+class _Term(NamedTuple):
+    """Постинги токена: отсортированные номера моделей и строк плюс те же множества для проверок"""
+    docs: Tuple[int, ...]
+    doc_set: frozenset
+    lines: Tuple[int, ...]
+    line_set: frozenset
+
+
+def _term(docs, lines) -> _Term:
+    docs, lines = tuple(docs), tuple(lines)
+    return _Term(docs, frozenset(docs), lines, frozenset(lines))
+
+
+def _walk(sorted_ids: Tuple[int, ...], sets: List[frozenset]):
+    """Номера из sorted_ids, которые есть во всех sets, по возрастанию.
+
+    Идём кусками растущего размера: пересечение куска считается в C, а поиск
+    останавливается, как только вызывающему хватило результатов, — не трогая
+    остаток длинных постингов.
+    """
+    start, size = 0, 64
+    while start < len(sorted_ids):
+        chunk = sorted_ids[start:start + size]
+        if sets:
+            for found in sets:
+                chunk = found.intersection(chunk)
+            chunk = sorted(chunk)
+        yield from chunk
+        start += size
+        size = min(size * 2, 4096)
+
+
+class SearchHit(NamedTuple):
+    name: str
+    price: Optional[int]
+    lines: Tuple[str, ...]  # совпавшие строки спецификации, HTML с подсветкой
+
+
+class SearchIndex:
+    """Обратный индекс по характеристикам, описаниям и ценам.
+
+    Каждая модель разбита на строки: название, строки спецификации «ключ: значение»
+    и фразы описания. Для токена хранятся отсортированные номера моделей и строк
+    (номер модели << 6 | номер строки). Поиск идёт по постингам самого редкого
+    слова в порядке каталога и проверяет остальные слова по множествам:
+    сначала модели, где все слова встретились в одной строке, затем прочие.
+    Как только набралось limit моделей, поиск останавливается.
+    Незнакомый токен ищется как префикс по отсортированному словарю (объединения
+    постингов кэшируются); если и так не нашёлся — отбрасывается, а в ответе
+    об этом говорится. Фильтр цены («до 70 000», «от 80к») применяется к цене,
+    разобранной из описания.
+    """
+
+    PREFIX_CACHE_SIZE = 4096
+
+    def __init__(self, bikes: Mapping[str, dict]):
+        self.names: Tuple[str, ...] = tuple(bikes)
+        self.prices: Tuple[Optional[int], ...] = tuple(
+            bike.get("price") or parse_price(_TAG_RE.sub(" ", bike.get("description", ""))) for bike in bikes.values()
+        )
+        self._lines: List[Tuple[Tuple[Optional[str], str], ...]] = []
+        # Модели и строки обходятся по возрастанию номеров — списки постингов сразу отсортированы
+        docs: Dict[str, List[int]] = {}
+        lines: Dict[str, List[int]] = {}
+        vocabulary = set()  # без склеенных пар: префиксом ищутся только настоящие слова
+        line_tokens: Dict[Tuple[Optional[str], str], Tuple[str, ...]] = {}  # одинаковые строки у разных моделей — разбираем раз
+        for doc, (name, bike) in enumerate(bikes.items()):
+            entries = [(None, name)]
+            entries += [(key, str(value)) for key, value in bike.get("specs", {}).items()]
+            description = _TAG_RE.sub(" ", bike.get("description", ""))
+            entries += [(None, part.strip()) for part in re.split(r"\n+|(?<=[.!?])\s+", description)
+                        if part.strip() and part.strip() != name]
+            entries = entries[:_MAX_LINES]
+            self._lines.append(tuple(entries))
+            for number, entry in enumerate(entries):
+                tokens = line_tokens.get(entry)
+                if tokens is None:
+                    key, value = entry
+                    words = tokenize(value)
+                    # «ROCK SHOX» должен находиться и по «rockshox»
+                    pairs = [a + b for a, b in zip(words, words[1:])]
+                    words += tokenize(key) if key else []
+                    vocabulary.update(words)
+                    tokens = line_tokens[entry] = tuple(dict.fromkeys(words + pairs))
+                line = doc << _LINE_BITS | number
+                for token in tokens:
+                    found = lines.get(token)
+                    if found is None:
+                        docs[token] = [doc]
+                        lines[token] = [line]
+                    elif found[-1] != line:
+                        found.append(line)
+                        if docs[token][-1] != doc:
+                            docs[token].append(doc)
+        self._terms: Dict[str, _Term] = {token: _term(docs[token], found) for token, found in lines.items()}
+        self._prefixes: Dict[str, Optional[_Term]] = {}
+        self._vocabulary = sorted(vocabulary)
+        self._by_price = sorted((doc for doc, price in enumerate(self.prices) if price is not None),
+                                key=lambda doc: self.prices[doc])
+
+    def _postings(self, token: str) -> Optional[_Term]:
+        """Постинги токена; незнакомый длиннее двух букв — как префикс"""
+        term = self._terms.get(token)
+        if term is not None or len(token) < 3:
+            return term
+        try:
+            return self._prefixes[token]
+        except KeyError:
+            pass
+        start = bisect.bisect_left(self._vocabulary, token)
+        words = []
+        for word in self._vocabulary[start:]:
+            if not word.startswith(token):
+                break
+            words.append(word)
+        if len(words) > 1:
+            term = _term(sorted(frozenset().union(*(self._terms[w].doc_set for w in words))),
+                         sorted(frozenset().union(*(self._terms[w].line_set for w in words))))
+        elif words:
+            term = self._terms[words[0]]
+        if len(self._prefixes) >= self.PREFIX_CACHE_SIZE:
+            self._prefixes.clear()
+        self._prefixes[token] = term
+        return term
+
+    def search(self, query: str, limit: int = 10) -> Tuple[List[SearchHit], Tuple[str, ...]]:
+        """Найденные модели (лучшие первыми) и слова запроса, которые пришлось отбросить"""
+        low, high = None, None
+        for word, amount, thousands in _PRICE_FILTER_RE.findall(query):
+            value = int(re.sub(r"\D", "", amount)) * (1000 if thousands else 1)
+            if word.lower() in ("до", "дешевле"):
+                high = value
+            else:
+                low = value
+        query = _PRICE_FILTER_RE.sub(" ", query)
+
+        postings = []
+        ignored = []
+        for word in _WORD_RE.findall(query):
+            token = normalize(word)
+            # Одиночные символы, в том числе цифры, совпадают с обрывками артикулов («FC-U6000-1»)
+            if token in _STOP_WORDS or len(token) < 2:
+                continue
+            found = self._postings(token)
+            if found is None:
+                ignored.append(word)
+            else:
+                postings.append(found)
+
+        if postings:
+            candidates = self._ranked(postings)
+        elif low is not None or high is not None:
+            candidates = self._by_price  # только фильтр цены — от дешёвых к дорогим
+        else:
+            candidates = []
+
+        tokens = frozenset(normalize(word) for word in _WORD_RE.findall(query))
+        hits = []
+        for doc in candidates:
+            price = self.prices[doc]
+            if low is not None or high is not None:
+                if price is None or (low is not None and price < low) or (high is not None and price > high):
+                    continue
+            hits.append(self._hit(doc, postings, tokens))
+            if len(hits) == limit:
+                break
+        return hits, tuple(ignored)
+
+    def _ranked(self, postings: List[_Term]):
+        """Сначала модели, где все слова нашлись в одной строке, затем остальные — лениво, по порядку каталога"""
+        rarest = min(postings, key=lambda term: len(term.lines))
+        first = set()
+        for line in _walk(rarest.lines, [term.line_set for term in postings if term is not rarest]):
+            doc = line >> _LINE_BITS
+            if doc not in first:
+                first.add(doc)
+                yield doc
+        if len(postings) > 1:
+            rarest = min(postings, key=lambda term: len(term.docs))
+            for doc in _walk(rarest.docs, [term.doc_set for term in postings if term is not rarest]):
+                if doc not in first:
+                    yield doc
+
+    def _hit(self, doc: int, postings: List[_Term], tokens: frozenset, max_lines: int = 4) -> SearchHit:
+        # Строки модели в постингах слова идут подряд — находим их бинарным поиском.
+        # Строка 0 — само название; показываем строки, где совпало больше всего слов запроса
+        start = doc << _LINE_BITS
+        counts: Dict[int, int] = {}
+        for term in postings:
+            i = bisect.bisect_left(term.lines, start + 1)
+            end = bisect.bisect_left(term.lines, start + _MAX_LINES, i)
+            for line in term.lines[i:end]:
+                counts[line - start] = counts.get(line - start, 0) + 1
+        coverage = sorted((-count, number) for number, count in counts.items())
+        lines = []
+        for count, number in coverage[:max_lines]:
+            if count != coverage[0][0]:
+                break
+            key, value = self._lines[doc][number]
+            text = _highlight(value, tokens)
+            lines.append(f"<b>{html.escape(key)}:</b> {text}" if key else text)
+        return SearchHit(self.names[doc], self.prices[doc], tuple(lines))
+
+
+@functools.lru_cache(maxsize=4096)
+def _highlight(text: str, tokens: frozenset) -> str:
+    parts, last = [], 0
+    for match in _WORD_RE.finditer(text):
+        token = normalize(match.group())
+        if token in tokens or any(len(t) >= 3 and token.startswith(t) for t in tokens):
+            parts.append(html.escape(text[last:match.start()]))
+            parts.append(f"<u>{html.escape(match.group())}</u>")
+            last = match.end()
+    parts.append(html.escape(text[last:]))
+    return "".join(parts)
+
+
+class CatalogSnapshot:
+    """Скомпилированный каталог: готовые подписи, тексты и JSON клавиатур.
+
+    Снимок не меняется после сборки; при изменении файла каталога собирается
+    новый снимок и подменяется целиком.
+    """
+
+    def __init__(self, data: dict):
+        bikes = data["bikes"]
+        frame_sizes = data["frame_sizes"]
+        self.bikes: Mapping[str, dict] = MappingProxyType(bikes)
+        self.frame_sizes: Mapping[str, str] = MappingProxyType(dict(frame_sizes))
+        self.names: Tuple[str, ...] = tuple(bikes)
+        self.photo_urls: Tuple[str, ...] = tuple(url for bike in bikes.values() for url in bike["photos"])
+
+        self.catalog_text = "Выберите модель:"
+        self.catalog_keyboard = _keyboard([[(name, name)] for name in bikes])
+
+        photos, captions, photo_keyboards = {}, {}, {}
+        specs_text, specs_keyboard, size_text, size_keyboard = {}, {}, {}, {}
+        for name, bike in bikes.items():
+            urls = bike["photos"]
+            photos[name] = tuple(urls)
+            for idx in range(len(urls)):
+                captions[(name, idx)] = bike["description"] if idx == 0 else f"Фото {idx+1}"
+                rows = []
+                if len(urls) > 1:
+                    nav = []
+                    if idx > 0:
+                        nav.append(("Пред", f"prev_photo_{name}"))
+                    nav.append((f"{idx+1}/{len(urls)}", "ignore"))
+                    if idx < len(urls) - 1:
+                        nav.append(("След", f"next_photo_{name}"))
+                    rows.append(nav)
+                rows += [
+                    [("Спецификация", f"specs_{name}")],
+                    [("Заказать", f"order_{name}")],
+                    [("Назад", "back_to_catalog")],
+                ]
+                photo_keyboards[(name, idx)] = _keyboard(rows)
+
+            text = f"<b>Спецификация {name}</b>\n\n"
+            for k, v in bike["specs"].items():
+                text += f"• <b>{k}:</b> {v}\n"
+            specs_text[name] = text
+            specs_keyboard[name] = _keyboard([[("Назад", name)]])
+
+            size_text[name] = f"Выбрано: {name}\n\nВыберите размер:"
+            size_keyboard[name] = _keyboard(
+                [[(f"{size} ({h})", f"size_{size}")] for size, h in frame_sizes.items()] + [[("Назад", name)]]
+            )
+
+        self.photos = MappingProxyType(photos)
+        self.captions = MappingProxyType(captions)
+        self.photo_keyboards = MappingProxyType(photo_keyboards)
+        self.specs_text = MappingProxyType(specs_text)
+        self.specs_keyboard = MappingProxyType(specs_keyboard)
+        self.size_text = MappingProxyType(size_text)
+        self.size_keyboard = MappingProxyType(size_keyboard)
+        self.search = SearchIndex(bikes)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.bikes
+
+
+class Catalog:
+    """Каталог из файла с горячей перезагрузкой.
+
+    current() возвращает готовый снимок; раз в check_interval секунд проверяется
+    mtime файла, и если он изменился — новый снимок (с поисковым индексом это
+    секунды на тысячах моделей) собирается в фоновом потоке и атомарно
+    подменяется. До тех пор и при ошибке разбора работаем со старым снимком.
+    """
+
+    def __init__(self, path: str = CATALOG_FILE, check_interval: float = 5.0):
+        self.path = path
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._mtime = os.stat(path).st_mtime_ns
+        self._checked_at = time.monotonic()
+        self._snapshot = self._compile()
+
+    def _compile(self) -> CatalogSnapshot:
+        with open(self.path, encoding="utf-8") as f:
+            return CatalogSnapshot(json.load(f))
+
+    def current(self) -> CatalogSnapshot:
+        if time.monotonic() - self._checked_at >= self.check_interval:
+            self._checked_at = time.monotonic()
+            if self._changed() and not self._lock.locked():
+                threading.Thread(target=self.reload, name="catalog-reload", daemon=True).start()
+        return self._snapshot
+
+    def _changed(self) -> bool:
+        try:
+            return os.stat(self.path).st_mtime_ns != self._mtime
+        except OSError as e:
+            logger.error("Не удалось проверить файл каталога %s: %s", self.path, e)
+            return False
+
+    def reload(self, force: bool = False) -> Optional[CatalogSnapshot]:
+        """Пересобрать снимок, если файл изменился; возвращает новый снимок или None"""
+        if not self._lock.acquire(blocking=False):
+            return None  # уже пересобирает другой поток — отдаём текущий снимок
+        try:
+            self._checked_at = time.monotonic()
+            mtime = os.stat(self.path).st_mtime_ns
+            if mtime == self._mtime and not force:
+                return None
+            self._mtime = mtime
+            snapshot = self._compile()
+            self._snapshot = snapshot
+            logger.info("Каталог перезагружен: %s моделей", len(snapshot.names))
+            return snapshot
+        except Exception as e:
+            logger.error("Не удалось перезагрузить каталог %s: %s", self.path, e)
+            return None
+        finally:
+            self._lock.release()
@@ -1,120 +1,677 @@
 import sqlite3
 import datetime
-from typing import List, Tuple, Dict
+import logging
+import os
+import threading
+import time
+import weakref
+from contextlib import contextmanager
+from functools import lru_cache
+from typing import Dict, Iterator, List, Optional, Set, Tuple
 
-class Database:
-    def __init__(self, db_name: str = "bot_database.db"):
+logger = logging.getLogger(__name__)
+
+
+class _ThreadConnection:
+    """Держатель соединения в threading.local: когда поток завершается, он
+    собирается сборщиком мусора и его финализатор закрывает соединение"""
+    __slots__ = ('conn', '__weakref__')
+
+    def __init__(self, conn: sqlite3.Connection):
+        self.conn = conn
+
+
+def _close_connection(connections: Set[sqlite3.Connection], lock: threading.Lock, conn: sqlite3.Connection):
+    with lock:
+        if conn not in connections:
+            return  # уже закрыто в close_all
+        connections.discard(conn)
+    try:
+        conn.close()
+    except Exception:
+        pass
+
+
+class ConnectionManager:
+    """Потокобезопасный менеджер соединений SQLite: одно постоянное соединение на поток, WAL.
+
+    Соединение живёт, пока жив поток: у короткоживущих потоков (рассылки,
+    таймеры, фоновый старт) оно закрывается при их завершении и не держит
+    дескрипторы db/-wal/-shm.
+    """
+
+    def __init__(self, db_name: str, busy_timeout: float = 30.0, cached_statements: int = 256,
+                 retries: int = 5):
         self.db_name = db_name
-        self.init_db()
-
-    def init_db(self):
-        """Инициализация базы данных"""
-        conn = sqlite3.connect(self.db_name)
-        cursor = conn.cursor()
-        
-        # Таблица пользователей
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                user_id INTEGER PRIMARY KEY,
-                username TEXT,
-                first_name TEXT,
-                last_name TEXT,
-                created_at TEXT,
-                last_active TEXT
-            )
+        self.busy_timeout = busy_timeout
+        self.cached_statements = cached_statements
+        self.retries = retries
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections: Set[sqlite3.Connection] = set()
+        self.metrics = None  # metrics.Metrics: время запросов и транзакций, None — без замеров
+
+    def _connect(self) -> sqlite3.Connection:
+        # isolation_level=None — транзакциями управляем сами (BEGIN IMMEDIATE),
+        # cached_statements — кэш подготовленных выражений внутри соединения
+        conn = sqlite3.connect(
+            self.db_name,
+            timeout=self.busy_timeout,
+            isolation_level=None,
+            check_same_thread=False,
+            cached_statements=self.cached_statements,
+        )
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA busy_timeout={int(self.busy_timeout * 1000)}")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        with self._lock:
+            self._connections.add(conn)
+        return conn
+
+    def connection(self) -> sqlite3.Connection:
+        """Соединение текущего потока (создаётся при первом обращении)"""
+        holder = getattr(self._local, 'holder', None)
+        if holder is None:
+            conn = self._connect()
+            holder = _ThreadConnection(conn)
+            weakref.finalize(holder, _close_connection, self._connections, self._lock, conn)
+            self._local.holder = holder
+        return holder.conn
+
+    @property
+    def open_connections(self) -> int:
+        return len(self._connections)
+
+    @contextmanager
+    def transaction(self):
+        """Пишущая транзакция: BEGIN IMMEDIATE сразу берёт блокировку записи,
+        поэтому конкурирующие писатели ждут busy_timeout, а не падают с deadlock"""
+        conn = self.connection()
+        started = time.perf_counter()
+        for attempt in range(self.retries):
+            try:
+                conn.execute("BEGIN IMMEDIATE")
+                break
+            except sqlite3.OperationalError as e:
+                if "locked" not in str(e) or attempt == self.retries - 1:
+                    raise
+                time.sleep(0.05 * (attempt + 1))
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        else:
+            conn.execute("COMMIT")
+        finally:
+            if self.metrics is not None:
+                self.metrics.observe('bot_db_query_seconds', time.perf_counter() - started, 'transaction')
+
+    def execute(self, sql: str, params=()) -> sqlite3.Cursor:
+        """Чтение или одиночная запись в режиме autocommit"""
+        if self.metrics is None:
+            return self.connection().execute(sql, params)
+        with self.metrics.timer('bot_db_query_seconds', _statement_kind(sql)):
+            return self.connection().execute(sql, params)
+
+    def close_all(self):
+        """Закрыть все соединения (при остановке бота)"""
+        with self._lock:
+            connections = list(self._connections)
+            self._connections.clear()
+        for conn in connections:
+            try:
+                conn.close()
+            except Exception:
+                pass
+        self._local = threading.local()
+
+
+# === СХЕМА ===
+# Версия схемы хранится в PRAGMA user_version; каждая миграция выполняется
+# в своей транзакции вместе с записью нового номера версии.
+
+USERS_TABLE_SQL = '''
+    CREATE TABLE {name} (
+        user_id INTEGER PRIMARY KEY,
+        username TEXT,
+        first_name TEXT,
+        last_name TEXT,
+        full_name TEXT,
+        first_seen TEXT,
+        last_activity TEXT,
+        messages_count INTEGER NOT NULL DEFAULT 0,
+        reachable INTEGER NOT NULL DEFAULT 1,
+        delivery_error TEXT,
+        failed_count INTEGER NOT NULL DEFAULT 0,
+        last_failure TEXT
+    )
+'''
+
+# Столбец новой таблицы -> выражение по старой, если такого столбца в ней нет
+_USERS_DEFAULTS = {
+    'username': 'NULL',
+    'first_name': 'NULL',
+    'last_name': 'NULL',
+    'full_name': "''",
+    'first_seen': 'NULL',
+    'last_activity': 'NULL',
+    'messages_count': '0',
+    'reachable': '1',
+    'delivery_error': 'NULL',
+    'failed_count': '0',
+    'last_failure': 'NULL',
+}
+
+# Счётчики ведутся триггерами при каждой записи в users, поэтому экраны админки
+# читают пару строк вместо полного прохода по таблице.
+STATS_TRIGGERS = '''
+    CREATE TRIGGER IF NOT EXISTS users_stats_insert AFTER INSERT ON users
+    BEGIN
+        INSERT INTO stats_daily (day, active_users, new_users, messages)
+        VALUES (substr(NEW.last_activity, 1, 10), 1, 1, NEW.messages_count)
+        ON CONFLICT(day) DO UPDATE SET
+            active_users = active_users + 1,
+            new_users = new_users + 1,
+            messages = messages + excluded.messages;
+        UPDATE stats_counters SET value = value + 1 WHERE name = 'total_users';
+        UPDATE stats_counters SET value = value + NEW.reachable WHERE name = 'reachable_users';
+        UPDATE stats_counters SET value = value + NEW.messages_count WHERE name = 'total_messages';
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS users_stats_activity AFTER UPDATE OF last_activity, messages_count ON users
+    BEGIN
+        INSERT INTO stats_daily (day, active_users, new_users, messages)
+        VALUES (
+            substr(NEW.last_activity, 1, 10),
+            substr(OLD.last_activity, 1, 10) IS NOT substr(NEW.last_activity, 1, 10),
+            0,
+            NEW.messages_count - OLD.messages_count
+        )
+        ON CONFLICT(day) DO UPDATE SET
+            active_users = active_users + excluded.active_users,
+            messages = messages + excluded.messages;
+        UPDATE stats_counters SET value = value + NEW.messages_count - OLD.messages_count
+        WHERE name = 'total_messages';
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS users_stats_reachable AFTER UPDATE OF reachable ON users
+    WHEN OLD.reachable IS NOT NEW.reachable
+    BEGIN
+        UPDATE stats_counters SET value = value + NEW.reachable - OLD.reachable WHERE name = 'reachable_users';
+    END;
+
+    CREATE TRIGGER IF NOT EXISTS users_stats_delete AFTER DELETE ON users
+    BEGIN
+        UPDATE stats_counters SET value = value - 1 WHERE name = 'total_users';
+        UPDATE stats_counters SET value = value - OLD.reachable WHERE name = 'reachable_users';
+        UPDATE stats_counters SET value = value - OLD.messages_count WHERE name = 'total_messages';
+    END;
+'''
+
+USER_UPSERT_SQL = '''
+    INSERT INTO users (user_id, username, first_name, last_name, full_name, first_seen, last_activity, messages_count)
+    VALUES (?, ?, ?, ?, ?, ?, ?, 1)
+    ON CONFLICT(user_id) DO UPDATE SET
+        username = excluded.username,
+        first_name = excluded.first_name,
+        last_name = excluded.last_name,
+        full_name = excluded.full_name,
+        last_activity = excluded.last_activity,
+        messages_count = users.messages_count + 1,
+        reachable = 1,
+        delivery_error = NULL
+'''
+
+ACTIVITY_UPSERT_SQL = '''
+    INSERT INTO users (user_id, username, first_name, last_name, full_name, first_seen, last_activity, messages_count)
+    VALUES (?, NULL, NULL, NULL, '', ?, ?, 1)
+    ON CONFLICT(user_id) DO UPDATE SET
+        last_activity = excluded.last_activity,
+        messages_count = users.messages_count + 1,
+        reachable = 1,
+        delivery_error = NULL
+'''
+
+USERS_PAGE_COLUMNS = "user_id, username, full_name, messages_count, last_activity"
+
+# Таблицы, доступные для выгрузки, и столбец даты для фильтра
+EXPORT_DATE_COLUMNS = {
+    'users': 'last_activity',
+    'orders': 'created_at',
+}
+
+
+@lru_cache(maxsize=512)
+def _statement_kind(sql: str) -> str:
+    """Метка запроса для метрик: первое слово SQL (select, insert, pragma...)"""
+    return sql.lstrip().split(None, 1)[0].lower() if sql.strip() else "empty"
+
+
+def _columns(conn: sqlite3.Connection, table: str, schema: str = "main") -> Dict[str, str]:
+    return {row[1]: (row[2] or "").upper() for row in conn.execute(f"PRAGMA {schema}.table_info({table})")}
+
+
+def _migrate_users_integer_ids(db: "Database", conn: sqlite3.Connection):
+    """v1: users с INTEGER user_id (раньше в users.db был TEXT) и таблица заказов"""
+    old = _columns(conn, "users")
+    if not old:
+        conn.execute(USERS_TABLE_SQL.format(name="users"))
+    elif old.get("user_id") != "INTEGER" or set(_USERS_DEFAULTS) - set(old):
+        # Пересобираем таблицу: SQLite не умеет менять тип столбца.
+        # Вместе со старой таблицей уходят её индексы и триггеры — их создаёт v3.
+        conn.execute(USERS_TABLE_SQL.format(name="users_v1"))
+        columns = ", ".join(_USERS_DEFAULTS)
+        values = ", ".join(
+            f"COALESCE({column}, {default})" if column in old else default
+            for column, default in _USERS_DEFAULTS.items()
+        )
+        # Если '42' и ' 42' сошлись в один ключ — остаётся самая свежая запись
+        order = "ORDER BY last_activity DESC" if "last_activity" in old else ""
+        conn.execute(f'''
+            INSERT OR IGNORE INTO users_v1 (user_id, {columns})
+            SELECT CAST(user_id AS INTEGER), {values} FROM users
+            WHERE CAST(user_id AS INTEGER) != 0 {order}
         ''')
-        
-        # Таблица заказов (упрощенная версия)
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS orders (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                user_name TEXT,
-                user_phone TEXT,
-                user_email TEXT,
-                bike_model TEXT,
-                frame_size TEXT,
-                created_at TEXT
-            )
+        conn.execute("DROP TABLE users")
+        conn.execute("ALTER TABLE users_v1 RENAME TO users")
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS orders (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            user_name TEXT,
+            user_phone TEXT,
+            user_email TEXT,
+            bike_model TEXT,
+            frame_size TEXT,
+            created_at TEXT
+        )
+    ''')
+
+
+def _migrate_merge_legacy(db: "Database", conn: sqlite3.Connection):
+    """v2: перенести пользователей и заказы из старой bot_database.db, если она есть"""
+    if not db.legacy_attached:
+        return
+    legacy_users = _columns(conn, "users", "legacy")
+    if legacy_users:
+        moved = conn.execute('''
+            INSERT INTO users (user_id, username, first_name, last_name, full_name, first_seen, last_activity)
+            SELECT user_id, username, first_name, last_name,
+                   trim(COALESCE(first_name, '') || ' ' || COALESCE(last_name, '')), created_at, last_active
+            FROM legacy.users WHERE user_id IS NOT NULL
+            ON CONFLICT(user_id) DO UPDATE SET
+                username = COALESCE(users.username, excluded.username),
+                first_name = COALESCE(users.first_name, excluded.first_name),
+                last_name = COALESCE(users.last_name, excluded.last_name),
+                first_seen = COALESCE(min(users.first_seen, excluded.first_seen), users.first_seen, excluded.first_seen),
+                last_activity = COALESCE(max(users.last_activity, excluded.last_activity), users.last_activity,
+                                         excluded.last_activity)
+        ''').rowcount
+        logger.info("Из %s перенесено пользователей: %s", db.legacy_db, moved)
+    if _columns(conn, "orders", "legacy"):
+        moved = conn.execute('''
+            INSERT INTO orders (user_id, user_name, user_phone, user_email, bike_model, frame_size, created_at)
+            SELECT user_id, user_name, user_phone, user_email, bike_model, frame_size, created_at
+            FROM legacy.orders WHERE user_id IS NOT NULL ORDER BY id
+        ''').rowcount
+        logger.info("Из %s перенесено заказов: %s", db.legacy_db, moved)
+
+
+def _migrate_indexes_and_stats(db: "Database", conn: sqlite3.Connection):
+    """v3: индексы под выборки бота, таблицы статистики и триггеры к ним"""
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_users_reachable ON users(reachable, user_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_users_last_activity ON users(last_activity, user_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_users_first_seen ON users(first_seen, user_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_orders_user_created ON orders(user_id, created_at)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_orders_model_created ON orders(bike_model, created_at)")
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS stats_daily (
+            day TEXT PRIMARY KEY,
+            active_users INTEGER NOT NULL DEFAULT 0,
+            new_users INTEGER NOT NULL DEFAULT 0,
+            messages INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS stats_counters (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    # Пользователи пересобраны и слиты — счётчики считаем заново по данным
+    total, reachable, messages = conn.execute(
+        "SELECT COUNT(*), COALESCE(SUM(reachable), 0), COALESCE(SUM(messages_count), 0) FROM users"
+    ).fetchone()
+    conn.execute("DELETE FROM stats_counters")
+    conn.executemany("INSERT INTO stats_counters (name, value) VALUES (?, ?)", [
+        ('total_users', total), ('reachable_users', reachable), ('total_messages', messages),
+    ])
+    if conn.execute("SELECT COUNT(*) FROM stats_daily").fetchone()[0] == 0:
+        # Истории по дням ещё нет — восстанавливаем, что можно, по users
+        conn.execute('''
+            INSERT INTO stats_daily (day, active_users)
+            SELECT substr(last_activity, 1, 10), COUNT(*) FROM users WHERE last_activity IS NOT NULL GROUP BY 1
         ''')
-        
-        conn.commit()
-        conn.close()
+        conn.execute('''
+            INSERT INTO stats_daily (day, new_users)
+            SELECT substr(first_seen, 1, 10), COUNT(*) FROM users WHERE first_seen IS NOT NULL GROUP BY 1 ORDER BY 1
+            ON CONFLICT(day) DO UPDATE SET new_users = excluded.new_users
+        ''')
+    for statement in STATS_TRIGGERS.split("END;"):
+        if statement.strip():
+            conn.execute(statement + "END;")
+
+
+def _migrate_broadcasts_and_photos(db: "Database", conn: sqlite3.Connection):
+    """v4: таблицы рассылок и кэша фото (раньше их создавали сами BroadcastStore и PhotoStore)"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS broadcast_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            text TEXT NOT NULL,
+            chat_id INTEGER,
+            message_id INTEGER,
+            status TEXT NOT NULL DEFAULT 'running',
+            total INTEGER NOT NULL DEFAULT 0,
+            sent INTEGER NOT NULL DEFAULT 0,
+            failed INTEGER NOT NULL DEFAULT 0,
+            cursor INTEGER NOT NULL DEFAULT 0,
+            created_at TEXT,
+            finished_at TEXT
+        )
+    ''')
+    # status: pending / sent / blocked / not_found / failed (временная ошибка)
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS broadcast_deliveries (
+            job_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            PRIMARY KEY (job_id, user_id)
+        ) WITHOUT ROWID
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS photo_cache (
+            url TEXT PRIMARY KEY,
+            file_id TEXT NOT NULL,
+            updated_at TEXT
+        )
+    ''')
+
+
+def _migrate_orders_by_date(db: "Database", conn: sqlite3.Connection):
+    """v5: заказы за период по диапазону created_at, а не полным обходом индекса по моделям"""
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_orders_created_model ON orders(created_at, bike_model)")
+    # Запросов по модели без даты нет, а индекс из v3 только замедлял вставку заказов
+    conn.execute("DROP INDEX IF EXISTS idx_orders_model_created")
+
 
+MIGRATIONS = (
+    _migrate_users_integer_ids,
+    _migrate_merge_legacy,
+    _migrate_indexes_and_stats,
+    _migrate_broadcasts_and_photos,
+    _migrate_orders_by_date,
+)
+
+
+class Database:
+    """Хранилище бота: пользователи, заказы, статистика, рассылки и кэш фото в одной БД
+    с версионированной схемой"""
+
+    def __init__(self, db_name: str = "users.db", legacy_db: Optional[str] = "bot_database.db"):
+        self.db_name = db_name
+        self.legacy_db = legacy_db
+        self.legacy_attached = False
+        self.pool = ConnectionManager(db_name)
+        self.migrate()
+
+    @property
+    def version(self) -> int:
+        return self.pool.execute("PRAGMA user_version").fetchone()[0]
+
+    def migrate(self):
+        """Применить недостающие миграции по порядку"""
+        version = self.version
+        if version >= len(MIGRATIONS):
+            return
+        conn = self.pool.connection()
+        # ATTACH нельзя выполнить внутри транзакции — подключаем старую БД заранее
+        if version < 2 and self.legacy_db and os.path.exists(self.legacy_db) \
+                and os.path.abspath(self.legacy_db) != os.path.abspath(self.db_name):
+            conn.execute("ATTACH DATABASE ? AS legacy", (self.legacy_db,))
+            self.legacy_attached = True
+        try:
+            for number, migration in enumerate(MIGRATIONS[version:], version + 1):
+                with self.pool.transaction() as tx:
+                    migration(self, tx)
+                    tx.execute(f"PRAGMA user_version = {number}")
+                logger.info("Схема %s обновлена до версии %s", self.db_name, number)
+        finally:
+            if self.legacy_attached:
+                conn.execute("DETACH DATABASE legacy")
+                self.legacy_attached = False
+
+    def optimize(self):
+        """Обновить статистику планировщика там, где она устарела (ANALYZE по необходимости)"""
+        self.pool.execute("PRAGMA optimize")
+
+    # === ПОЛЬЗОВАТЕЛИ ===
     def add_user(self, user_id: int, username: str, first_name: str, last_name: str):
-        """Добавление нового пользователя"""
-        conn = sqlite3.connect(self.db_name)
-        cursor = conn.cursor()
-        
-        current_time = datetime.datetime.now().isoformat()
-        cursor.execute('''
-            INSERT OR REPLACE INTO users (user_id, username, first_name, last_name, created_at, last_active)
-            VALUES (?, ?, ?, ?, ?, ?)
-        ''', (user_id, username, first_name, last_name, current_time, current_time))
-        
-        conn.commit()
-        conn.close()
+        """Добавить пользователя или обновить его данные — трогает только одну строку"""
+        now = datetime.datetime.now().isoformat()
+        full_name = f"{first_name} {last_name or ''}".strip()
+        self.pool.execute(USER_UPSERT_SQL, (user_id, username, first_name, last_name, full_name, now, now))
 
     def update_user_activity(self, user_id: int):
-        """Обновление времени последней активности"""
-        conn = sqlite3.connect(self.db_name)
-        cursor = conn.cursor()
-        
+        """Атомарно увеличить счётчик сообщений и обновить last_activity"""
+        now = datetime.datetime.now().isoformat()
+        self.pool.execute(ACTIVITY_UPSERT_SQL, (user_id, now, now))
+
+    def get_user_stats(self) -> Dict[str, int]:
+        """Общие счётчики и данные за сегодня — несколько чтений по первичному ключу"""
+        stats = dict(self.pool.execute("SELECT name, value FROM stats_counters").fetchall())
+        today = datetime.datetime.now().date().isoformat()
+        row = self.pool.execute(
+            "SELECT active_users, new_users, messages FROM stats_daily WHERE day = ?", (today,)
+        ).fetchone() or (0, 0, 0)
+        stats.update(active_today=row[0], new_today=row[1], messages_today=row[2])
+        return stats
+
+    def get_users_page(self, page: int = 0, after: Optional[Tuple[str, int]] = None,
+                       before: Optional[Tuple[str, int]] = None, limit: int = 10):
+        """Страница пользователей по убыванию last_activity через индекс.
+
+        after / before — ключ (last_activity, user_id) последней / первой строки соседней
+        страницы: переход «след./пред.» идёт по ключу и стоит O(limit); без ключа — OFFSET.
+        """
+        if after is not None:
+            return self.pool.execute(f'''
+                SELECT {USERS_PAGE_COLUMNS} FROM users WHERE (last_activity, user_id) < (?, ?)
+                ORDER BY last_activity DESC, user_id DESC LIMIT ?
+            ''', (*after, limit)).fetchall()
+        if before is not None:
+            rows = self.pool.execute(f'''
+                SELECT {USERS_PAGE_COLUMNS} FROM users WHERE (last_activity, user_id) > (?, ?)
+                ORDER BY last_activity ASC, user_id ASC LIMIT ?
+            ''', (*before, limit)).fetchall()
+            return rows[::-1]
+        return self.pool.execute(f'''
+            SELECT {USERS_PAGE_COLUMNS} FROM users ORDER BY last_activity DESC, user_id DESC LIMIT ? OFFSET ?
+        ''', (limit, page * limit)).fetchall()
+
+    def get_all_users(self, limit: int = 50, offset: int = 0):
+        """Получение страницы пользователей (новые сверху) по индексу first_seen"""
+        return self.pool.execute('''
+            SELECT user_id, username, first_name, last_name FROM users
+            ORDER BY first_seen DESC, user_id DESC LIMIT ? OFFSET ?
+        ''', (limit, offset)).fetchall()
+
+    # === ЗАКАЗЫ ===
+    def add_order(self, user_id: int, user_name: str, user_phone: str, user_email: Optional[str],
+                  bike_model: str, frame_size: str) -> int:
+        """Добавление нового заказа; возвращает его номер"""
         current_time = datetime.datetime.now().isoformat()
-        cursor.execute('''
-            UPDATE users SET last_active = ? WHERE user_id = ?
-        ''', (current_time, user_id))
-        
-        conn.commit()
-        conn.close()
+        with self.pool.transaction() as conn:
+            return conn.execute('''
+                INSERT INTO orders (user_id, user_name, user_phone, user_email, bike_model, frame_size, created_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', (user_id, user_name, user_phone, user_email, bike_model, frame_size, current_time)).lastrowid
+
+    def get_user_orders(self, user_id: int, limit: int = 20):
+        """Последние заказы пользователя — по индексу (user_id, created_at)"""
+        return self.pool.execute('''
+            SELECT id, bike_model, frame_size, user_phone, created_at FROM orders
+            WHERE user_id = ? ORDER BY created_at DESC LIMIT ?
+        ''', (user_id, limit)).fetchall()
+
+    def get_sales_by_model(self, since: Optional[str] = None) -> List[Tuple[str, int]]:
+        """Число заказов по моделям с даты since — диапазон по индексу (created_at, bike_model).
+
+        Заказы без модели (контакты без выбранного велосипеда) не считаются.
+        """
+        return self.pool.execute('''
+            SELECT bike_model, COUNT(*) FROM orders WHERE created_at >= ? AND bike_model IS NOT NULL
+            GROUP BY bike_model ORDER BY COUNT(*) DESC
+        ''', (since or "",)).fetchall()
+
+    def count_orders(self, since: Optional[str] = None) -> int:
+        """Все заказы с даты since, включая заказы без модели"""
+        return self.pool.execute(
+            "SELECT COUNT(*) FROM orders WHERE created_at >= ?", (since or "",)
+        ).fetchone()[0]
+
+    # === ВЫГРУЗКА ===
+    def export_rows(self, table: str, since: Optional[str] = None, until: Optional[str] = None,
+                    chunk_size: int = 1000) -> Tuple[List[str], Iterator[List[tuple]]]:
+        """Названия столбцов и строки таблицы порциями по chunk_size прямо из курсора.
 
-    def add_order(self, user_id: int, user_name: str, user_phone: str, user_email: str, bike_model: str, frame_size: str):
-        """Добавление нового заказа"""
-        conn = sqlite3.connect(self.db_name)
-        cursor = conn.cursor()
-        
+        Фильтр по дате: users — по last_activity, orders — по created_at; since включительно,
+        until — исключительно. В памяти одновременно не больше одной порции.
+        """
+        column = EXPORT_DATE_COLUMNS[table]
+        conditions, params = [], []
+        if since:
+            conditions.append(f"{column} >= ?")
+            params.append(since)
+        if until:
+            conditions.append(f"{column} < ?")
+            params.append(until)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        # ORDER BY rowid — обход таблицы по порядку хранения, без сортировки во временном B-дереве
+        cursor = self.pool.connection().execute(f"SELECT * FROM {table} {where} ORDER BY rowid", params)
+        header = [d[0] for d in cursor.description]
+
+        def chunks():
+            try:
+                while True:
+                    rows = cursor.fetchmany(chunk_size)
+                    if not rows:
+                        return
+                    yield rows
+            finally:
+                cursor.close()
+
+        return header, chunks()
+
+
+class BroadcastStore:
+    """Хранение рассылок: задание, курсор по получателям и статус доставки каждому.
+
+    Таблицы создаёт миграция v4 — pool должен принадлежать Database.
+    """
+
+    def __init__(self, pool: ConnectionManager):
+        self.pool = pool
+
+    def create_job(self, text: str, chat_id: int, message_id: int) -> Dict:
+        """Создать задание и зафиксировать список получателей одним INSERT ... SELECT"""
+        now = datetime.datetime.now().isoformat()
+        with self.pool.transaction() as conn:
+            job_id = conn.execute('''
+                INSERT INTO broadcast_jobs (text, chat_id, message_id, created_at) VALUES (?, ?, ?, ?)
+            ''', (text, chat_id, message_id, now)).lastrowid
+            total = conn.execute('''
+                INSERT OR IGNORE INTO broadcast_deliveries (job_id, user_id)
+                SELECT ?, user_id FROM users WHERE reachable = 1
+            ''', (job_id,)).rowcount
+            conn.execute('UPDATE broadcast_jobs SET total = ? WHERE id = ?', (total, job_id))
+        return self.get_job(job_id)
+
+    def get_job(self, job_id: int) -> Optional[Dict]:
+        row = self.pool.execute('''
+            SELECT id, text, chat_id, message_id, status, total, sent, failed, cursor FROM broadcast_jobs WHERE id = ?
+        ''', (job_id,)).fetchone()
+        if row is None:
+            return None
+        keys = ('id', 'text', 'chat_id', 'message_id', 'status', 'total', 'sent', 'failed', 'cursor')
+        return dict(zip(keys, row))
+
+    def unfinished_jobs(self) -> List[Dict]:
+        rows = self.pool.execute("SELECT id FROM broadcast_jobs WHERE status = 'running' ORDER BY id").fetchall()
+        return [self.get_job(job_id) for (job_id,) in rows]
+
+    def iter_pending(self, job_id: int, after: int = 0, batch_size: int = 1000) -> Iterator[int]:
+        """Недоставленные получатели по возрастанию user_id, порциями по первичному ключу"""
+        while True:
+            rows = self.pool.execute('''
+                SELECT user_id FROM broadcast_deliveries
+                WHERE job_id = ? AND user_id > ? AND status = 'pending'
+                ORDER BY user_id LIMIT ?
+            ''', (job_id, after, batch_size)).fetchall()
+            if not rows:
+                return
+            for (uid,) in rows:
+                yield uid
+            after = rows[-1][0]
+
+    def checkpoint(self, job_id: int, results: List[Tuple[int, str]], sent: int, failed: int, cursor: int):
+        """Пачкой записать результаты доставки, отметить недоступных пользователей и сдвинуть курсор"""
+        now = datetime.datetime.now().isoformat()
+        failures = [(status, now, uid) for uid, status in results if status != 'sent']
+        with self.pool.transaction() as conn:
+            conn.executemany('''
+                UPDATE broadcast_deliveries SET status = ? WHERE job_id = ? AND user_id = ?
+            ''', [(status, job_id, uid) for uid, status in results])
+            conn.executemany('''
+                UPDATE users SET
+                    delivery_error = ?1,
+                    last_failure = ?2,
+                    failed_count = failed_count + 1,
+                    reachable = CASE WHEN ?1 IN ('blocked', 'not_found') THEN 0 ELSE reachable END
+                WHERE user_id = ?3
+            ''', failures)
+            conn.execute('''
+                UPDATE broadcast_jobs SET sent = ?, failed = ?, cursor = ? WHERE id = ?
+            ''', (sent, failed, cursor, job_id))
+
+    def delivery_summary(self, job_id: int) -> Dict[str, int]:
+        rows = self.pool.execute('''
+            SELECT status, COUNT(*) FROM broadcast_deliveries WHERE job_id = ? GROUP BY status
+        ''', (job_id,)).fetchall()
+        return dict(rows)
+
+    def finish_job(self, job_id: int, status: str):
+        now = datetime.datetime.now().isoformat()
+        with self.pool.transaction() as conn:
+            conn.execute('UPDATE broadcast_jobs SET status = ?, finished_at = ? WHERE id = ?', (status, now, job_id))
+
+
+class PhotoStore:
+    """Соответствие URL фотографии и file_id, который Telegram вернул после загрузки (таблица — из миграции v4)"""
+
+    def __init__(self, pool: ConnectionManager):
+        self.pool = pool
+
+    def load_all(self) -> Dict[str, str]:
+        return dict(self.pool.execute('SELECT url, file_id FROM photo_cache').fetchall())
+
+    def save(self, url: str, file_id: str):
         current_time = datetime.datetime.now().isoformat()
-        cursor.execute('''
-            INSERT INTO orders (user_id, user_name, user_phone, user_email, bike_model, frame_size, created_at)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-        ''', (user_id, user_name, user_phone, user_email, bike_model, frame_size, current_time))
-        
-        conn.commit()
-        conn.close()
+        self.pool.execute('''
+            INSERT INTO photo_cache (url, file_id, updated_at) VALUES (?, ?, ?)
+            ON CONFLICT(url) DO UPDATE SET file_id = excluded.file_id, updated_at = excluded.updated_at
+        ''', (url, file_id, current_time))
 
-    def get_user_stats(self):
-        """Получение статистики пользователей"""
-        conn = sqlite3.connect(self.db_name)
-        cursor = conn.cursor()
-        
-        # Общее количество пользователей
-        cursor.execute('SELECT COUNT(*) FROM users')
-        total_users = cursor.fetchone()[0]
-        
-        # Активные за сегодня
-        today = datetime.datetime.now().date().isoformat()
-        cursor.execute('SELECT COUNT(*) FROM users WHERE date(last_active) = ?', (today,))
-        active_today = cursor.fetchone()[0]
-        
-        # Новые пользователи за сегодня
-        cursor.execute('SELECT COUNT(*) FROM users WHERE date(created_at) = ?', (today,))
-        new_today = cursor.fetchone()[0]
-        
-        conn.close()
-        
-        return {
-            'total_users': total_users,
-            'active_today': active_today,
-            'new_today': new_today
-        }
-
-    def get_all_users(self):
-        """Получение списка всех пользователей"""
-        conn = sqlite3.connect(self.db_name)
-        cursor = conn.cursor()
-        
-        cursor.execute('SELECT user_id, username, first_name, last_name FROM users ORDER BY created_at DESC')
-        users = cursor.fetchall()
-        
-        conn.close()
-        return users
+    def delete(self, url: str):
+        self.pool.execute('DELETE FROM photo_cache WHERE url = ?', (url,))
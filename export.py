@@ -0,0 +1,68 @@
+import csv
+import datetime
+import gzip
+import io
+import os
+import tempfile
+from typing import Optional, Tuple
+
+from database import Database
+
+EXPORT_TITLES = {
+    'users': "Пользователи",
+    'orders': "Заказы",
+}
+
+# С этих символов Excel начинает формулу; имена и контакты пишут сами пользователи
+FORMULA_PREFIXES = ("=", "+", "-", "@", "\t", "\r")
+
+
+def _safe_cell(value):
+    if isinstance(value, str) and value.startswith(FORMULA_PREFIXES):
+        return "'" + value
+    return value
+
+
+def parse_period(args) -> Tuple[Optional[str], Optional[str]]:
+    """Даты «с» и «по» (ГГГГ-ММ-ДД, обе включительно) -> границы для Database.export_rows"""
+    since = until = None
+    if len(args) > 0:
+        since = datetime.date.fromisoformat(args[0]).isoformat()
+    if len(args) > 1:
+        until = (datetime.date.fromisoformat(args[1]) + datetime.timedelta(days=1)).isoformat()
+    return since, until
+
+
+def export_csv_gz(db: Database, table: str, since: Optional[str] = None, until: Optional[str] = None,
+                  chunk_size: int = 1000, directory: Optional[str] = None) -> Tuple[str, int]:
+    """Выгрузить таблицу в gzip CSV во временный файл; возвращает путь и число строк.
+
+    Строки идут из курсора порциями и сразу пишутся в сжатый поток, так что память
+    не зависит от размера таблицы. Файл удаляет вызывающий.
+    """
+    fd, path = tempfile.mkstemp(prefix=f"{table}_", suffix=".csv.gz", dir=directory)
+    count = 0
+    try:
+        with os.fdopen(fd, "wb") as raw, gzip.GzipFile(fileobj=raw, mode="wb", compresslevel=6) as gz, \
+                io.TextIOWrapper(gz, encoding="utf-8-sig", newline="") as text:
+            # utf-8-sig — чтобы Excel сразу открыл кириллицу
+            writer = csv.writer(text)
+            header, chunks = db.export_rows(table, since, until, chunk_size)
+            writer.writerow(header)
+            for rows in chunks:
+                writer.writerows([[_safe_cell(value) for value in row] for row in rows])
+                count += len(rows)
+    except BaseException:
+        os.unlink(path)
+        raise
+    return path, count
+
+
+def export_filename(table: str, since: Optional[str], until: Optional[str]) -> str:
+    name = table
+    if since:
+        name += f"_from_{since}"
+    if until:
+        last_day = datetime.date.fromisoformat(until) - datetime.timedelta(days=1)
+        name += f"_to_{last_day.isoformat()}"
+    return f"{name}.csv.gz"
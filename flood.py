@@ -0,0 +1,136 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, Hashable, Iterable, Optional
+
+from telebot import types
+from telebot.handler_backends import BaseMiddleware, CancelUpdate
+
+logger = logging.getLogger(__name__)
+
+
+class FloodControl(BaseMiddleware):
+    """Ограничение частоты апдейтов от одного пользователя до хэндлеров.
+
+    У каждого пользователя свой token bucket: rate апдейтов в секунду, запас burst.
+    Состояние — список [токены, время, когда предупреждали] в OrderedDict,
+    не больше max_users записей: давно молчавшие вытесняются первыми, а их
+    bucket и так был бы полным. Лишние апдейты отбрасываются (CancelUpdate),
+    пользователь получает on_throttle не чаще раза в notice_interval секунд.
+    Остальные отброшенные апдейты передаются в on_drop — например, чтобы молча
+    ответить на callback, иначе у кнопки крутится индикатор загрузки до таймаута.
+    """
+
+    def __init__(self, rate: float = 1.0, burst: float = 5.0, max_users: int = 10000,
+                 notice_interval: float = 10.0, exempt: Iterable[int] = (),
+                 on_throttle: Optional[Callable] = None, on_drop: Optional[Callable] = None):
+        super().__init__()
+        self.update_types = ['message', 'callback_query']
+        self.rate = rate
+        self.burst = burst
+        self.max_users = max_users
+        self.notice_interval = notice_interval
+        self.exempt = frozenset(exempt)
+        self.on_throttle = on_throttle
+        self.on_drop = on_drop
+        self._users: "OrderedDict[int, list]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.throttled: Dict[str, int] = {'message': 0, 'callback_query': 0}
+        self.notices = 0
+
+    def allow(self, user_id: int):
+        """(пропустить ли апдейт, нужно ли предупредить пользователя)"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._users.get(user_id)
+            if entry is None:
+                entry = self._users[user_id] = [self.burst, now, 0.0]
+                if len(self._users) > self.max_users:
+                    self._users.popitem(last=False)
+            else:
+                self._users.move_to_end(user_id)
+                entry[0] = min(self.burst, entry[0] + (now - entry[1]) * self.rate)
+                entry[1] = now
+            if entry[0] >= 1:
+                entry[0] -= 1
+                return True, False
+            if now - entry[2] >= self.notice_interval:
+                entry[2] = now
+                return False, True
+            return False, False
+
+    def pre_process(self, update, data):
+        user = getattr(update, 'from_user', None)
+        if user is None or user.id in self.exempt:
+            return None
+        allowed, notice = self.allow(user.id)
+        if allowed:
+            return None
+        kind = 'callback_query' if isinstance(update, types.CallbackQuery) else 'message'
+        with self._lock:
+            self.throttled[kind] += 1
+            if notice:
+                self.notices += 1
+        handler = self.on_throttle if notice else self.on_drop
+        if handler is not None:
+            try:
+                handler(update)
+            except Exception as e:
+                logger.warning("Не удалось ответить пользователю %s на отброшенный апдейт: %s", user.id, e)
+        return CancelUpdate()
+
+    def post_process(self, update, data, exception):
+        pass
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'users': len(self._users),
+            'throttled_messages': self.throttled['message'],
+            'throttled_callbacks': self.throttled['callback_query'],
+            'notices': self.notices,
+        }
+
+
+class Coalescer:
+    """Схлопывание частых действий по ключу: первое выполняется сразу, а всё, что
+    пришло за следующие window секунд, — одним последним вызовом в конце окна.
+
+    Для карусели: пять быстрых «След» дают две перерисовки, а не пять.
+    """
+
+    def __init__(self, window: float = 0.7):
+        self.window = window
+        self._pending: Dict[Hashable, Optional[Callable]] = {}  # None — окно открыто, отложенного вызова нет
+        self._lock = threading.Lock()
+        self.coalesced = 0
+
+    def submit(self, key: Hashable, fn: Callable):
+        with self._lock:
+            if key in self._pending:
+                if self._pending[key] is not None:
+                    self.coalesced += 1  # предыдущий отложенный вызов так и не понадобился
+                self._pending[key] = fn
+                return
+            self._pending[key] = None
+        try:
+            fn()
+        finally:
+            self._arm(key)
+
+    def _arm(self, key: Hashable):
+        timer = threading.Timer(self.window, self._flush, args=(key,))
+        timer.daemon = True
+        timer.start()
+
+    def _flush(self, key: Hashable):
+        with self._lock:
+            fn = self._pending.get(key)
+            if fn is None:
+                self._pending.pop(key, None)
+                return
+            self._pending[key] = None
+        try:
+            fn()
+        finally:
+            self._arm(key)
@@ -0,0 +1,323 @@
+import bisect
+import functools
+import hmac
+import logging
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Optional, Tuple
+
+from telebot import apihelper
+from telebot.apihelper import ApiTelegramException
+from telebot.handler_backends import BaseMiddleware
+
+logger = logging.getLogger(__name__)
+
+# Границы корзин гистограмм, секунды: от миллисекунд SQLite до долгих запросов к API
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+LabelValues = Tuple[str, ...]
+
+
+class _Histogram:
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self, size: int):
+        self.counts = [0] * size  # последняя корзина — +Inf
+        self.sum = 0.0
+        self.count = 0
+
+
+class _Timer:
+    __slots__ = ("metrics", "name", "labels", "started")
+
+    def __init__(self, metrics: "Metrics", name: str, labels: LabelValues):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.metrics.observe(self.name, time.perf_counter() - self.started, *self.labels)
+        return False
+
+
+class _NoopTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NOOP = _NoopTimer()
+
+
+class Metrics:
+    """Счётчики и гистограммы в памяти процесса с выдачей в текстовом формате Prometheus.
+
+    Метрика сначала объявляется через describe (тип, описание, имена меток),
+    потом обновляется по значениям меток: inc/observe/timer. Значения, которые
+    и так считают другие компоненты (очереди, рассылки), не дублируются —
+    они снимаются функцией collect в момент выдачи.
+    С enabled=False все вызовы сразу возвращаются, а timer отдаёт общий пустой
+    контекстный менеджер — остаётся только вызов метода.
+    """
+
+    def __init__(self, enabled: bool = True, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.enabled = enabled
+        self.buckets = tuple(buckets)
+        self._meta: Dict[str, Tuple[str, str, Tuple[str, ...]]] = {}  # имя -> (тип, описание, метки)
+        self._values: Dict[Tuple[str, LabelValues], float] = {}
+        self._histograms: Dict[Tuple[str, LabelValues], _Histogram] = {}
+        self._collectors: Dict[str, Callable] = {}
+        self._lock = threading.Lock()
+
+    # === ОБЪЯВЛЕНИЕ ===
+    def describe(self, name: str, kind: str, help: str, labels: Tuple[str, ...] = ()):
+        self._meta[name] = (kind, help, tuple(labels))
+
+    def collect(self, name: str, kind: str, help: str, fn: Callable, labels: Tuple[str, ...] = ()):
+        """Значение снимается при выдаче: fn() -> число или {значения меток: число}"""
+        self.describe(name, kind, help, labels)
+        self._collectors[name] = fn
+
+    # === ОБНОВЛЕНИЕ ===
+    def inc(self, name: str, *labels: str, value: float = 1):
+        if not self.enabled:
+            return
+        key = (name, labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def observe(self, name: str, seconds: float, *labels: str):
+        if not self.enabled:
+            return
+        key = (name, labels)
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            hist = self._histograms.get(key)
+            if hist is None:
+                hist = self._histograms[key] = _Histogram(len(self.buckets) + 1)
+            hist.counts[index] += 1
+            hist.sum += seconds
+            hist.count += 1
+
+    def timer(self, name: str, *labels: str):
+        if not self.enabled:
+            return _NOOP
+        return _Timer(self, name, labels)
+
+    def timed(self, fn: Callable) -> Callable:
+        """Декоратор хэндлера: время попадает в bot_handler_seconds с именем функции"""
+        name = fn.__name__
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with self.timer('bot_handler_seconds', name):
+                return fn(*args, **kwargs)
+        return wrapper
+
+    # === ЧТЕНИЕ ===
+    def histogram(self, name: str) -> Dict[LabelValues, Tuple[int, float, float]]:
+        """{метки: (количество, среднее, p99)} для экрана в админке"""
+        with self._lock:
+            items = [(key[1], list(h.counts), h.sum, h.count) for key, h in self._histograms.items() if key[0] == name]
+        return {labels: (count, total / count, self._quantile(counts, count, 0.99))
+                for labels, counts, total, count in items if count}
+
+    def counter(self, name: str) -> Dict[LabelValues, float]:
+        with self._lock:
+            return {key[1]: value for key, value in self._values.items() if key[0] == name}
+
+    def _quantile(self, counts: List[int], count: int, q: float) -> float:
+        """Оценка квантиля по корзинам: линейно внутри корзины, как histogram_quantile"""
+        rank = q * count
+        seen = 0
+        for i, n in enumerate(counts):
+            if seen + n >= rank and n:
+                if i == len(self.buckets):
+                    return self.buckets[-1]
+                lower = self.buckets[i - 1] if i else 0.0
+                return lower + (self.buckets[i] - lower) * (rank - seen) / n
+            seen += n
+        return 0.0
+
+    def render(self) -> str:
+        """Все метрики в текстовом формате Prometheus 0.0.4"""
+        with self._lock:
+            values = dict(self._values)
+            histograms = {key: (list(h.counts), h.sum, h.count) for key, h in self._histograms.items()}
+        collected = {}
+        for name, fn in list(self._collectors.items()):
+            try:
+                collected[name] = fn()
+            except Exception as e:
+                logger.warning("Не удалось снять метрику %s: %s", name, e)
+        lines = []
+        for name, (kind, help, label_names) in self._meta.items():
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            if name in collected:
+                value = collected[name]
+                series = value.items() if isinstance(value, dict) else [((), value)]
+                for labels, v in series:
+                    labels = labels if isinstance(labels, tuple) else (labels,)
+                    lines.append(f"{name}{_labels(label_names, labels)} {_number(v)}")
+            elif kind == 'histogram':
+                for (metric, labels), (counts, total, count) in histograms.items():
+                    if metric != name:
+                        continue
+                    cumulative = 0
+                    for bound, n in zip(self.buckets + (float("inf"),), counts):
+                        cumulative += n
+                        le = "+Inf" if bound == float("inf") else repr(bound)
+                        lines.append(f"{name}_bucket{_labels(label_names + ('le',), labels + (le,))} {cumulative}")
+                    lines.append(f"{name}_sum{_labels(label_names, labels)} {_number(total)}")
+                    lines.append(f"{name}_count{_labels(label_names, labels)} {count}")
+            else:
+                for (metric, labels), v in values.items():
+                    if metric == name:
+                        lines.append(f"{name}{_labels(label_names, labels)} {_number(v)}")
+        return "\n".join(lines) + "\n"
+
+
+def _labels(names: Tuple[str, ...], values: LabelValues) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(f'{n}="{_escape(str(v))}"' for n, v in zip(names, values))
+    return "{" + pairs + "}"
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _number(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+# === ИСТОЧНИКИ ===
+class UpdateTimer(BaseMiddleware):
+    """Полное время обработки апдейта — от middleware до конца хэндлера, по типу апдейта"""
+
+    def __init__(self, metrics: Metrics):
+        super().__init__()
+        self.update_types = ['message', 'callback_query', 'inline_query']
+        self.metrics = metrics
+
+    def pre_process(self, update, data):
+        data['_started'] = time.perf_counter()
+
+    def post_process(self, update, data, exception):
+        started = data.get('_started')
+        if started is None:
+            return
+        kind = type(update).__name__
+        self.metrics.observe('bot_update_seconds', time.perf_counter() - started, kind)
+        if exception is not None:
+            self.metrics.inc('bot_update_errors_total', kind)
+
+
+def instrument_api(metrics: Metrics):
+    """Засекать каждый запрос к Bot API: у pyTelegramBotAPI все методы идут через apihelper._make_request.
+
+    Функция приватная, поэтому аргументы передаются как есть: из них читается
+    только имя метода (второй позиционный или method_name).
+    """
+    original = apihelper._make_request
+    if getattr(original, '_instrumented', False):
+        return
+
+    @functools.wraps(original)
+    def _make_request(*args, **kwargs):
+        method_name = args[1] if len(args) > 1 else kwargs.get('method_name', 'unknown')
+        started = time.perf_counter()
+        try:
+            return original(*args, **kwargs)
+        except ApiTelegramException as e:
+            metrics.inc('bot_api_errors_total', method_name, str(e.error_code))
+            raise
+        except Exception:
+            metrics.inc('bot_api_errors_total', method_name, 'network')
+            raise
+        finally:
+            metrics.observe('bot_api_request_seconds', time.perf_counter() - started, method_name)
+
+    _make_request._instrumented = True
+    apihelper._make_request = _make_request
+
+
+def describe_defaults(metrics: Metrics):
+    """Метрики, которые обновляют сами компоненты бота"""
+    metrics.describe('bot_update_seconds', 'histogram', "Update processing time", ('type',))
+    metrics.describe('bot_update_errors_total', 'counter', "Updates whose handler raised", ('type',))
+    metrics.describe('bot_handler_seconds', 'histogram', "Handler latency", ('handler',))
+    metrics.describe('bot_db_query_seconds', 'histogram', "SQLite statement or transaction time", ('op',))
+    metrics.describe('bot_api_request_seconds', 'histogram', "Bot API request latency", ('method',))
+    metrics.describe('bot_api_errors_total', 'counter', "Failed Bot API requests by error code", ('method', 'code'))
+
+
+# === HTTP ===
+class MetricsServer:
+    """Отдельный HTTP-сервер для /metrics, не на публичном порту вебхука.
+
+    По умолчанию слушает только localhost; если открыть его шире (host="::" для
+    внутренней сети хостинга), задайте token — тогда без заголовка
+    «Authorization: Bearer <token>» сервер отвечает 401.
+    """
+
+    def __init__(self, metrics: Metrics, host: str = "127.0.0.1", port: int = 9100, token: Optional[str] = None):
+        self.metrics = metrics
+        self.token = f"Bearer {token}".encode() if token else None
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def _empty(self, code: int):
+                self.send_response(code)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self._empty(404)
+                    return
+                if server.token is not None:
+                    given = (self.headers.get("Authorization") or "").encode()
+                    if not hmac.compare_digest(given, server.token):
+                        self._empty(401)
+                        return
+                body = server.metrics.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", CONTENT_TYPE)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server_class = ThreadingHTTPServer
+        if ":" in host:
+            server_class = type("ThreadingHTTPServer6", (ThreadingHTTPServer,), {'address_family': socket.AF_INET6})
+        self._httpd = server_class((host, port), Handler)
+        self._httpd.daemon_threads = True
+
+    @property
+    def port(self) -> int:
+        return self._httpd.server_address[1]
+
+    def start(self):
+        threading.Thread(target=self._httpd.serve_forever, name="metrics-http", daemon=True).start()
+        logger.info("Метрики: http://%s:%s/metrics", *self._httpd.server_address[:2])
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
@@ -0,0 +1,238 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+from collections import deque
+from typing import Callable, Deque, Dict, List, Optional, Tuple
+
+from ratelimit import TokenBucket, retry_after
+
+logger = logging.getLogger(__name__)
+
+MAX_MESSAGE_LENGTH = 4096
+_DIGEST_SEPARATOR = "\n\n———\n\n"
+
+
+class _Task:
+    __slots__ = ("fn", "args", "kwargs", "attempts")
+
+    def __init__(self, fn: Callable, args: tuple, kwargs: dict):
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.attempts = 0
+
+
+class _Chat:
+    """Очередь одного чата и его собственный token bucket (без блокировок — под общим lock)"""
+
+    __slots__ = ("tasks", "tokens", "updated", "not_before", "scheduled", "busy")
+
+    def __init__(self, burst: float, now: float):
+        self.tasks: Deque[_Task] = deque()
+        self.tokens = burst
+        self.updated = now
+        self.not_before = 0.0
+        self.scheduled = False
+        self.busy = False
+
+
+class Outbox:
+    """Исходящие сообщения: хэндлер ставит отправку в очередь и сразу возвращается.
+
+    Порядок внутри чата сохраняется — чат в каждый момент обслуживает не больше
+    одного воркера. Частоту ограничивают два bucket'а: свой на чат (Telegram
+    просит не чаще ~1 сообщения в секунду) и общий на бота, тот же, что у
+    рассылок. На 429 чат откладывается на retry_after, общий bucket ставится
+    на паузу, а сообщение отправляется повторно.
+    """
+
+    def __init__(self, bot, bucket: TokenBucket, workers: int = 4, chat_rate: float = 1.0,
+                 chat_burst: float = 3.0, max_retries: int = 3, max_per_chat: int = 50,
+                 coalesce_window: float = 3.0):
+        self.bot = bot
+        self.bucket = bucket
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.max_per_chat = max_per_chat
+        self.coalesce_window = coalesce_window
+        self._chats: Dict[int, _Chat] = {}
+        self._ready: List[Tuple[float, int, int]] = []  # (когда можно, порядковый номер, chat_id)
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._stopping = False
+        self._swept = time.monotonic()
+        self._digests: Dict[int, List[str]] = {}
+        self._digest_sent: Dict[int, float] = {}
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self._threads = [
+            threading.Thread(target=self._worker, name=f"outbox-{i}", daemon=True) for i in range(workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    # === ПОСТАНОВКА В ОЧЕРЕДЬ ===
+    def submit(self, chat_id: int, fn: Callable, *args, **kwargs) -> bool:
+        """Поставить вызов fn(*args, **kwargs) в очередь чата; False — очередь чата переполнена"""
+        with self._cond:
+            now = time.monotonic()
+            chat = self._chats.get(chat_id)
+            if chat is None:
+                chat = self._chats[chat_id] = _Chat(self.chat_burst, now)
+            if len(chat.tasks) >= self.max_per_chat:
+                self.dropped += 1
+                logger.warning("Очередь чата %s переполнена, сообщение отброшено", chat_id)
+                return False
+            chat.tasks.append(_Task(fn, args, kwargs))
+            self._schedule(chat_id, chat, now)
+            if now - self._swept >= 60:
+                self._sweep(now)
+        return True
+
+    def send_message(self, chat_id: int, text: str, **kwargs) -> bool:
+        return self.submit(chat_id, self.bot.send_message, chat_id, text, **kwargs)
+
+    def notify(self, chat_id: int, text: str) -> bool:
+        """Служебное уведомление (админу): первое уходит сразу, всплеск за coalesce_window склеивается в одно"""
+        with self._cond:
+            now = time.monotonic()
+            pending = self._digests.get(chat_id)
+            if pending is not None:
+                pending.append(text)
+                self.coalesced += 1
+                return True
+            if now - self._digest_sent.get(chat_id, float("-inf")) >= self.coalesce_window:
+                self._digest_sent[chat_id] = now
+                return self.submit(chat_id, self.bot.send_message, chat_id, text)
+            self._digests[chat_id] = [text]
+            delay = self._digest_sent[chat_id] + self.coalesce_window - now
+        timer = threading.Timer(delay, self._flush_digest, args=(chat_id,))
+        timer.daemon = True
+        timer.start()
+        return True
+
+    def _flush_digest(self, chat_id: int):
+        with self._cond:
+            texts = self._digests.pop(chat_id, None)
+            self._digest_sent[chat_id] = time.monotonic()
+        if not texts:
+            return
+        for chunk in _pack(texts):
+            self.submit(chat_id, self.bot.send_message, chat_id, chunk)
+
+    def _schedule(self, chat_id: int, chat: _Chat, now: float):
+        """Поставить чат в очередь готовности к моменту, когда у него будет токен (под lock)"""
+        if chat.scheduled or chat.busy or not chat.tasks:
+            return
+        chat.tokens = min(self.chat_burst, chat.tokens + (now - chat.updated) * self.chat_rate)
+        chat.updated = now
+        due = max(chat.not_before, now if chat.tokens >= 1 else now + (1 - chat.tokens) / self.chat_rate)
+        heapq.heappush(self._ready, (due, next(self._seq), chat_id))
+        chat.scheduled = True
+        self._cond.notify()
+
+    def _sweep(self, now: float):
+        """Забыть простаивающие чаты с полным bucket'ом — их состояние ничем не отличается от нового (под lock)"""
+        self._swept = now
+        idle = [chat_id for chat_id, chat in self._chats.items()
+                if not chat.tasks and not chat.busy and now >= chat.not_before
+                and chat.tokens + (now - chat.updated) * self.chat_rate >= self.chat_burst]
+        for chat_id in idle:
+            del self._chats[chat_id]
+
+    # === ВОРКЕРЫ ===
+    def _next(self) -> Optional[Tuple[int, _Chat, _Task]]:
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                if self._ready and self._ready[0][0] <= now:
+                    _, _, chat_id = heapq.heappop(self._ready)
+                    chat = self._chats[chat_id]
+                    chat.scheduled = False
+                    chat.busy = True
+                    chat.tokens -= 1
+                    return chat_id, chat, chat.tasks[0]
+                if self._stopping and not self._ready:
+                    return None
+                self._cond.wait(self._ready[0][0] - now if self._ready else None)
+
+    def _worker(self):
+        while True:
+            item = self._next()
+            if item is None:
+                return
+            chat_id, chat, task = item
+            self.bucket.acquire()
+            task.attempts += 1
+            wait = None
+            try:
+                task.fn(*task.args, **task.kwargs)
+                outcome = 'sent'
+            except Exception as e:
+                wait = retry_after(e)
+                if wait is not None and task.attempts <= self.max_retries:
+                    outcome = 'retry'
+                    self.bucket.pause(wait)
+                else:
+                    outcome = 'failed'
+                    logger.warning("Не удалось отправить в чат %s: %s", chat_id, e)
+            with self._cond:
+                now = time.monotonic()
+                chat.busy = False
+                if outcome == 'retry':
+                    self.retried += 1
+                    chat.not_before = now + wait
+                else:
+                    chat.tasks.popleft()
+                    if outcome == 'sent':
+                        self.sent += 1
+                    else:
+                        self.failed += 1
+                if chat.tasks:
+                    self._schedule(chat_id, chat, now)
+                if self._stopping:
+                    self._cond.notify_all()
+
+    def stop(self, timeout: float = 10.0):
+        """Дождаться отправки уже поставленных сообщений и остановить воркеры"""
+        for chat_id in list(self._digests):
+            self._flush_digest(chat_id)
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+        deadline = time.monotonic() + timeout
+        for thread in self._threads:
+            thread.join(max(0.0, deadline - time.monotonic()))
+
+    def stats(self) -> Dict[str, int]:
+        with self._cond:
+            return {
+                'queued': sum(len(chat.tasks) for chat in self._chats.values()),
+                'chats': len(self._chats),
+                'sent': self.sent,
+                'failed': self.failed,
+                'retried': self.retried,
+                'dropped': self.dropped,
+                'coalesced': self.coalesced,
+            }
+
+
+def _pack(texts: List[str]) -> List[str]:
+    """Склеить уведомления в сообщения не длиннее лимита Telegram"""
+    chunks, current = [], ""
+    for text in texts:
+        text = text[:MAX_MESSAGE_LENGTH]
+        candidate = current + _DIGEST_SEPARATOR + text if current else text
+        if len(candidate) > MAX_MESSAGE_LENGTH:
+            chunks.append(current)
+            candidate = text
+        current = candidate
+    if current:
+        chunks.append(current)
+    return chunks
@@ -0,0 +1,116 @@
+import logging
+import threading
+from typing import Dict, Iterable, Optional
+
+from telebot import types
+from telebot.apihelper import ApiTelegramException
+
+from database import PhotoStore
+
+logger = logging.getLogger(__name__)
+
+
+class PhotoCache:
+    """Кэш file_id фотографий каталога.
+
+    Первый раз фото уходит по URL, Telegram скачивает его и возвращает file_id;
+    дальше отправляем уже file_id — без повторной загрузки с tildacdn.
+    """
+
+    def __init__(self, store: PhotoStore):
+        self.store = store
+        self._file_ids: Dict[str, str] = store.load_all()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.uploads = 0
+        self.errors = 0
+
+    def get(self, url: str) -> Optional[str]:
+        file_id = self._file_ids.get(url)
+        with self._lock:
+            if file_id:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return file_id
+
+    def remember(self, url: str, message) -> Optional[str]:
+        """Сохранить file_id из ответа Telegram на отправку фото"""
+        photos = getattr(message, 'photo', None)
+        if not photos:
+            return None
+        # Берём самый крупный вариант — из него Telegram сам делает превью
+        file_id = photos[-1].file_id
+        if self._file_ids.get(url) != file_id:
+            self._file_ids[url] = file_id
+            self.store.save(url, file_id)
+        return file_id
+
+    def forget(self, url: str):
+        if self._file_ids.pop(url, None) is not None:
+            self.store.delete(url)
+
+    def media(self, url: str) -> str:
+        """Что передавать в Telegram: file_id из кэша или исходный URL"""
+        return self.get(url) or url
+
+    def send_photo(self, bot, chat_id: int, url: str, **kwargs):
+        """send_photo с подстановкой file_id; протухший file_id сбрасывается и фото уходит по URL"""
+        file_id = self.get(url)
+        if file_id:
+            try:
+                return bot.send_photo(chat_id, file_id, **kwargs)
+            except ApiTelegramException as e:
+                if e.error_code != 400:
+                    raise
+                logger.warning("file_id для %s не принят (%s), загружаем заново", url, e.description)
+                with self._lock:
+                    self.errors += 1
+                self.forget(url)
+        message = bot.send_photo(chat_id, url, **kwargs)
+        with self._lock:
+            self.uploads += 1
+        self.remember(url, message)
+        return message
+
+    def edit_photo(self, bot, chat_id: int, message_id: int, url: str, caption: Optional[str] = None,
+                   parse_mode: Optional[str] = None, reply_markup=None):
+        """Заменить фото, подпись и клавиатуру существующего сообщения одним edit_message_media"""
+        source = self.media(url)
+        media = types.InputMediaPhoto(source, caption=caption, parse_mode=parse_mode)
+        result = bot.edit_message_media(media, chat_id, message_id, reply_markup=reply_markup)
+        if source == url:
+            with self._lock:
+                self.uploads += 1
+            self.remember(url, result)
+        return result
+
+    def warm_up(self, bot, chat_id: int, urls: Iterable[str]) -> int:
+        """Заранее загрузить фото в служебный чат, чтобы первый просмотр каталога уже шёл по file_id"""
+        uploaded = 0
+        for url in urls:
+            if url in self._file_ids:
+                continue
+            try:
+                message = bot.send_photo(chat_id, url, disable_notification=True)
+                self.remember(url, message)
+                uploaded += 1
+                try:
+                    bot.delete_message(chat_id, message.message_id)
+                except Exception:
+                    pass
+            except Exception as e:
+                logger.warning("Не удалось прогреть %s: %s", url, e)
+        with self._lock:
+            self.uploads += uploaded
+        return uploaded
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            'cached': len(self._file_ids),
+            'hits': self.hits,
+            'misses': self.misses,
+            'uploads': self.uploads,
+            'errors': self.errors,
+        }
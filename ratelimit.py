@@ -0,0 +1,72 @@
+import threading
+import time
+from typing import Optional
+
+from telebot.apihelper import ApiTelegramException
+
+
+class TokenBucket:
+    """Потокобезопасный token bucket: rate токенов в секунду, запас до capacity"""
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float):
+        if now > self._updated:
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+
+    def _reserve(self, tokens: float) -> float:
+        """Пытается взять токены; возвращает 0 при успехе или сколько ждать"""
+        with self._lock:
+            now = time.monotonic()
+            if now < self._paused_until:
+                return self._paused_until - now
+            self._refill(now)
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                return 0.0
+            return (tokens - self._tokens) / self.rate
+
+    def try_acquire(self, tokens: float = 1) -> bool:
+        return self._reserve(tokens) == 0.0
+
+    def acquire(self, tokens: float = 1, timeout: Optional[float] = None,
+                cancel: Optional[threading.Event] = None) -> bool:
+        """Блокирует, пока не появятся токены. False — если истёк timeout или выставлен cancel"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            wait = self._reserve(tokens)
+            if wait == 0.0:
+                return True
+            if deadline is not None:
+                left = deadline - time.monotonic()
+                if left <= 0:
+                    return False
+                wait = min(wait, left)
+            if cancel is not None:
+                if cancel.wait(wait):
+                    return False
+            else:
+                time.sleep(wait)
+
+    def pause(self, seconds: float):
+        """Остановить выдачу токенов (после 429 от Telegram)"""
+        with self._lock:
+            now = time.monotonic()
+            self._paused_until = max(self._paused_until, now + seconds)
+            self._tokens = 0.0
+            self._updated = max(self._updated, self._paused_until)
+
+
+def retry_after(exc: BaseException) -> Optional[float]:
+    """Сколько секунд просит подождать Telegram (429 Too Many Requests), иначе None"""
+    if not isinstance(exc, ApiTelegramException) or exc.error_code != 429:
+        return None
+    params = (exc.result_json or {}).get('parameters') or {}
+    return float(params.get('retry_after', 1))
@@ -0,0 +1,213 @@
+import json
+import threading
+from contextlib import contextmanager
+from typing import Dict, Hashable, Iterable, List, Optional, Tuple
+
+import redis
+from telebot.storage.base_storage import StateDataContext, StateStorageBase
+
+from sessions import SessionBackend
+
+
+class _Batch:
+    """Единица работы на один апдейт: прочитанные ключи и отложенные записи"""
+
+    def __init__(self):
+        self.cache: Dict[str, object] = {}
+        self.ops: List[Tuple] = []
+
+
+class RedisConnection:
+    """Общий клиент Redis поверх пула соединений.
+
+    Внутри batch() всё, что хэндлер читает, кэшируется, а записи копятся и
+    уходят одним pipeline при выходе — так на апдейт приходится один запрос
+    на чтение (с предзагрузкой) и один на запись.
+    """
+
+    def __init__(self, pool: "redis.ConnectionPool", prefix: str = "bot"):
+        self.redis = redis.Redis(connection_pool=pool)
+        self.prefix = prefix
+        self._local = threading.local()
+
+    def key(self, *parts) -> str:
+        return ":".join([self.prefix, *map(str, parts)])
+
+    @property
+    def _batch(self) -> Optional[_Batch]:
+        return getattr(self._local, 'batch', None)
+
+    @contextmanager
+    def batch(self, prefetch: Iterable[Tuple[str, str]] = ()):
+        """prefetch — пары (тип, ключ), тип 'hash' или 'string', читаются одним pipeline"""
+        if self._batch is not None:
+            yield self._batch
+            return
+        batch = _Batch()
+        prefetch = list(prefetch)
+        if prefetch:
+            pipe = self.redis.pipeline(transaction=False)
+            for kind, key in prefetch:
+                pipe.hgetall(key) if kind == 'hash' else pipe.get(key)
+            for (kind, key), value in zip(prefetch, pipe.execute()):
+                batch.cache[key] = _decode(value)
+        self._local.batch = batch
+        try:
+            yield batch
+        finally:
+            self._local.batch = None
+            self._flush(batch)
+
+    def _flush(self, batch: _Batch):
+        if not batch.ops:
+            return
+        pipe = self.redis.pipeline(transaction=False)
+        for op, *args in batch.ops:
+            getattr(pipe, op)(*args)
+        pipe.execute()
+
+    def _execute(self, *ops: Tuple):
+        batch = self._batch
+        if batch is not None:
+            batch.ops.extend(ops)
+            return
+        if len(ops) == 1:
+            op, *args = ops[0]
+            getattr(self.redis, op)(*args)
+            return
+        pipe = self.redis.pipeline(transaction=False)
+        for op, *args in ops:
+            getattr(pipe, op)(*args)
+        pipe.execute()
+
+    # === ЧТЕНИЕ С КЭШЕМ БАТЧА ===
+    def read_hash(self, key: str) -> Dict[str, str]:
+        batch = self._batch
+        if batch is not None and key in batch.cache:
+            return batch.cache[key]
+        value = _decode(self.redis.hgetall(key))
+        if batch is not None:
+            batch.cache[key] = value
+        return value
+
+    def read_string(self, key: str) -> Optional[str]:
+        batch = self._batch
+        if batch is not None and key in batch.cache:
+            return batch.cache[key]
+        value = _decode(self.redis.get(key))
+        if batch is not None:
+            batch.cache[key] = value
+        return value
+
+    # === ЗАПИСЬ ===
+    def write_hash(self, key: str, mapping: Dict[str, str], ttl: int, setnx: Optional[Dict[str, str]] = None):
+        current = dict(self.read_hash(key)) if self._batch is not None else None
+        ops = [('hset', key, None, None, mapping)]
+        for field, value in (setnx or {}).items():
+            ops.append(('hsetnx', key, field, value))
+        ops.append(('expire', key, ttl))
+        if current is not None:
+            for field, value in (setnx or {}).items():
+                current.setdefault(field, value)
+            current.update(mapping)
+            self._batch.cache[key] = current
+        self._execute(*ops)
+
+    def write_string(self, key: str, value: str, ttl: int):
+        if self._batch is not None:
+            self._batch.cache[key] = value
+        self._execute(('set', key, value, ttl))
+
+    def delete(self, key: str, empty=None):
+        if self._batch is not None:
+            self._batch.cache[key] = empty
+        self._execute(('delete', key))
+
+
+def _decode(value):
+    if value is None:
+        return None
+    if isinstance(value, bytes):
+        return value.decode("utf-8")
+    if isinstance(value, dict):
+        return {_decode(k): _decode(v) for k, v in value.items()}
+    return value
+
+
+class RedisStateStorage(StateStorageBase):
+    """Хранилище FSM TeleBot в Redis: состояние и данные — поля одного hash с TTL"""
+
+    def __init__(self, conn: RedisConnection, ttl: int = 86400, bot_id: Optional[int] = None):
+        super().__init__()
+        self.conn = conn
+        self.ttl = int(ttl)
+        self.bot_id = bot_id
+
+    def _key(self, chat_id, user_id, business_connection_id=None, message_thread_id=None, bot_id=None) -> str:
+        return self._get_key(chat_id, user_id, self.conn.key("state"), ":",
+                             business_connection_id, message_thread_id, bot_id)
+
+    def prefetch_key(self, chat_id, user_id) -> Tuple[str, str]:
+        """Ключ состояния в том виде, в каком его запросит TeleBot, — для предзагрузки в batch()"""
+        return 'hash', self._key(chat_id, user_id, bot_id=self.bot_id)
+
+    def set_state(self, chat_id, user_id, state, business_connection_id=None, message_thread_id=None, bot_id=None):
+        if hasattr(state, "name"):
+            state = state.name
+        key = self._key(chat_id, user_id, business_connection_id, message_thread_id, bot_id)
+        self.conn.write_hash(key, {"state": state}, self.ttl, setnx={"data": "{}"})
+        return True
+
+    def get_state(self, chat_id, user_id, business_connection_id=None, message_thread_id=None, bot_id=None):
+        key = self._key(chat_id, user_id, business_connection_id, message_thread_id, bot_id)
+        return (self.conn.read_hash(key) or {}).get("state")
+
+    def delete_state(self, chat_id, user_id, business_connection_id=None, message_thread_id=None, bot_id=None):
+        key = self._key(chat_id, user_id, business_connection_id, message_thread_id, bot_id)
+        self.conn.delete(key, empty={})
+        return True
+
+    def get_data(self, chat_id, user_id, business_connection_id=None, message_thread_id=None, bot_id=None):
+        key = self._key(chat_id, user_id, business_connection_id, message_thread_id, bot_id)
+        data = (self.conn.read_hash(key) or {}).get("data")
+        return json.loads(data) if data else {}
+
+    def set_data(self, chat_id, user_id, key, value, business_connection_id=None, message_thread_id=None, bot_id=None):
+        data = self.get_data(chat_id, user_id, business_connection_id, message_thread_id, bot_id)
+        data[key] = value
+        return self.save(chat_id, user_id, data, business_connection_id, message_thread_id, bot_id)
+
+    def reset_data(self, chat_id, user_id, business_connection_id=None, message_thread_id=None, bot_id=None):
+        return self.save(chat_id, user_id, {}, business_connection_id, message_thread_id, bot_id)
+
+    def save(self, chat_id, user_id, data, business_connection_id=None, message_thread_id=None, bot_id=None):
+        key = self._key(chat_id, user_id, business_connection_id, message_thread_id, bot_id)
+        self.conn.write_hash(key, {"data": json.dumps(data, ensure_ascii=False)}, self.ttl)
+        return True
+
+    def get_interactive_data(self, chat_id, user_id, business_connection_id=None, message_thread_id=None, bot_id=None):
+        return StateDataContext(self, chat_id=chat_id, user_id=user_id, business_connection_id=business_connection_id,
+                                message_thread_id=message_thread_id, bot_id=bot_id)
+
+    def __str__(self) -> str:
+        return f"RedisStateStorage({self.conn.redis})"
+
+
+class RedisSessionBackend(SessionBackend):
+    """Backend для SessionStore: значение — JSON-список в строковом ключе с TTL"""
+
+    def __init__(self, conn: RedisConnection):
+        self.conn = conn
+
+    def prefetch_key(self, namespace: str, key: Hashable) -> Tuple[str, str]:
+        return 'string', self.conn.key("session", namespace, key)
+
+    def load(self, namespace: str, key: Hashable) -> Optional[tuple]:
+        raw = self.conn.read_string(self.conn.key("session", namespace, key))
+        return tuple(json.loads(raw)) if raw else None
+
+    def save(self, namespace: str, key: Hashable, value: tuple, ttl: float):
+        self.conn.write_string(self.conn.key("session", namespace, key), json.dumps(value, ensure_ascii=False), int(ttl))
+
+    def delete(self, namespace: str, key: Hashable):
+        self.conn.delete(self.conn.key("session", namespace, key))
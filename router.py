@@ -0,0 +1,101 @@
+from typing import Callable, Dict, Optional, Tuple
+
+Handler = Callable
+Route = Tuple[Handler, bool]
+
+
+class Router:
+    """Диспетчер апдейтов за O(1).
+
+    Тексты кнопок ищутся в словаре точных совпадений, callback_data — сначала
+    в словаре точных значений, затем в таблице префиксов, сгруппированной по
+    длине префикса. Всё, что не нашлось, уходит в явный fallback.
+    Маршруты с admin=True срабатывают только для администратора, для остальных
+    апдейт идёт дальше, как если бы маршрута не было.
+    С metrics время каждого хэндлера пишется в bot_handler_seconds.
+    """
+
+    def __init__(self, admin_id: Optional[int] = None, metrics=None):
+        self.admin_id = admin_id
+        self.metrics = metrics
+        self._texts: Dict[str, Route] = {}
+        self._callbacks: Dict[str, Route] = {}
+        self._prefixes: Dict[int, Dict[str, Route]] = {}
+        self._prefix_lengths: Tuple[int, ...] = ()
+        self._text_fallback: Optional[Handler] = None
+        self._callback_fallback: Optional[Handler] = None
+
+    # === РЕГИСТРАЦИЯ ===
+    def text(self, *texts: str, admin: bool = False):
+        def decorator(handler):
+            for text in texts:
+                self._texts[text] = (handler, admin)
+            return handler
+        return decorator
+
+    def callback(self, *values: str, admin: bool = False):
+        def decorator(handler):
+            for value in values:
+                self._callbacks[value] = (handler, admin)
+            return handler
+        return decorator
+
+    def callback_prefix(self, *prefixes: str, admin: bool = False):
+        def decorator(handler):
+            for prefix in prefixes:
+                self._prefixes.setdefault(len(prefix), {})[prefix] = (handler, admin)
+            # Длинные префиксы проверяем первыми
+            self._prefix_lengths = tuple(sorted(self._prefixes, reverse=True))
+            return handler
+        return decorator
+
+    def text_fallback(self, handler):
+        self._text_fallback = handler
+        return handler
+
+    def callback_fallback(self, handler):
+        self._callback_fallback = handler
+        return handler
+
+    # === ПОИСК ===
+    def _allowed(self, route: Optional[Route], user_id: int) -> Optional[Handler]:
+        if route is None:
+            return None
+        handler, admin = route
+        if admin and user_id != self.admin_id:
+            return None
+        return handler
+
+    def resolve_message(self, msg) -> Optional[Handler]:
+        handler = self._allowed(self._texts.get(msg.text), msg.from_user.id)
+        return handler or self._text_fallback
+
+    def resolve_callback(self, call) -> Optional[Handler]:
+        data = call.data or ""
+        user_id = call.from_user.id
+        handler = self._allowed(self._callbacks.get(data), user_id)
+        if handler:
+            return handler
+        for length in self._prefix_lengths:
+            table = self._prefixes[length]
+            handler = self._allowed(table.get(data[:length]), user_id)
+            if handler:
+                return handler
+        return self._callback_fallback
+
+    # === ДИСПЕТЧЕРИЗАЦИЯ ===
+    def dispatch_message(self, msg):
+        handler = self.resolve_message(msg)
+        if handler:
+            return self._call(handler, msg)
+
+    def dispatch_callback(self, call):
+        handler = self.resolve_callback(call)
+        if handler:
+            return self._call(handler, call)
+
+    def _call(self, handler: Handler, obj):
+        if self.metrics is None:
+            return handler(obj)
+        with self.metrics.timer('bot_handler_seconds', handler.__name__):
+            return handler(obj)
@@ -0,0 +1,101 @@
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+
+
+class SessionBackend(ABC):
+    """Интерфейс внешнего хранилища сессий (Redis и т.п.); значения — кортежи простых типов"""
+
+    @abstractmethod
+    def load(self, namespace: str, key: Hashable) -> Optional[tuple]:
+        ...
+
+    @abstractmethod
+    def save(self, namespace: str, key: Hashable, value: tuple, ttl: float):
+        ...
+
+    @abstractmethod
+    def delete(self, namespace: str, key: Hashable):
+        ...
+
+
+class SessionStore:
+    """Сессии пользователей с TTL и LRU-вытеснением.
+
+    Запись — кортеж (expires_at, value), значения тоже кортежи: так на пользователя
+    уходит пара небольших объектов вместо словаря. Срок жизни продлевается при каждом
+    обращении, поэтому OrderedDict упорядочен и по давности, и по сроку — просроченные
+    записи всегда в начале и вычищаются за O(1) на операцию. Сверх max_entries
+    вытесняются самые давние. При заданном backend (Redis) хранилищем служит только
+    он: локальной копии нет, чтобы несколько реплик бота не отдавали устаревшую
+    карусель, а TTL и вытеснение берёт на себя сам backend.
+    """
+
+    def __init__(self, namespace: str, ttl: float = 3600, max_entries: int = 10000,
+                 backend: Optional[SessionBackend] = None):
+        self.namespace = namespace
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.backend = backend
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.evicted = 0
+        self.expired = 0
+
+    def _purge(self, now: float):
+        data = self._data
+        while data:
+            key, (expires_at, _) = next(iter(data.items()))
+            if expires_at > now:
+                break
+            del data[key]
+            self.expired += 1
+        while len(data) > self.max_entries:
+            data.popitem(last=False)
+            self.evicted += 1
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        if self.backend is not None:
+            value = self.backend.load(self.namespace, key)
+            return default if value is None else tuple(value)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    self._data[key] = (now + self.ttl, entry[1])
+                    self._data.move_to_end(key)
+                    return entry[1]
+                del self._data[key]
+                self.expired += 1
+        return default
+
+    def set(self, key: Hashable, value: tuple):
+        if self.backend is not None:
+            self.backend.save(self.namespace, key, value, self.ttl)
+            return
+        now = time.monotonic()
+        with self._lock:
+            self._data[key] = (now + self.ttl, value)
+            self._data.move_to_end(key)
+            self._purge(now)
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        value = self.get(key, default)
+        if self.backend is not None:
+            self.backend.delete(self.namespace, key)
+            return value
+        with self._lock:
+            self._data.pop(key, None)
+        return value
+
+    def __contains__(self, key: Hashable) -> bool:
+        return self.get(key) is not None
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def stats(self) -> dict:
+        return {'size': len(self._data), 'evicted': self.evicted, 'expired': self.expired}
@@ -0,0 +1,200 @@
+import fcntl
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from abc import ABC, abstractmethod
+from typing import Callable, Optional
+
+from telebot.handler_backends import BaseMiddleware
+
+logger = logging.getLogger(__name__)
+
+
+def default_owner() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+class Lease(ABC):
+    """Право обслуживать бота одним экземпляром: захват с TTL и продление в фоне.
+
+    Новый экземпляр ждёт, пока старый не отпустит лизу (при остановке) или она
+    не истечёт (старый упал) — вместо фиксированной паузы. Продление каждые
+    ttl/3 секунд; если лизу успел забрать другой, вызывается on_lost.
+    """
+
+    def __init__(self, ttl: float = 15.0, owner: Optional[str] = None):
+        self.ttl = ttl
+        self.owner = owner or default_owner()
+        self.held = False
+        self.on_lost: Optional[Callable[[], None]] = None
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @abstractmethod
+    def try_acquire(self) -> bool:
+        ...
+
+    @abstractmethod
+    def renew(self) -> bool:
+        ...
+
+    @abstractmethod
+    def _release(self):
+        ...
+
+    def acquire(self, poll: float = 0.2, timeout: Optional[float] = None, max_backoff: float = 5.0) -> float:
+        """Дождаться лизы; возвращает, сколько секунд ждали.
+
+        Ошибки хранилища (Redis недоступен, таймаут) не прерывают ожидание:
+        пишем в лог и пробуем снова с растущей паузой до max_backoff.
+        """
+        started = time.monotonic()
+        logged = False
+        backoff = poll
+        while True:
+            delay = poll
+            try:
+                if self.try_acquire():
+                    break
+                backoff = poll
+                if not logged:
+                    logger.info("Лиза занята другим экземпляром, ждём освобождения (TTL %s с)", self.ttl)
+                    logged = True
+            except Exception as e:
+                delay, backoff = backoff, min(backoff * 2, max_backoff)
+                logger.warning("Не удалось проверить лизу: %s; повтор через %.2f с", e, delay)
+            waited = time.monotonic() - started
+            if timeout is not None and waited >= timeout:
+                raise TimeoutError(f"лиза не получена за {timeout} с")
+            time.sleep(delay)
+        self.held = True
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._heartbeat, name="lease-heartbeat", daemon=True)
+        self._thread.start()
+        return time.monotonic() - started
+
+    def _heartbeat(self):
+        while not self._stop.wait(self.ttl / 3):
+            try:
+                renewed = self.renew()
+            except Exception as e:
+                # Лиза действует до истечения TTL — следующая попытка ещё успеет
+                logger.warning("Не удалось продлить лизу: %s", e)
+                continue
+            if not renewed:
+                self.held = False
+                logger.error("Лиза перехвачена другим экземпляром")
+                if self.on_lost is not None:
+                    self.on_lost()
+                return
+
+    def release(self):
+        """Отпустить лизу — следующий экземпляр стартует сразу, не дожидаясь TTL"""
+        self._stop.set()
+        if not self.held:
+            return
+        self.held = False
+        try:
+            self._release()
+        except Exception as e:
+            logger.warning("Не удалось освободить лизу: %s", e)
+
+
+class FileLease(Lease):
+    """Лиза в локальном файле (общий том или один хост): JSON с владельцем и сроком под flock"""
+
+    def __init__(self, path: str, ttl: float = 15.0, owner: Optional[str] = None):
+        super().__init__(ttl, owner)
+        self.path = path
+
+    def _update(self, take: bool, extend: bool = True) -> bool:
+        with open(self.path, "a+", encoding="utf-8") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.seek(0)
+            try:
+                current = json.loads(f.read() or "{}")
+            except ValueError:
+                current = {}
+            now = time.time()
+            mine = current.get('owner') == self.owner
+            free = not current or current.get('expires', 0) < now
+            if not mine and not (take and free):
+                return False
+            f.seek(0)
+            f.truncate()
+            if extend:
+                json.dump({'owner': self.owner, 'expires': now + self.ttl}, f)
+            f.flush()
+            os.fsync(f.fileno())
+            return True
+
+    def try_acquire(self) -> bool:
+        return self._update(take=True)
+
+    def renew(self) -> bool:
+        return self._update(take=False)
+
+    def _release(self):
+        self._update(take=False, extend=False)
+
+
+class RedisLease(Lease):
+    """Лиза в Redis: SET NX PX на захват, продление и освобождение — только своей (Lua)"""
+
+    _RENEW = """
+    if redis.call('get', KEYS[1]) == ARGV[1] then
+        return redis.call('pexpire', KEYS[1], ARGV[2])
+    end
+    return 0
+    """
+    _RELEASE = """
+    if redis.call('get', KEYS[1]) == ARGV[1] then
+        return redis.call('del', KEYS[1])
+    end
+    return 0
+    """
+
+    def __init__(self, client, key: str = "bot:lease", ttl: float = 15.0, owner: Optional[str] = None):
+        super().__init__(ttl, owner)
+        self.client = client
+        self.key = key
+        self._renew = client.register_script(self._RENEW)
+        self._release_script = client.register_script(self._RELEASE)
+
+    def try_acquire(self) -> bool:
+        return bool(self.client.set(self.key, self.owner, nx=True, px=int(self.ttl * 1000)))
+
+    def renew(self) -> bool:
+        return bool(self._renew(keys=[self.key], args=[self.owner, int(self.ttl * 1000)]))
+
+    def _release(self):
+        self._release_script(keys=[self.key], args=[self.owner])
+
+
+class FirstUpdate(BaseMiddleware):
+    """Замер времени от старта процесса до первого апдейта, дошедшего до бота"""
+
+    def __init__(self, started: float, on_first: Optional[Callable[[float], None]] = None):
+        super().__init__()
+        self.update_types = ['message', 'callback_query']
+        self.started = started
+        self.on_first = on_first
+        self.elapsed: Optional[float] = None
+        self._lock = threading.Lock()
+
+    def pre_process(self, update, data):
+        if self.elapsed is not None:
+            return
+        with self._lock:
+            if self.elapsed is not None:
+                return
+            self.elapsed = time.monotonic() - self.started
+        if self.on_first is not None:
+            self.on_first(self.elapsed)
+
+    def post_process(self, update, data, exception):
+        pass
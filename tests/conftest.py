@@ -0,0 +1,46 @@
+import os
+import sys
+
+import fakeredis
+import pytest
+import redis
+
+# Модули бота лежат в корне репозитория
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from redis_storage import RedisConnection  # noqa: E402
+
+
+@pytest.fixture
+def redis_conn():
+    """RedisConnection поверх fakeredis: тот же пул соединений, что в боте, но без сервера"""
+    pool = redis.ConnectionPool(connection_class=fakeredis.FakeRedisConnection, server=fakeredis.FakeServer())
+    return RedisConnection(pool, prefix="test")
+
+
+@pytest.fixture
+def round_trips(redis_conn, monkeypatch):
+    """Запросы к Redis по порядку: ('command', имя) или ('pipeline', [имена команд])"""
+    calls = []
+    client = redis_conn.redis
+    execute_command = client.execute_command
+    pipeline = client.pipeline
+
+    def counted_command(*args, **kwargs):
+        calls.append(('command', args[0]))
+        return execute_command(*args, **kwargs)
+
+    def counted_pipeline(*args, **kwargs):
+        pipe = pipeline(*args, **kwargs)
+        execute = pipe.execute
+
+        def counted_execute(*a, **kw):
+            calls.append(('pipeline', [command[0][0] for command in pipe.command_stack]))
+            return execute(*a, **kw)
+
+        pipe.execute = counted_execute
+        return pipe
+
+    monkeypatch.setattr(client, 'execute_command', counted_command)
+    monkeypatch.setattr(client, 'pipeline', counted_pipeline)
+    return calls
@@ -0,0 +1,96 @@
+import threading
+import time
+from collections import Counter
+
+import pytest
+
+from broadcast import Broadcaster
+from database import BroadcastStore, Database
+from ratelimit import TokenBucket
+
+USERS = range(1, 301)
+
+
+class FakeBot:
+    """send_message с задержкой, как у настоящего API; edit_message_text — прогресс рассылки"""
+
+    def __init__(self, delay: float = 0.002):
+        self.delay = delay
+        self.sent = Counter()
+        self._lock = threading.Lock()
+
+    def send_message(self, chat_id, text, **kwargs):
+        time.sleep(self.delay)
+        with self._lock:
+            self.sent[chat_id] += 1
+
+    def edit_message_text(self, *args, **kwargs):
+        pass
+
+
+@pytest.fixture
+def db(tmp_path):
+    db = Database(str(tmp_path / "users.db"), legacy_db=None)
+    for uid in USERS:
+        db.add_user(uid, f"user{uid}", "Имя", None)
+    yield db
+    db.pool.close_all()
+
+
+def make_broadcaster(db, bot, **kwargs):
+    return Broadcaster(bot, BroadcastStore(db.pool), TokenBucket(5000), workers=8,
+                       progress_interval=0.05, checkpoint_size=20, **kwargs)
+
+
+def wait_done(job, timeout=30):
+    assert job.done.wait(timeout), "рассылка не завершилась"
+
+
+def deliveries(db, job_id):
+    return dict(db.pool.execute(
+        "SELECT status, COUNT(*) FROM broadcast_deliveries WHERE job_id = ? GROUP BY status", (job_id,)
+    ).fetchall())
+
+
+def test_interrupt_and_resume_sends_each_user_once(db):
+    bot = FakeBot()
+    first = make_broadcaster(db, bot)
+    job = first.start("Новости", chat_id=1, message_id=1)
+    while job.processed < 100:
+        time.sleep(0.005)
+    first.shutdown()  # как при SIGTERM: прогресс сохранён, задание осталось незавершённым
+    wait_done(job)
+    assert 0 < sum(bot.sent.values()) < len(USERS)
+
+    second = make_broadcaster(db, bot)
+    resumed = second.resume_unfinished()
+    assert [j.id for j in resumed] == [job.id]
+    wait_done(resumed[0])
+
+    assert set(bot.sent) == set(USERS)
+    assert max(bot.sent.values()) == 1
+    assert deliveries(db, job.id) == {'sent': len(USERS)}
+    row = BroadcastStore(db.pool).get_job(job.id)
+    assert (row['status'], row['sent'], row['failed']) == ('done', len(USERS), 0)
+
+
+def test_failed_checkpoint_keeps_results(db):
+    bot = FakeBot()
+    broadcaster = make_broadcaster(db, bot)
+    store = broadcaster.store
+    checkpoint = store.checkpoint
+    failures = iter([True, True])
+
+    def flaky_checkpoint(*args, **kwargs):
+        if next(failures, False):
+            raise RuntimeError("database is locked")
+        return checkpoint(*args, **kwargs)
+
+    store.checkpoint = flaky_checkpoint
+    job = broadcaster.start("Новости", chat_id=1, message_id=1)
+    wait_done(job)
+
+    assert sum(bot.sent.values()) == len(USERS)
+    assert deliveries(db, job.id) == {'sent': len(USERS)}
+    row = store.get_job(job.id)
+    assert (row['status'], row['sent']) == ('done', len(USERS))
@@ -0,0 +1,145 @@
+import sqlite3
+
+import pytest
+
+from database import MIGRATIONS, Database
+
+
+def make_baseline_users_db(path):
+    """users.db в формате первой версии бота: user_id TEXT, messages_count без NOT NULL"""
+    conn = sqlite3.connect(path)
+    conn.execute('''
+        CREATE TABLE users (
+            user_id TEXT PRIMARY KEY,
+            username TEXT,
+            first_name TEXT,
+            last_name TEXT,
+            full_name TEXT,
+            first_seen TEXT,
+            last_activity TEXT,
+            messages_count INTEGER
+        )
+    ''')
+    conn.executemany("INSERT INTO users VALUES (?, ?, ?, ?, ?, ?, ?, ?)", [
+        ("42", "old", "Иван", None, "Иван", "2026-01-01T09:00:00", "2026-01-01T10:00:00", 3),
+        # Тот же пользователь, записанный с пробелом, — остаётся более свежая запись
+        (" 42", "new", "Иван", "Петров", "Иван Петров", "2026-01-02T09:00:00", "2026-02-01T10:00:00", 5),
+        ("7", None, None, None, None, "2026-01-05T09:00:00", "2026-01-05T09:00:00", None),
+        ("abc", "broken", None, None, None, None, None, 1),
+    ])
+    conn.commit()
+    conn.close()
+
+
+def make_baseline_legacy_db(path):
+    """bot_database.db старого модуля database.py: users с created_at / last_active и заказы"""
+    conn = sqlite3.connect(path)
+    conn.execute('''
+        CREATE TABLE users (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            first_name TEXT,
+            last_name TEXT,
+            created_at TEXT,
+            last_active TEXT
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE orders (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            user_name TEXT,
+            user_phone TEXT,
+            user_email TEXT,
+            bike_model TEXT,
+            frame_size TEXT,
+            created_at TEXT
+        )
+    ''')
+    conn.executemany("INSERT INTO users VALUES (?, ?, ?, ?, ?, ?)", [
+        (42, "legacy42", "Иван", "Петров", "2025-12-01T08:00:00", "2026-03-01T12:00:00"),
+        (99, None, "Анна", "Б", "2026-02-10T08:00:00", "2026-02-10T08:30:00"),
+    ])
+    conn.executemany(
+        "INSERT INTO orders (user_id, user_name, user_phone, user_email, bike_model, frame_size, created_at) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?)", [
+            (42, "Иван", "+79001234567", None, "PRIMO", "M", "2026-03-01T12:00:00"),
+            (99, "Анна", "89001234567", None, None, None, "2026-02-10T08:30:00"),
+            (None, "Без id", None, None, "PRIMO", "L", "2026-02-11T08:30:00"),
+        ])
+    conn.commit()
+    conn.close()
+
+
+def users(db):
+    return {row[0]: row[1:] for row in db.pool.execute('''
+        SELECT user_id, username, full_name, first_seen, last_activity, messages_count, reachable
+        FROM users ORDER BY user_id
+    ''')}
+
+
+def counters(db):
+    return dict(db.pool.execute("SELECT name, value FROM stats_counters").fetchall())
+
+
+@pytest.fixture
+def open_db():
+    opened = []
+
+    def open_db(*args, **kwargs):
+        db = Database(*args, **kwargs)
+        opened.append(db)
+        return db
+
+    yield open_db
+    for db in opened:
+        db.pool.close_all()
+
+
+def test_v1_converts_text_ids(tmp_path, open_db):
+    path = str(tmp_path / "users.db")
+    make_baseline_users_db(path)
+    db = open_db(path, legacy_db=str(tmp_path / "missing.db"))
+
+    assert db.version == len(MIGRATIONS)
+    assert users(db) == {
+        7: (None, "", "2026-01-05T09:00:00", "2026-01-05T09:00:00", 0, 1),
+        42: ("new", "Иван Петров", "2026-01-02T09:00:00", "2026-02-01T10:00:00", 5, 1),
+    }
+    assert counters(db) == {'total_users': 2, 'reachable_users': 2, 'total_messages': 5}
+    assert db.pool.execute("SELECT COUNT(*) FROM orders").fetchone()[0] == 0
+
+
+def test_v2_merges_legacy_users_and_orders(tmp_path, open_db):
+    path, legacy = str(tmp_path / "users.db"), str(tmp_path / "bot_database.db")
+    make_baseline_users_db(path)
+    make_baseline_legacy_db(legacy)
+    db = open_db(path, legacy_db=legacy)
+
+    assert users(db) == {
+        7: (None, "", "2026-01-05T09:00:00", "2026-01-05T09:00:00", 0, 1),
+        # Данные users.db приоритетнее, из старой БД — более ранний first_seen и поздний last_activity
+        42: ("new", "Иван Петров", "2025-12-01T08:00:00", "2026-03-01T12:00:00", 5, 1),
+        99: (None, "Анна Б", "2026-02-10T08:00:00", "2026-02-10T08:30:00", 0, 1),
+    }
+    assert counters(db) == {'total_users': 3, 'reachable_users': 3, 'total_messages': 5}
+    assert db.pool.execute("SELECT user_id, bike_model FROM orders ORDER BY id").fetchall() == [
+        (42, "PRIMO"), (99, None),
+    ]
+    assert db.count_orders("2026-01-01") == 2
+    assert db.get_sales_by_model("2026-01-01") == [("PRIMO", 1)]
+    assert dict(db.pool.execute("SELECT day, new_users FROM stats_daily WHERE new_users > 0").fetchall()) == {
+        "2025-12-01": 1, "2026-01-05": 1, "2026-02-10": 1,
+    }
+
+    # Повторное открытие ничего не переносит заново
+    db.pool.close_all()
+    again = open_db(path, legacy_db=legacy)
+    assert counters(again) == {'total_users': 3, 'reachable_users': 3, 'total_messages': 5}
+    assert again.count_orders() == 2
+
+
+def test_indexes_after_migration(tmp_path, open_db):
+    db = open_db(str(tmp_path / "users.db"), legacy_db=None)
+    indexes = {row[1] for row in db.pool.execute("PRAGMA index_list(orders)")}
+    assert indexes == {'idx_orders_user_created', 'idx_orders_created_model'}
@@ -0,0 +1,119 @@
+from telebot import TeleBot
+from telebot.handler_backends import State, StatesGroup
+
+from redis_storage import RedisSessionBackend, RedisStateStorage
+from sessions import SessionStore
+
+TOKEN = "123:test"
+BOT_ID = 123
+USER = 42
+CHAT = 42
+
+
+class Form(StatesGroup):
+    waiting = State()
+
+
+def make_bot(redis_conn, ttl=600):
+    storage = RedisStateStorage(redis_conn, ttl=ttl, bot_id=BOT_ID)
+    return TeleBot(TOKEN, state_storage=storage, threaded=False), storage
+
+
+# === FSM ===
+def test_state_set_get_delete(redis_conn):
+    bot, _ = make_bot(redis_conn)
+    assert bot.get_state(USER, CHAT) is None
+    bot.set_state(USER, Form.waiting, CHAT)
+    assert bot.get_state(USER, CHAT) == Form.waiting.name
+    bot.delete_state(USER, CHAT)
+    assert bot.get_state(USER, CHAT) is None
+
+
+def test_retrieve_data_saves_on_exit(redis_conn):
+    bot, _ = make_bot(redis_conn)
+    bot.set_state(USER, Form.waiting, CHAT)
+    with bot.retrieve_data(USER, CHAT) as data:
+        data['model'] = "PRIMO"
+        data['size'] = "M"
+    with bot.retrieve_data(USER, CHAT) as data:
+        assert data == {'model': "PRIMO", 'size': "M"}
+    # Данные не затирают состояние — это поля одного hash
+    assert bot.get_state(USER, CHAT) == Form.waiting.name
+
+
+def test_set_state_keeps_existing_data(redis_conn):
+    bot, _ = make_bot(redis_conn)
+    bot.add_data(USER, CHAT, model="PRIMO")
+    bot.set_state(USER, Form.waiting, CHAT)
+    with bot.retrieve_data(USER, CHAT) as data:
+        assert data == {'model': "PRIMO"}
+
+
+def test_state_key_has_ttl(redis_conn):
+    bot, storage = make_bot(redis_conn, ttl=600)
+    bot.set_state(USER, Form.waiting, CHAT)
+    _, key = storage.prefetch_key(CHAT, USER)
+    assert 0 < redis_conn.redis.ttl(key) <= 600
+    bot.add_data(USER, CHAT, model="PRIMO")
+    assert 0 < redis_conn.redis.ttl(key) <= 600
+
+
+# === БАТЧ НА АПДЕЙТ ===
+def test_batch_is_one_read_and_one_write(redis_conn, round_trips):
+    bot, storage = make_bot(redis_conn)
+    backend = RedisSessionBackend(redis_conn)
+    photos = SessionStore("photo", ttl=300, backend=backend)
+    with redis_conn.batch([storage.prefetch_key(CHAT, USER), backend.prefetch_key("photo", USER)]):
+        assert bot.get_state(USER, CHAT) is None
+        assert photos.get(USER) is None
+        bot.set_state(USER, Form.waiting, CHAT)
+        bot.add_data(USER, CHAT, model="PRIMO")
+        photos.set(USER, ("PRIMO", 1))
+        # Внутри батча чтения видят свои же отложенные записи
+        assert bot.get_state(USER, CHAT) == Form.waiting.name
+        assert photos.get(USER) == ("PRIMO", 1)
+    assert [kind for kind, _ in round_trips] == ['pipeline', 'pipeline']
+    assert round_trips[0][1] == ['HGETALL', 'GET']
+    assert set(round_trips[1][1]) <= {'HSET', 'HSETNX', 'EXPIRE', 'SET'}
+    assert bot.get_state(USER, CHAT) == Form.waiting.name
+    assert photos.get(USER) == ("PRIMO", 1)
+
+
+def test_batch_without_writes_skips_flush(redis_conn, round_trips):
+    bot, storage = make_bot(redis_conn)
+    with redis_conn.batch([storage.prefetch_key(CHAT, USER)]):
+        bot.get_state(USER, CHAT)
+        bot.get_state(USER, CHAT)
+    assert round_trips == [('pipeline', ['HGETALL'])]
+
+
+def test_nested_batch_flushes_once(redis_conn, round_trips):
+    bot, _ = make_bot(redis_conn)
+    with redis_conn.batch():
+        with redis_conn.batch():
+            bot.set_state(USER, Form.waiting, CHAT)
+        assert round_trips == [('command', 'HGETALL')]  # чтение перед записью hash, записи ещё не ушли
+    assert [kind for kind, _ in round_trips] == ['command', 'pipeline']
+
+
+# === СЕССИИ ===
+def test_session_store_with_redis_backend(redis_conn):
+    backend = RedisSessionBackend(redis_conn)
+    store = SessionStore("order", ttl=300, backend=backend)
+    assert store.get(USER) is None
+    assert USER not in store
+    store.set(USER, ("PRIMO", "M"))
+    assert store.get(USER) == ("PRIMO", "M")
+    assert USER in store
+    # Другая реплика с тем же Redis видит ту же сессию
+    assert SessionStore("order", ttl=300, backend=backend).get(USER) == ("PRIMO", "M")
+    assert SessionStore("photo", ttl=300, backend=backend).get(USER) is None
+    assert store.pop(USER) == ("PRIMO", "M")
+    assert store.get(USER, ("none", None)) == ("none", None)
+
+
+def test_session_key_has_ttl(redis_conn):
+    backend = RedisSessionBackend(redis_conn)
+    SessionStore("order", ttl=300, backend=backend).set(USER, ("PRIMO", "M"))
+    _, key = backend.prefetch_key("order", USER)
+    assert 0 < redis_conn.redis.ttl(key) <= 300
@@ -0,0 +1,229 @@
+import hmac
+import json
+import logging
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Deque, Dict, List, Optional
+
+from telebot import types
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+MAX_BODY = 1 << 20  # Telegram не шлёт апдейты больше мегабайта
+
+
+class _HTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 128  # Telegram открывает до max_connections соединений разом
+
+
+def _user_key(update: dict) -> int:
+    """Чьи это апдейты: пока один из них в обработке, остальные ждут его, по порядку"""
+    for field in ("message", "edited_message", "callback_query", "inline_query", "my_chat_member"):
+        obj = update.get(field)
+        if obj:
+            sender = obj.get("from") or obj.get("chat") or {}
+            return sender.get("id", 0)
+    return update.get("update_id", 0)
+
+
+class WebhookServer:
+    """Приём апдейтов по вебхуку.
+
+    HTTP-поток только проверяет секрет, разбирает JSON и кладёт апдейт в общую
+    очередь — ответ Telegram уходит сразу, не дожидаясь хэндлеров. Очередь
+    ограничена: если воркеры не успевают, отвечаем 503 и Telegram повторит
+    доставку позже (это и есть backpressure). Апдейт берёт любой свободный
+    воркер; если этот пользователь уже в обработке у другого воркера, апдейт
+    уходит ему в хвост — так апдейты одного человека идут по порядку, а
+    свободные воркеры не простаивают, пока у соседа очередь.
+    """
+
+    def __init__(self, bot, secret: Optional[str], host: str = "0.0.0.0", port: int = 8080,
+                 path: str = "/webhook", workers: int = 8, queue_size: int = 1000,
+                 enqueue_timeout: float = 0.5):
+        self.bot = bot
+        self.secret = secret.encode() if secret else None
+        self.path = path
+        self.enqueue_timeout = enqueue_timeout
+        self.workers = max(1, workers)
+        self.queue_size = max(1, queue_size)
+        self._queue: Deque[dict] = deque()
+        # Пользователь -> апдейты, ждущие воркера, который сейчас обрабатывает этого пользователя
+        self._active: Dict[int, Deque[dict]] = {}
+        self._pending = 0  # принято, но ещё не взято в обработку (общая очередь + хвосты)
+        self._closing = False
+        self._threads: List[threading.Thread] = []
+        self._lock = threading.Lock()
+        self._ready = threading.Condition(self._lock)  # в очереди появился апдейт
+        self._space = threading.Condition(self._lock)  # в очереди освободилось место
+        self.received = 0
+        self.processed = 0
+        self.rejected = 0
+        self.overloaded = 0
+        self.errors = 0
+        self.max_depth = 0
+        self._handle_time = 0.0
+        self._httpd = _HTTPServer((host, port), self._handler_class())
+
+    @property
+    def port(self) -> int:
+        return self._httpd.server_address[1]
+
+    # === HTTP ===
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def _reply(self, code: int, body: bytes = b"", content_type: str = "text/plain", close: bool = False):
+                self.send_response(code)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                if close:
+                    # Тело запроса не прочитано — соединение дальше использовать нельзя
+                    self.send_header("Connection", "close")
+                    self.close_connection = True
+                self.end_headers()
+                if body:
+                    self.wfile.write(body)
+
+            def do_GET(self):
+                # Порт вебхука публичный: наружу только «жив», счётчики — в админке и на MetricsServer
+                if self.path == "/healthz":
+                    self._reply(200, b'{"status": "ok"}', "application/json")
+                else:
+                    self._reply(404)
+
+            def do_POST(self):
+                if self.path != server.path:
+                    self._reply(404, close=True)
+                    return
+                if server.secret is not None:
+                    token = (self.headers.get(SECRET_HEADER) or "").encode()
+                    if not hmac.compare_digest(token, server.secret):
+                        with server._lock:
+                            server.rejected += 1
+                        self._reply(403, close=True)
+                        return
+                length = int(self.headers.get("Content-Length") or 0)
+                if length <= 0 or length > MAX_BODY:
+                    self._reply(400, close=True)
+                    return
+                try:
+                    update = json.loads(self.rfile.read(length))
+                except ValueError:
+                    self._reply(400)
+                    return
+                self._reply(200 if server.submit(update) else 503)
+
+            def log_message(self, format, *args):
+                pass  # каждый апдейт в лог — слишком шумно
+
+        return Handler
+
+    def submit(self, update: dict) -> bool:
+        """Поставить апдейт в очередь; False — очередь полна"""
+        with self._lock:
+            if not self._space.wait_for(lambda: self._pending < self.queue_size, self.enqueue_timeout):
+                self.overloaded += 1
+                return False
+            self._queue.append(update)
+            self._pending += 1
+            self.received += 1
+            if self._pending > self.max_depth:
+                self.max_depth = self._pending
+            self._ready.notify()
+        return True
+
+    # === ВОРКЕРЫ ===
+    def _take(self) -> Optional[dict]:
+        """Следующий апдейт пользователя, которого сейчас никто не обрабатывает; None — пора выходить"""
+        with self._lock:
+            while True:
+                if not self._queue:
+                    if self._closing:
+                        return None
+                    self._ready.wait()
+                    continue
+                update = self._queue.popleft()
+                key = _user_key(update)
+                backlog = self._active.get(key)
+                if backlog is None:
+                    self._active[key] = deque()
+                    self._pending -= 1
+                    self._space.notify()
+                    return update
+                # Пользователь уже у другого воркера — тот доберёт апдейт сам, после текущего
+                backlog.append(update)
+
+    def _next_for(self, key: int) -> Optional[dict]:
+        """Следующий апдейт того же пользователя или None, если его хвост пуст"""
+        with self._lock:
+            backlog = self._active[key]
+            if not backlog:
+                del self._active[key]
+                return None
+            self._pending -= 1
+            self._space.notify()
+            return backlog.popleft()
+
+    def _process(self, update: dict):
+        started = time.monotonic()
+        try:
+            self.bot.process_new_updates([types.Update.de_json(update)])
+        except Exception as e:
+            logger.error("Ошибка обработки апдейта %s: %s", update.get("update_id"), e)
+            with self._lock:
+                self.errors += 1
+        with self._lock:
+            self.processed += 1
+            self._handle_time += time.monotonic() - started
+
+    def _worker(self):
+        while True:
+            update = self._take()
+            if update is None:
+                return
+            key = _user_key(update)
+            while update is not None:
+                self._process(update)
+                update = self._next_for(key)
+
+    def start(self):
+        """Запустить воркеры и HTTP-сервер в фоновых потоках"""
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._worker, name=f"webhook-worker-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        threading.Thread(target=self._httpd.serve_forever, name="webhook-http", daemon=True).start()
+        logger.info("Вебхук слушает %s:%s%s, воркеров: %s", *self._httpd.server_address[:2], self.path, self.workers)
+
+    def stop(self, timeout: float = 10.0):
+        """Перестать принимать апдейты и дообработать то, что уже в очереди"""
+        self._httpd.shutdown()
+        self._httpd.server_close()
+        with self._lock:
+            self._closing = True
+            self._ready.notify_all()
+        deadline = time.monotonic() + timeout
+        for thread in self._threads:
+            thread.join(max(0.0, deadline - time.monotonic()))
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            processed = self.processed
+            return {
+                'received': self.received,
+                'processed': processed,
+                'queued': self._pending,
+                'max_depth': self.max_depth,
+                'overloaded': self.overloaded,
+                'rejected': self.rejected,
+                'errors': self.errors,
+                'avg_handle_ms': round(self._handle_time / processed * 1000, 2) if processed else 0.0,
+            }